@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Pre-allocation of entity ids, so keys are known before the put.'''
+
+import logging
+import threading
+
+from google.appengine.ext import ndb
+from google.appengine.api import namespace_manager
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['KeyAllocator', 'allocator']
+
+# Ids allocated at once for root entities of a kind.
+RANGE_SIZE = 100
+
+
+def _kind(kind):
+  if isinstance(kind, basestring):
+    return kind
+  return kind._get_kind()
+
+
+class KeyAllocator(object):
+  '''Hands out ids of root entities from ranges reserved in bulk with
+  allocate_ids, one pool by namespace and kind. Thread safe: the RPC is made
+  out of the lock. Ids of child entities are allocated for their parent
+  with one RPC by call, as ranges of a parent are rarely reused. Ids left
+  in pools when the instance dies are just never used.'''
+  def __init__(self, range_size=RANGE_SIZE):
+    self.range_size = range_size
+    self._lock = threading.Lock()
+    self._pools = {}
+
+  def _allocate_range(self, kind, size, parent=None, namespace=None):
+    key = ndb.Key(kind, None, parent=parent, namespace=namespace)
+    return ndb.get_context().allocate_ids(key, size=size).get_result()
+
+  def allocate_ids(self, kind, count=1, parent=None, namespace=None):
+    '''Returns a list of count ids.
+
+    Args:
+      kind: model class or kind name.
+      count: number of ids.
+      parent: key of the parent, if ids are for child entities.
+      namespace: namespace of root entities, the current one by default.'''
+    kind = _kind(kind)
+    if not parent is None:
+      first, last = self._allocate_range(kind, count, parent=parent)
+      return range(first, last + 1)
+
+    if namespace is None:
+      namespace = namespace_manager.get_namespace()
+    ids = []
+    while True:
+      with self._lock:
+        pool = self._pools.setdefault((namespace, kind), [])
+        while pool and len(ids) < count:
+          first, last = pool[0]
+          take = min(last - first + 1, count - len(ids))
+          ids.extend(xrange(first, first + take))
+          if first + take > last:
+            pool.pop(0)
+          else:
+            pool[0] = (first + take, last)
+      if len(ids) >= count:
+        return ids
+      size = max(self.range_size, count - len(ids))
+      first, last = self._allocate_range(kind, size, namespace=namespace)
+      with self._lock:
+        self._pools.setdefault((namespace, kind), []).append((first, last))
+
+  def allocate_keys(self, kind, count=1, parent=None, namespace=None):
+    '''Returns a list of count complete keys. See allocate_ids.'''
+    name = _kind(kind)
+    if not parent is None:
+      namespace = parent.namespace()
+    elif namespace is None:
+      namespace = namespace_manager.get_namespace()
+    return [ndb.Key(name, id, parent=parent, namespace=namespace)
+            for id in self.allocate_ids(name, count, parent=parent,
+                                        namespace=namespace)]
+
+  def allocate_key(self, kind, parent=None, namespace=None):
+    '''Returns a complete key. See allocate_ids.'''
+    return self.allocate_keys(kind, 1, parent=parent, namespace=namespace)[0]
+
+
+allocator = KeyAllocator()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+'''Login latency at several password hashing costs.
+
+Run it from the app root, with appengine SDK in the path:
+  python -m stones.auth.benchmark 1000 10000 50000
+'''
+
+import logging
+import sys
+
+from stones import benchmark
+
+import hashers
+from models import BaseUser
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['benchmark_login']
+
+
+def benchmark_login(costs=(1000, 5000, 10000, 20000, 50000), rounds=50,
+                    user_model=BaseUser):
+  '''Returns login latency stats (see stones.benchmark.summarize) for
+  each PBKDF2 iterations setting. A login is
+  user_model.get_by_auth_password, as used by webapp2 auth.'''
+  results = {}
+  original_hashers = user_model.password_hashers
+  with benchmark.stubs():
+    try:
+      for cost in costs:
+        user_model.password_hashers = [
+          hashers.PBKDF2PasswordHasher(iterations=cost)
+        ] + list(original_hashers[1:])
+        auth_id = 'own:bench%d@example.com' % cost
+        user = user_model(auth_ids=[auth_id], type=['u'])
+        user.set_password('secret')
+        user.put()
+        results[cost] = benchmark.measure(
+          user_model.get_by_auth_password, rounds, 5, auth_id, 'secret')
+    finally:
+      user_model.password_hashers = original_hashers
+  return results
+
+
+def main(argv):
+  costs = [int(cost) for cost in argv[1:]] or None
+  if costs:
+    results = benchmark_login(costs)
+  else:
+    results = benchmark_login()
+  print '%10s %10s %10s %10s' % ('iterations', 'p50 ms', 'p99 ms', 'mean ms')
+  for cost in sorted(results):
+    stats = results[cost]
+    print '%10d %10.2f %10.2f %10.2f' % (cost, stats['p50'], stats['p99'],
+                                         stats['mean'])
+
+
+if __name__ == '__main__':
+  main(sys.argv)
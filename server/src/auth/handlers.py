@@ -3,6 +3,11 @@
 
 import logging
 import datetime
+import time
+try:
+  import simplejson as json
+except ImportError:
+  import json
 
 import stones
 import stones.oauth2 as oauth2
@@ -12,6 +17,8 @@ from google.appengine.api import taskqueue
 
 import webapp2_extras.auth
 
+from google.appengine.ext import ndb
+
 
 logger = logging.getLogger(__name__)
 __all__ = ['AuthError', 'ProviderConfNotFoundError', 'BaseWelcomeHandler',
@@ -20,7 +27,14 @@ __all__ = ['AuthError', 'ProviderConfNotFoundError', 'BaseWelcomeHandler',
            'BaseUserAuthProvidersHandler', 'BaseMakeSuperHeroHandler',
            'BaseLogoutHandler', 'BaseSignupHandler',
            'BaseAccountVerificationEmailHandler',
-           'BaseAccountVerificationHandler', 'BaseLoginHandler']
+           'BaseAccountVerificationHandler', 'BaseLoginHandler',
+           'BaseAccountVerificationEmailBatchHandler']
+
+# Throttling of credentials related requests.
+LOGIN_RATE_LIMITS = [
+  stones.RateLimiter('ip', rate=0.5, burst=20, methods=('POST',)),
+  stones.RateLimiter('auth_id', rate=1 / 60.0, burst=5, methods=('POST',)),
+]
 
 AUTH_CONFIG = {
   'providers': {},
@@ -33,6 +47,18 @@ AUTH_CONFIG = {
     'verify_account': 'auth/verify_account.html',
   },
   'email_sender': 'foo@bar.com',
+  'verification': {
+    # Pull queue to hold account verification jobs. If None, every signup
+    # enqueues its own push task to 'send.account.verification' route.
+    'queue': None,
+    # How many jobs are leased (and emails sent) per batch.
+    'batch_size': 100,
+    'lease_seconds': 60,
+    # Max emails sent per second. 0 means no limit.
+    'emails_per_second': 10,
+    # Stop leasing new batches after this amount of seconds.
+    'deadline': 540,
+  },
 }
 
 
@@ -169,6 +195,26 @@ class BaseOAuth2BeginHandler(OAuth2Conf):
 class BaseSignupHandler(WebAppBaseHandler):
   '''Signup Interface.'''
   tpl_key = 'signup'
+  rate_limits = LOGIN_RATE_LIMITS
+
+  def enqueue_account_verification(self, user_id, signup_token):
+    '''Enqueues the account verification email job.
+    If a pull queue is configured in 'verification' settings, the job is
+    added there to be sent in batches by
+    BaseAccountVerificationEmailBatchHandler; else a push task is added.'''
+    config = self.app.config.load_config('stones.auth',
+      default_values=AUTH_CONFIG)
+    queue_name = config.get('verification', {}).get('queue', None)
+    if queue_name:
+      payload = json.dumps({'user_id': user_id, 'signup_token': signup_token})
+      taskqueue.Queue(queue_name).add(
+        taskqueue.Task(payload=payload, method='PULL'))
+    else:
+      taskqueue.add(
+        url=self.uri_for('send.account.verification', user_id=user_id),
+        params={'signup_token': signup_token},
+        method='POST'
+      )
 
   def post(self):
     username = self.request.get('username')
@@ -195,11 +241,7 @@ class BaseSignupHandler(WebAppBaseHandler):
     ok, new_user = user_model.create_user(auth_id, **user_info)
     if ok:
       signup_token = user_model.create_signup_token(new_user.key.id())
-      taskqueue.add(
-        url=self.uri_for('send.account.verification', user_id=new_user.key.id()),
-        params={'signup_token': signup_token},
-        method='POST'
-      )
+      self.enqueue_account_verification(new_user.key.id(), signup_token)
       return self.redirect_to('welcome')
     else:
       context['username'] = username
@@ -210,14 +252,23 @@ class BaseSignupHandler(WebAppBaseHandler):
 
 class BaseAccountVerificationEmailHandler(stones.BaseHandler):
   '''Handler to begin account verification process.'''
-  def post(self, user_id=None):
-    config = self.app.config.load_config('stones.auth',
+  def get_auth_config(self):
+    return self.app.config.load_config('stones.auth',
       default_values=AUTH_CONFIG,
       required_keys=['email_sender', 'templates'])
 
-    signup_token = self.request.get('signup_token')
-    user = self.auth.store.user_model.get_by_id(int(user_id))
-
+  def render_cached_template(self, _template, **context):
+    '''Renders a template compiled once and cached in the app registry.'''
+    templates = self.app.registry.setdefault('stones.auth.templates', {})
+    template = templates.get(_template, None)
+    if template is None:
+      template = self.jinja2.environment.get_template(_template)
+      templates[_template] = template
+    return template.render(**context)
+
+  def build_verification_email(self, config, user, signup_token):
+    '''Returns the account verification email for user.'''
+    user_id = user.key.id()
     context = {
       'verify_url': self.uri_for('verify.account', signup_token=signup_token,
         user_id=user_id, _full=True),
@@ -225,16 +276,97 @@ class BaseAccountVerificationEmailHandler(stones.BaseHandler):
 
     email = mail.EmailMessage(sender=config['email_sender'])
     email.to = user.email
-    email.body = self.jinja2.render_template(
+    email.body = self.render_cached_template(
       config['templates']['welcome_text'], **context)
-    email.html = self.jinja2.render_template(
+    email.html = self.render_cached_template(
       config['templates']['welcome_html'], **context)
-    email.send()
+    return email
+
+  def post(self, user_id=None):
+    config = self.get_auth_config()
+    signup_token = self.request.get('signup_token')
+    user = self.auth.store.user_model.get_by_id(int(user_id))
+    self.build_verification_email(config, user, signup_token).send()
+
+
+class BaseAccountVerificationEmailBatchHandler(
+    BaseAccountVerificationEmailHandler):
+  '''Handler to send account verification emails in batches.
+  Leases jobs from the pull queue set in 'verification' settings, fetches
+  their users with a single get_multi and sends the emails respecting
+  'emails_per_second'. Intended to be run by cron or a push task.'''
+  def process_batch(self, config, verification, tasks):
+    '''Sends the emails for a batch of leased tasks.
+    Returns the tasks that are done and can be deleted.'''
+    emails_per_second = verification['emails_per_second']
+    user_model = self.auth.store.user_model
+
+    jobs = []
+    done = []
+    for task in tasks:
+      try:
+        jobs.append((task, json.loads(task.payload)))
+      except ValueError:
+        logger.error('Invalid verification job payload: %r' % task.payload)
+        done.append(task)
+
+    keys = [ndb.Key(user_model, int(job['user_id'])) for unused, job in jobs]
+    users = ndb.get_multi(keys)
+    for (task, job), user in zip(jobs, users):
+      if user is None:
+        logger.warning('User %s not found. Dropping verification job.'
+                       % job['user_id'])
+        done.append(task)
+        continue
+      started = time.time()
+      try:
+        self.build_verification_email(config, user,
+                                      job['signup_token']).send()
+      except mail.Error, e:
+        # Lease expires and the job is retried later.
+        logger.error('Verification email to %s failed: %s' % (user.email, e))
+        continue
+      done.append(task)
+      if emails_per_second:
+        elapsed = time.time() - started
+        wait = 1.0 / emails_per_second - elapsed
+        if wait > 0:
+          time.sleep(wait)
+    return done
+
+  def get(self):
+    config = self.get_auth_config()
+    verification = dict(AUTH_CONFIG['verification'])
+    verification.update(config.get('verification', {}))
+    if not verification['queue']:
+      raise AuthError('No verification queue found in settings.')
+
+    queue = taskqueue.Queue(verification['queue'])
+    deadline = time.time() + verification['deadline']
+    sent = 0
+    while time.time() < deadline:
+      tasks = queue.lease_tasks(verification['lease_seconds'],
+                                verification['batch_size'])
+      if not tasks:
+        break
+      done = self.process_batch(config, verification, tasks)
+      if done:
+        queue.delete_tasks(done)
+      sent += len(done)
+    logger.info('%d account verification jobs processed.' % sent)
+  post = get
 
 
 class BaseAccountVerificationHandler(WebAppBaseHandler):
   '''Handler to finish account verification process.'''
   tpl_key = 'verify_account'
+  rate_limits = LOGIN_RATE_LIMITS
+
+  def get_rate_limit_value(self, scope):
+    if scope == 'auth_id':
+      return self.request.get('user_id')
+    return super(BaseAccountVerificationHandler,
+                 self).get_rate_limit_value(scope)
 
   def get(self, signup_token=None):
     user_id = int(self.request.get('user_id'))
@@ -299,6 +431,8 @@ class BaseAccountVerificationHandler(WebAppBaseHandler):
 class BaseLoginHandler(WebAppBaseHandler):
   '''Login Interface.'''
   tpl_key = 'login'
+  rate_limits = LOGIN_RATE_LIMITS
+
   def get(self):
     self_url = self.request.route.build(self.request, self.request.route_args,
         self.request.route_kwargs)
@@ -344,9 +478,7 @@ class BaseMakeSuperHeroHandler(OAuth2Conf):
   users_allowed = ['u']
   def get(self):
     user_model = self.auth.store.user_model
-    qry = user_model.query(user_model.type == 'superhero')
-    superheros = qry.count()
-    if superheros == 0:
+    if not user_model.role_exists('superhero'):
       user_type = self.user.type
       user_type.append('superhero')
       self.user.type = user_type
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import hmac
+import logging
+import struct
+
+from webapp2_extras import security
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['PasswordHasher', 'PBKDF2PasswordHasher', 'Webapp2PasswordHasher',
+           'identify_hasher']
+
+
+def _pbkdf2(digest, password, salt, iterations):
+  '''PBKDF2-HMAC, for runtimes where hashlib.pbkdf2_hmac does not exist.'''
+  mac = hmac.new(password, None, digest)
+
+  def prf(data):
+    h = mac.copy()
+    h.update(data)
+    return h.digest()
+
+  size = mac.digest_size
+  u = prf(salt + struct.pack('>I', 1))
+  result = [ord(c) for c in u]
+  for unused in xrange(iterations - 1):
+    u = prf(u)
+    for index, c in enumerate(u):
+      result[index] ^= ord(c)
+  return ''.join(chr(c) for c in result)[:size]
+
+
+class PasswordHasher(object):
+  '''Base class of password hashers.
+  Encoded passwords start with algorithm, so several hashers can live
+  together while passwords are rehashed.'''
+  algorithm = None
+
+  def encode(self, password):
+    '''Returns the encoded (hashed) password.'''
+    raise NotImplementedError()
+
+  def verify(self, password, encoded):
+    '''Returns if password matches encoded.'''
+    raise NotImplementedError()
+
+  def identify(self, encoded):
+    '''Returns if encoded was produced by this hasher.'''
+    return encoded.split('$', 1)[0] == self.algorithm
+
+  def needs_rehash(self, encoded):
+    '''Returns if encoded was produced with other settings (work factor).'''
+    return False
+
+
+class PBKDF2PasswordHasher(PasswordHasher):
+  '''PBKDF2 hasher. Format: "pbkdf2_sha256$iterations$salt$hash".
+  iterations is the work factor.'''
+  algorithm = 'pbkdf2_sha256'
+  digest = hashlib.sha256
+
+  def __init__(self, iterations=10000, salt_length=12):
+    self.iterations = iterations
+    self.salt_length = salt_length
+
+  def _hash(self, password, salt, iterations):
+    if isinstance(password, unicode):
+      password = password.encode('utf-8')
+    salt = str(salt)
+    pbkdf2_hmac = getattr(hashlib, 'pbkdf2_hmac', None)
+    if pbkdf2_hmac is None:
+      hashed = _pbkdf2(self.digest, password, salt, iterations)
+    else:
+      hashed = pbkdf2_hmac(self.digest().name, password, salt, iterations)
+    return base64.b64encode(hashed)
+
+  def encode(self, password):
+    salt = security.generate_random_string(length=self.salt_length)
+    hashed = self._hash(password, salt, self.iterations)
+    return '%s$%d$%s$%s' % (self.algorithm, self.iterations, salt, hashed)
+
+  def verify(self, password, encoded):
+    try:
+      algorithm, iterations, salt, hashed = encoded.split('$', 3)
+      iterations = int(iterations)
+    except ValueError:
+      return False
+    return security.compare_hashes(
+      self._hash(password, salt, iterations), hashed)
+
+  def needs_rehash(self, encoded):
+    return int(encoded.split('$')[1]) != self.iterations
+
+
+class Webapp2PasswordHasher(PasswordHasher):
+  '''webapp2_extras.security hashes. Format: "hash$method$salt".
+  Older BaseUser passwords were saved this way.'''
+  algorithm = 'webapp2'
+
+  def __init__(self, method='sha1', length=12, pepper=None):
+    self.method = method
+    self.length = length
+    self.pepper = pepper
+
+  def identify(self, encoded):
+    return encoded.count('$') == 2
+
+  def encode(self, password):
+    return security.generate_password_hash(password, method=self.method,
+                                           length=self.length,
+                                           pepper=self.pepper)
+
+  def verify(self, password, encoded):
+    return security.check_password_hash(password, encoded,
+                                         pepper=self.pepper)
+
+  def needs_rehash(self, encoded):
+    return encoded.split('$')[1] != self.method
+
+
+def identify_hasher(encoded, hashers):
+  '''Returns the hasher (from hashers) that encoded a password or None.'''
+  if not encoded:
+    return None
+  for hasher in hashers:
+    if hasher.identify(encoded):
+      return hasher
+  return None
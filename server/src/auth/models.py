@@ -2,14 +2,33 @@
 #-*- coding: utf-8 -*-
 
 import logging
+import time
 from webapp2_extras.appengine.auth.models import User as Webapp2_user
-from webapp2_extras import security
+from webapp2_extras import auth
+
+from google.appengine.ext import ndb
 
 import stones
+from stones import counters
+import hashers
 
 
 logger = logging.getLogger(__name__)
-__all__ = ['BaseUser']
+__all__ = ['BaseUser', 'UserAuthId', 'UserIndexState']
+
+# Max values of an IN filter.
+MAX_IN_VALUES = 30
+
+
+class UserAuthId(stones.Model):
+  '''Points from one auth_id (key id) to its user.'''
+  user = stones.KeyProperty(indexed=False)
+
+
+class UserIndexState(stones.Model):
+  '''Written by rebuild_indexes once UserAuthId entries and role counters
+  hold every user. Key id is the user kind.'''
+  rebuilt = stones.DateTimeProperty(auto_now_add=True)
 
 
 class BaseUser(Webapp2_user, stones.Expando):
@@ -24,6 +43,21 @@ class BaseUser(Webapp2_user, stones.Expando):
   password = stones.StringProperty()
   type = stones.StringProperty(repeated=True)
 
+  # UserAuthId entries are maintained from these.
+  _tracked_properties = ('auth_ids',)
+  # Users are counted by role (type). See stones.counters.
+  _counter_shards = 20
+  _counted_properties = ('type',)
+  # Kinds whose indexes are rebuilt, seen by this instance.
+  _rebuilt_kinds = set()
+
+  # First hasher encodes new passwords. The others only verify passwords
+  # saved before; those are rehashed with the first one on login.
+  password_hashers = [
+    hashers.PBKDF2PasswordHasher(iterations=10000),
+    hashers.Webapp2PasswordHasher(),
+  ]
+
   @classmethod
   def get_user_types(cls):
     return [
@@ -47,8 +81,33 @@ class BaseUser(Webapp2_user, stones.Expando):
 
   def set_password(self, password):
     '''Sets user password.'''
-    hashed = security.generate_password_hash(password, length=12)
-    self.password = hashed
+    self.password = self.password_hashers[0].encode(password)
+
+  def check_password(self, password):
+    '''Returns if password is the user password. If the stored hash was made
+    by other hasher or work factor, password is rehashed and saved.'''
+    started = time.time()
+    hasher = hashers.identify_hasher(self.password, self.password_hashers)
+    if hasher is None or not hasher.verify(password, self.password):
+      return False
+    logger.debug('Password verified by %s in %.1f ms.'
+                 % (hasher.algorithm, (time.time() - started) * 1000))
+
+    preferred = self.password_hashers[0]
+    if not hasher is preferred or hasher.needs_rehash(self.password):
+      self.set_password(password)
+      self.put_async()
+    return True
+
+  @classmethod
+  def get_by_auth_password(cls, auth_id, password):
+    '''Returns user by auth_id checking password. Used by webapp2 auth.'''
+    user = cls.get_by_auth_id(auth_id)
+    if not user:
+      raise auth.InvalidAuthIdError()
+    if not user.check_password(password):
+      raise auth.InvalidPasswordError()
+    return user
 
   def to_dict(self):
     rv = super(BaseUser, self).to_dict()
@@ -65,4 +124,110 @@ class BaseUser(Webapp2_user, stones.Expando):
       _uniques += list(unique_properties)
     return super(BaseUser, cls).create_user(auth_id, _uniques, **user_values)
 
+  @classmethod
+  def get_by_auth_id(cls, auth_id):
+    '''Returns a user by auth_id through UserAuthId index.'''
+    return cls.get_by_auth_ids([auth_id])[0]
+
+  @classmethod
+  def get_by_auth_ids(cls, auth_ids):
+    '''Returns users for many auth_ids at once, in the same order. None is
+    returned for auth_ids without user.'''
+    auth_ids = list(auth_ids)
+    indexes = ndb.get_multi([ndb.Key(UserAuthId, a) for a in auth_ids])
+    user_keys = [index.user for index in indexes if not index is None]
+    users = dict((user.key, user) for user in ndb.get_multi(user_keys)
+                 if not user is None)
+
+    rv = []
+    missing = []
+    for auth_id, index in zip(auth_ids, indexes):
+      user = None
+      if not index is None:
+        user = users.get(index.user, None)
+      if user is None:
+        missing.append(auth_id)
+      rv.append(user)
 
+    if missing and not cls.indexes_rebuilt():
+      # Users saved before the index existed.
+      found = {}
+      for start in xrange(0, len(missing), MAX_IN_VALUES):
+        chunk = missing[start:start + MAX_IN_VALUES]
+        for user in cls.query(cls.auth_ids.IN(chunk)).fetch():
+          for auth_id in user.auth_ids:
+            found[auth_id] = user
+      rv = [user or found.get(auth_id, None)
+            for auth_id, user in zip(auth_ids, rv)]
+    return rv
+
+  @classmethod
+  def indexes_rebuilt(cls):
+    '''Returns if rebuild_indexes ran, so UserAuthId entries and role
+    counters hold every user.'''
+    kind = cls._get_kind()
+    if kind in cls._rebuilt_kinds:
+      return True
+    if UserIndexState.get_by_id(kind) is None:
+      return False
+    cls._rebuilt_kinds.add(kind)
+    return True
+
+  @classmethod
+  def count_by_role(cls, role):
+    '''Returns how many users belong to role. Before rebuild_indexes, users
+    are counted by query.'''
+    if not cls.indexes_rebuilt():
+      return cls.query(cls.type == role).count()
+    return counters.count(cls, 'type', role)
+
+  @classmethod
+  def role_exists(cls, role):
+    '''Returns if there is any user in role.'''
+    if not cls.indexes_rebuilt():
+      return not cls.query(cls.type == role).get(keys_only=True) is None
+    return counters.count(cls, 'type', role) > 0
+
+  @classmethod
+  def _update_auth_ids(cls, key, old_auth_ids, new_auth_ids):
+    '''Updates UserAuthId entries.'''
+    stale = set(old_auth_ids) - set(new_auth_ids)
+    new = set(new_auth_ids) - set(old_auth_ids)
+    if stale:
+      ndb.delete_multi([ndb.Key(UserAuthId, a) for a in stale])
+    if new:
+      ndb.put_multi([UserAuthId(id=a, user=key) for a in new])
+
+  def _post_put_hook(self, future):
+    super(BaseUser, self)._post_put_hook(future)
+    if not future.get_exception() is None:
+      return
+    self._update_auth_ids(future.get_result(),
+                          self._get_snapshot('auth_ids', []), self.auth_ids)
+    self._take_snapshot()
+
+  @classmethod
+  def _pre_delete_hook(cls, key):
+    super(BaseUser, cls)._pre_delete_hook(key)
+    cls._keep_for_post_hook(key, 'user', key.get())
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    super(BaseUser, cls)._post_delete_hook(key, future)
+    user = cls._take_from_pre_hook(key, 'user')
+    if user is None or not future.get_exception() is None:
+      return
+    cls._update_auth_ids(key, user.auth_ids, [])
+
+  @classmethod
+  def rebuild_indexes(cls):
+    '''Builds UserAuthId entries and role counters from existing users. Run
+    it once for data saved before these indexes existed; until then, users
+    are also looked up and counted by query.'''
+    auth_ids = []
+    for user in cls.query():
+      auth_ids += [UserAuthId(id=a, user=user.key) for a in user.auth_ids]
+    ndb.put_multi(auth_ids)
+    counters.rebuild_counts(cls)
+    UserIndexState(id=cls._get_kind()).put()
+    cls._rebuilt_kinds.add(cls._get_kind())
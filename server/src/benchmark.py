@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Tools to measure stones hot paths against appengine local stubs.
+
+The benchmark suite can be run from the app root, with appengine SDK in the
+path:
+  python -m stones.benchmark --output results.json --baseline baseline.json
+
+Results are JSON. When a baseline (results of a previous run) is given,
+cases whose p50 got slower than --tolerance are reported and exit status
+is 1.'''
+
+import argparse
+import contextlib
+import datetime
+import logging
+import platform
+import sys
+import time
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+import webapp2
+
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+
+import dates
+import handlers
+import model
+from model_handler_mixin import ModelHandlerMixin
+from utils import JSONEncoder
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['percentile', 'summarize', 'measure', 'stubs', 'session_overhead',
+           'case', 'run_suite', 'compare']
+
+
+def percentile(samples, p):
+  '''Returns the p (0-100) percentile of samples (nearest rank).'''
+  if not samples:
+    return 0.0
+  ordered = sorted(samples)
+  index = int(round(p / 100.0 * (len(ordered) - 1)))
+  return ordered[index]
+
+
+def summarize(samples):
+  '''Returns a dict with stats of samples (seconds) in milliseconds.'''
+  ms = [s * 1000.0 for s in samples]
+  if not ms:
+    return {'n': 0}
+  return {
+    'n': len(ms),
+    'mean': sum(ms) / len(ms),
+    'min': min(ms),
+    'max': max(ms),
+    'p50': percentile(ms, 50),
+    'p90': percentile(ms, 90),
+    'p99': percentile(ms, 99),
+  }
+
+
+def measure(func, rounds=100, warmup=5, *args, **kwargs):
+  '''Calls func rounds times and returns summarize() of its timings.'''
+  for unused in xrange(warmup):
+    func(*args, **kwargs)
+  samples = []
+  for unused in xrange(rounds):
+    started = time.time()
+    func(*args, **kwargs)
+    samples.append(time.time() - started)
+  return summarize(samples)
+
+
+@contextlib.contextmanager
+def stubs(**kwargs):
+  '''Activates datastore, memcache, taskqueue and search stubs, like
+  utils.BaseTestCase does. kwargs are passed to init_taskqueue_stub.'''
+  bed = testbed.Testbed()
+  bed.activate()
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+  bed.init_datastore_v3_stub(consistency_policy=policy)
+  bed.init_memcache_stub()
+  bed.init_user_stub()
+  bed.init_mail_stub()
+  bed.init_taskqueue_stub(**kwargs)
+  bed.init_search_stub()
+  try:
+    yield bed
+  finally:
+    bed.deactivate()
+
+
+def _session_app(backend):
+  '''Returns an app whose handler reads (default), writes (?w=1) or
+  ignores (?n=1) the session.'''
+  class SessionHandler(handlers.BaseHandler):
+    session_backend = backend
+
+    def get(self):
+      if self.request.get('n'):
+        pass
+      elif self.request.get('w'):
+        self.session['counter'] = self.session.get('counter', 0) + 1
+        self.session['payload'] = 'x' * int(self.request.get('size', 10))
+      else:
+        self.session.get('counter')
+      self.response.write('ok')
+
+  config = {'webapp2_extras.sessions': {'secret_key': 'benchmark'}}
+  return webapp2.WSGIApplication([('/', SessionHandler)], config=config)
+
+
+def session_overhead(backends=('securecookie', 'memcache', 'hybrid'),
+                     rounds=200, size=10):
+  '''Returns per request timings of BaseHandler with each session backend:
+  {backend: {'none': stats, 'read': stats, 'write': stats}}. size is the
+  length of the payload stored in session.'''
+  results = {}
+  with stubs():
+    for backend in backends:
+      app = _session_app(backend)
+      response = webapp2.Request.blank('/?w=1&size=%d' % size).get_response(
+        app)
+      cookie = response.headers.get('Set-Cookie', '').split(';')[0]
+
+      def request(path):
+        webapp2.Request.blank(path, headers={'Cookie': cookie}).get_response(
+          app)
+
+      results[backend] = {
+        'none': measure(request, rounds, 5, '/?n=1'),
+        'read': measure(request, rounds, 5, '/'),
+        'write': measure(request, rounds, 5, '/?w=1&size=%d' % size),
+      }
+  return results
+
+
+# Benchmark suite.
+
+_cases = []
+
+
+def case(rounds=100, warmup=5):
+  '''Decorator to add a case to the suite. The decorated function makes the
+  case setup (stubs are active) and returns the function to be measured.'''
+  def decorator(func):
+    _cases.append((func.__name__, func, rounds, warmup))
+    return func
+  return decorator
+
+
+class BenchAuthor(model.Model):
+  display = model.StringProperty()
+
+
+class BenchPart(model.Model):
+  name = model.StringProperty()
+  value = model.IntegerProperty()
+  when = model.DateTimeProperty()
+
+
+def _wide_properties():
+  props = {}
+  for index in range(20):
+    props['s%d' % index] = model.StringProperty()
+  for index in range(10):
+    props['i%d' % index] = model.IntegerProperty()
+    props['f%d' % index] = model.FloatProperty()
+  for index in range(5):
+    props['b%d' % index] = model.BooleanProperty()
+    props['d%d' % index] = model.DateTimeProperty()
+  return props
+
+BenchWide = type('BenchWide', (model.Model,), _wide_properties())
+
+
+class BenchDocument(model.Model):
+  title = model.StringProperty()
+  author = model.ReferenceProperty(BenchAuthor, is_child=False)
+  tags = model.ReferenceProperty(BenchAuthor, is_child=False, repeated=True)
+  parts = model.StructuredProperty(BenchPart, repeated=True)
+
+
+def _wide_dict(seed=0):
+  rv = {}
+  for index in range(20):
+    rv['s%d' % index] = u'value %d %d' % (seed, index)
+  for index in range(10):
+    rv['i%d' % index] = str(seed + index)
+    rv['f%d' % index] = seed + index / 3.0
+  for index in range(5):
+    rv['b%d' % index] = 'false' if index % 2 else 'true'
+    rv['d%d' % index] = '2013-06-%02dT10:20:30Z' % (index + 1)
+  return rv
+
+
+def _authors(count):
+  authors = [BenchAuthor(display=u'Author %d' % i) for i in range(count)]
+  model.ndb.put_multi(authors)
+  return authors
+
+
+def _document_dict(authors, with_display=True):
+  def ref(author):
+    rv = {'urlsafe_key': author.key.urlsafe()}
+    if with_display:
+      rv['display'] = author.display
+    return rv
+
+  return {
+    'title': u'Document',
+    'author': ref(authors[0]),
+    'tags': [ref(author) for author in authors[1:]],
+    'parts': [{'name': u'part %d' % i, 'value': i,
+               'when': '2013-06-01T10:20:30Z'} for i in range(20)],
+  }
+
+
+@case()
+def from_dict_wide():
+  value = _wide_dict()
+  return lambda: BenchWide.from_dict(value)
+
+
+@case()
+def populate_from_dict_wide():
+  value = _wide_dict()
+  entity = BenchWide()
+  return lambda: entity._populate_from_dict(value)
+
+
+@case()
+def from_dict_nested():
+  value = _document_dict(_authors(10))
+  return lambda: BenchDocument.from_dict(value)
+
+
+_TIMESTAMPS = ['2013-06-%02dT10:%02d:%02dZ' % (i % 28 + 1, i / 60 % 60, i % 60)
+               for i in range(1000)]
+
+
+@case(rounds=20)
+def parse_datetime_strptime():
+  return lambda: [datetime.datetime.strptime(v, model.DATETIME_FORMAT)
+                  for v in _TIMESTAMPS]
+
+
+@case(rounds=20)
+def parse_datetime_codec():
+  # The 1000 timestamps fit in the parse cache: this measures the parser.
+  parse = dates.parse_datetime.uncached
+  return lambda: [parse(v) for v in _TIMESTAMPS]
+
+
+@case(rounds=20)
+def parse_datetime_codec_cached():
+  return lambda: [dates.parse_datetime(v) for v in _TIMESTAMPS]
+
+
+@case(rounds=20)
+def format_datetime_strftime():
+  values = [dates.parse_datetime(v) for v in _TIMESTAMPS]
+  return lambda: [v.strftime(model.DATETIME_FORMAT) for v in values]
+
+
+@case(rounds=20)
+def format_datetime_codec():
+  values = [dates.parse_datetime(v) for v in _TIMESTAMPS]
+  return lambda: [dates.format_datetime(v) for v in values]
+
+
+class BenchSeries(model.Model):
+  values = model.FloatProperty(repeated=True)
+  counts = model.IntegerProperty(repeated=True)
+  times = model.DateTimeProperty(repeated=True)
+
+
+@case(rounds=20)
+def from_dict_repeated_series():
+  value = {
+    'values': [str(i / 7.0) for i in range(5000)],
+    'counts': [str(i) for i in range(5000)],
+    'times': ['2013-06-01T10:%02d:%02dZ' % (i / 60 % 60, i % 60)
+              for i in range(5000)],
+  }
+  return lambda: BenchSeries.from_dict(value)
+
+
+@case(rounds=50)
+def reference_resolution():
+  '''References without display are resolved from the datastore.'''
+  value = _document_dict(_authors(10), with_display=False)
+  return lambda: BenchDocument.from_dict(value)
+
+
+@case(rounds=50)
+def reference_get():
+  document = BenchDocument.from_dict(_document_dict(_authors(2)))
+  document.put()
+  prop = BenchDocument.author
+  return lambda: prop._get_reference(document)
+
+
+@case(rounds=5, warmup=1)
+def json_encoder_10k():
+  entities = []
+  for index in range(10000):
+    entity = BenchPart(name=u'part %d' % index, value=index,
+                       when=datetime.datetime(2013, 6, 1, 10, 20, 30))
+    entity.key = model.Key(BenchPart, index + 1)
+    entities.append(entity)
+  return lambda: json.dumps(entities, cls=JSONEncoder)
+
+
+class BenchWideHandler(handlers.BaseHandler, ModelHandlerMixin):
+  model = BenchWide
+
+
+class BenchPlainHandler(handlers.BaseHandler):
+  def get(self):
+    self.response.write('ok')
+
+
+def _app():
+  config = {'webapp2_extras.sessions': {'secret_key': 'benchmark'}}
+  return webapp2.WSGIApplication([
+    webapp2.Route('/plain', BenchPlainHandler),
+    webapp2.Route('/wide', BenchWideHandler),
+    webapp2.Route('/wide/<key>', BenchWideHandler),
+  ], config=config)
+
+
+def _call(app, path, method='GET', body=None):
+  request = webapp2.Request.blank(path)
+  request.method = method
+  if not body is None:
+    request.body = json.dumps(body)
+    request.content_type = 'application/json'
+  response = request.get_response(app)
+  if response.status_int >= 400:
+    raise AssertionError('%s %s: %s' % (method, path, response.status))
+  return response
+
+
+def _wide_entities(count):
+  entities = [BenchWide.from_dict(_wide_dict(i)) for i in range(count)]
+  model.ndb.put_multi(entities)
+  return entities
+
+
+@case()
+def dispatch_overhead():
+  app = _app()
+  return lambda: _call(app, '/plain')
+
+
+@case(rounds=50)
+def handler_get_list():
+  app = _app()
+  _wide_entities(100)
+  return lambda: _call(app, '/wide')
+
+
+@case()
+def handler_get_key():
+  app = _app()
+  key = _wide_entities(1)[0].key.urlsafe()
+  return lambda: _call(app, '/wide/%s' % key)
+
+
+@case()
+def handler_post():
+  app = _app()
+  value = _wide_dict()
+  return lambda: _call(app, '/wide', 'POST', value)
+
+
+@case()
+def handler_put():
+  app = _app()
+  key = _wide_entities(1)[0].key.urlsafe()
+  value = _wide_dict(1)
+  return lambda: _call(app, '/wide/%s' % key, 'PUT', value)
+
+
+@case()
+def handler_delete():
+  app = _app()
+  keys = iter([e.key.urlsafe() for e in _wide_entities(200)])
+  return lambda: _call(app, '/wide/%s' % keys.next(), 'DELETE')
+
+
+def run_suite(names=None):
+  '''Runs the cases of the suite (or those in names). Returns a dict ready
+  to be dumped as JSON.'''
+  results = {}
+  for name, setup, rounds, warmup in _cases:
+    if names and not name in names:
+      continue
+    with stubs():
+      func = setup()
+      results[name] = measure(func, rounds, warmup)
+  return {
+    'created': datetime.datetime.utcnow().strftime(model.DATETIME_FORMAT),
+    'python': platform.python_version(),
+    'cases': results,
+  }
+
+
+def compare(results, baseline, tolerance=0.2, stat='p50'):
+  '''Compares results with baseline (both as returned by run_suite).
+  Returns a list of (case, baseline ms, current ms, ratio, regressed).'''
+  rv = []
+  for name, stats in sorted(results['cases'].iteritems()):
+    base = baseline.get('cases', {}).get(name, None)
+    if not base or not base.get(stat):
+      continue
+    ratio = stats[stat] / base[stat]
+    rv.append((name, base[stat], stats[stat], ratio, ratio > 1 + tolerance))
+  return rv
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Stones benchmark suite.')
+  parser.add_argument('cases', nargs='*', help='Cases to run. Default all.')
+  parser.add_argument('--output', help='File to write JSON results.')
+  parser.add_argument('--baseline', help='JSON results to compare with.')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='Allowed slowdown ratio. Default 0.2 (20%%).')
+  args = parser.parse_args(argv[1:])
+
+  results = run_suite(args.cases)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2, sort_keys=True)
+
+  print '%-28s %10s %10s %10s' % ('case', 'p50 ms', 'p99 ms', 'mean ms')
+  for name, stats in sorted(results['cases'].iteritems()):
+    print '%-28s %10.3f %10.3f %10.3f' % (name, stats['p50'], stats['p99'],
+                                          stats['mean'])
+
+  if not args.baseline:
+    return 0
+  with open(args.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+  regressions = 0
+  print
+  print '%-28s %10s %10s %8s' % ('case', 'base ms', 'now ms', 'ratio')
+  for name, base, now, ratio, regressed in compare(results, baseline,
+                                                   args.tolerance):
+    regressions += int(regressed)
+    print '%-28s %10.3f %10.3f %8.2f%s' % (name, base, now, ratio,
+                                           ' REGRESSION' if regressed else '')
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
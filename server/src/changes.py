@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Change feed: entities upserted or deleted since a sync token.
+
+A model opts in setting _change_log; Model put and delete hooks then keep a
+ChangeLogEntry by entity (the last change only) which needs this index:
+
+  - kind: ChangeLogEntry
+    properties:
+    - name: kind
+    - name: changed
+
+Models without _change_log but with an auto_now "updated" property (like
+BaseUser) are synced by that property; their deletions are not reported.
+
+Tokens are opaque to clients: the first sync starts with token "0" and
+every response gives the token of the next one. Results come by pages;
+"more" is True while there are pages left. Changes made less than OVERLAP
+seconds before a sync are sent again by the next one, so changes committed
+late (or read late, since queries are eventually consistent) are not lost.'''
+
+import base64
+import datetime
+import logging
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+import model
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['ChangeLogEntry', 'InvalidTokenError', 'ExpiredTokenError',
+           'log_change', 'changes_since', 'purge_tombstones']
+
+# Changes by page.
+PAGE_SIZE = 100
+# Seconds of changes sent again by the next sync.
+OVERLAP = 10
+# Days deletions are kept. Older tokens must sync again from "0".
+TOMBSTONE_DAYS = 30
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class InvalidTokenError(ValueError):
+  '''Token was not given by changes_since.'''
+
+
+class ExpiredTokenError(ValueError):
+  '''Token older than the deletions kept.'''
+
+
+class ChangeLogEntry(model.Model):
+  '''Last change of an entity. Stored in the namespace of the entity, key
+  id is its urlsafe key.'''
+  kind = model.StringProperty()
+  key_changed = model.KeyProperty(indexed=False)
+  deleted = model.BooleanProperty(default=False, indexed=False)
+  changed = model.DateTimeProperty(auto_now=True)
+
+
+def log_change(key, deleted=False):
+  '''Writes (asynchronously) the change of the entity of key when the
+  current transaction commits (now, if there is none).'''
+  entry = ChangeLogEntry(id=key.urlsafe(), namespace=key.namespace(),
+                         kind=key.kind(), key_changed=key, deleted=deleted)
+  ndb.get_context().call_on_commit(entry.put_async)
+
+
+def _micros(value):
+  delta = value - EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _datetime(micros):
+  return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def encode_token(since, cursor=None):
+  values = {'t': _micros(since)}
+  if cursor:
+    values['c'] = cursor.urlsafe()
+  return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')))
+
+
+def decode_token(token):
+  '''Returns (since, cursor) of token.'''
+  if token in (None, '', '0'):
+    return EPOCH, None
+  try:
+    values = json.loads(base64.urlsafe_b64decode(str(token)))
+    since = _datetime(int(values['t']))
+    cursor = Cursor(urlsafe=values['c']) if 'c' in values else None
+  except Exception, e:
+    raise InvalidTokenError('Invalid sync token: %s' % e)
+  return since, cursor
+
+
+def _query(modelclass, since):
+  '''Returns the query of changes after since, oldest first.'''
+  if modelclass._change_log:
+    return ChangeLogEntry.query(
+      ChangeLogEntry.kind == modelclass._get_kind(),
+      ChangeLogEntry.changed > since).order(ChangeLogEntry.changed)
+  updated = modelclass._properties.get('updated', None)
+  if not isinstance(updated, ndb.DateTimeProperty) or \
+      not updated._auto_now:
+    raise ValueError('%s entities have no change log nor auto_now updated '
+                     'property.' % modelclass.__name__)
+  return modelclass.query(updated > since).order(updated)
+
+
+def changes_since(modelclass, token=None, page_size=PAGE_SIZE):
+  '''Returns a dict with the changes to entities of modelclass since token:
+
+    changed: entities upserted.
+    deleted: urlsafe keys of entities deleted.
+    since: token of the next sync.
+    more: True if there are more changes to read now.
+
+  Raises InvalidTokenError or ExpiredTokenError.'''
+  since, cursor = decode_token(token)
+  now = datetime.datetime.now()
+  if modelclass._change_log and since != EPOCH and \
+      since < now - datetime.timedelta(days=TOMBSTONE_DAYS):
+    raise ExpiredTokenError('Sync token older than %d days.'
+                            % TOMBSTONE_DAYS)
+
+  results, next_cursor, more = _query(modelclass, since).fetch_page(
+    page_size, start_cursor=cursor)
+
+  changed = []
+  deleted = []
+  if modelclass._change_log:
+    upserts = [e.key_changed for e in results if not e.deleted]
+    entities = dict(zip(upserts, ndb.get_multi(upserts)))
+    for entry in results:
+      entity = entities.get(entry.key_changed, None)
+      if entity is None:
+        deleted.append(entry.key_changed.urlsafe())
+      else:
+        changed.append(entity)
+  else:
+    changed = results
+
+  more = bool(more and next_cursor)
+  if more:
+    next_token = encode_token(since, next_cursor)
+  else:
+    # Changes of the last OVERLAP seconds are read again.
+    next_token = encode_token(
+      max(since, now - datetime.timedelta(seconds=OVERLAP)))
+  return {
+    'changed': changed,
+    'deleted': deleted,
+    'since': next_token,
+    'more': more,
+  }
+
+
+def purge_tombstones(days=TOMBSTONE_DAYS, batch_size=500):
+  '''Deletes the change log entries of entities deleted more than days ago,
+  in the current namespace. Returns how many.'''
+  before = datetime.datetime.now() - datetime.timedelta(days=days)
+  count = 0
+  keys = []
+  for entry in ChangeLogEntry.query(ChangeLogEntry.changed < before).iter(
+      batch_size=batch_size):
+    if entry.deleted:
+      keys.append(entry.key)
+    if len(keys) >= batch_size:
+      ndb.delete_multi(keys)
+      count += len(keys)
+      keys = []
+  if keys:
+    ndb.delete_multi(keys)
+    count += len(keys)
+  return count
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Sharded counters of entities by kind and by property value.
+
+A model opts in setting _counter_shards; its entities are counted by Model
+put and delete hooks, and also by value of the properties named in
+_counted_properties:
+
+  class Book(stones.Model):
+    _counter_shards = 10
+    _counted_properties = ('genre',)
+    genre = stones.StringProperty()
+
+  count(Book)                    # all books
+  count(Book, 'genre', u'poetry') # books with genre poetry
+
+Each change increments a random shard in its own transaction, after the
+transaction of the put commits, if any. Totals are cached in memcache for
+CACHE_SECONDS, so they may be a bit behind.
+
+To discount the values it overwrites, the put of an entity built with a
+complete key (not loaded) reads the stored entity first: one more datastore
+round trip by put. Keys allocated by Model._prepare_references skip it, and
+so do entities given their stored version with Model._set_stored, like the
+rows of imports and write-behind creations, read with one get_multi by
+batch.'''
+
+import logging
+import random
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache, namespace_manager
+
+import model
+import scan
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['CounterShard', 'counter_name', 'update_counts', 'count',
+           'rebuild_counts']
+
+# Seconds totals are kept in memcache.
+CACHE_SECONDS = 60
+MEMCACHE_NAMESPACE = 'stones.counters'
+# Retries of shard transactions.
+RETRIES = 5
+
+
+class CounterShard(model.Model):
+  '''A shard of a counter. Stored in the namespace of the counted entities,
+  key id is "<counter name>|<shard index>".'''
+  count = model.IntegerProperty(default=0, indexed=False)
+
+
+def _value_name(value):
+  if isinstance(value, ndb.Key):
+    return value.urlsafe()
+  if isinstance(value, str):
+    return value.decode('utf-8')
+  return unicode(value)
+
+
+def counter_name(kind, prop_name=None, value=None):
+  '''Returns the name of the counter of kind or, if prop_name is given, of
+  entities of kind whose property prop_name (datastore name) has value.'''
+  if prop_name is None:
+    return kind
+  return u'%s:%s=%s' % (kind, prop_name, _value_name(value))
+
+
+def _shard_keys(name, shards, namespace):
+  return [ndb.Key(CounterShard, u'%s|%d' % (name, index),
+                  namespace=namespace)
+          for index in xrange(shards)]
+
+
+def _cache_key(name, namespace):
+  return (u'%s|%s' % (namespace or '', name)).encode('utf-8')
+
+
+@ndb.tasklet
+def _increment_async(name, delta, shards, namespace):
+  key = _shard_keys(name, shards, namespace)[random.randint(0, shards - 1)]
+
+  def txn():
+    shard = key.get()
+    if shard is None:
+      shard = CounterShard(key=key)
+    shard.count += delta
+    shard.put()
+
+  yield ndb.transaction_async(txn, retries=RETRIES)
+
+
+def update_counts(key, added, removed, shards):
+  '''Adds one to the counters named in added and takes one from those in
+  removed, when the current transaction commits (now, if there is none).
+
+  Args:
+    key: key of the counted entity.
+    added: set of counter names.
+    removed: set of counter names.
+    shards: shards of the counters.'''
+  deltas = dict([(name, 1) for name in added] +
+                [(name, -1) for name in removed])
+  if not deltas:
+    return
+  namespace = key.namespace()
+
+  def apply():
+    for name, delta in deltas.iteritems():
+      _increment_async(name, delta, shards, namespace)
+    try:
+      memcache.offset_multi(dict((_cache_key(name, namespace), delta)
+                                 for name, delta in deltas.iteritems()),
+                            namespace=MEMCACHE_NAMESPACE)
+    except Exception, e:
+      logger.warning('Cached counts not updated: %s' % e)
+
+  ndb.get_context().call_on_commit(apply)
+
+
+def count(modelclass, prop_name=None, value=None, namespace=None):
+  '''Returns the number of entities of modelclass or, if prop_name (one of
+  its _counted_properties) is given, of those whose property has value.
+  Shards are summed once every CACHE_SECONDS.'''
+  shards = modelclass._counter_shards
+  if not shards:
+    raise ValueError('%s entities are not counted.' % modelclass.__name__)
+  if not prop_name is None:
+    if not prop_name in modelclass._counted_properties:
+      raise ValueError('%s entities are not counted by %s.'
+                       % (modelclass.__name__, prop_name))
+    prop_name = model.get_prop(prop_name, modelclass._properties)._name
+  if namespace is None:
+    namespace = namespace_manager.get_namespace()
+  name = counter_name(modelclass._get_kind(), prop_name, value)
+  cache_key = _cache_key(name, namespace)
+  total = memcache.get(cache_key, namespace=MEMCACHE_NAMESPACE)
+  if total is None:
+    total = sum(shard.count
+                for shard in ndb.get_multi(_shard_keys(name, shards,
+                                                       namespace))
+                if not shard is None)
+    total = max(total, 0)
+    memcache.add(cache_key, total, time=CACHE_SECONDS,
+                 namespace=MEMCACHE_NAMESPACE)
+  return total
+
+
+def rebuild_counts(modelclass, namespace=None):
+  '''Counts again every entity of modelclass and rewrites its counters.
+  Run it once for data saved before the model was counted. Entities saved
+  meanwhile may be miscounted.'''
+  shards = modelclass._counter_shards
+  if namespace is None:
+    namespace = namespace_manager.get_namespace()
+  query = modelclass.query(namespace=namespace)
+
+  def count_page(entities):
+    totals = {}
+    for entity in entities:
+      for name in entity._count_state():
+        totals[name] = totals.get(name, 0) + 1
+    return totals
+
+  totals = {}
+  for partial in scan.parallel_map(query, count_page):
+    for name, total in partial.iteritems():
+      totals[name] = totals.get(name, 0) + total
+
+  # Counters of values no longer held are left as they are.
+  entities = []
+  for name, total in totals.iteritems():
+    keys = _shard_keys(name, shards, namespace)
+    entities.append(CounterShard(key=keys[0], count=total))
+    entities += [CounterShard(key=k, count=0) for k in keys[1:]]
+  ndb.put_multi(entities)
+  memcache.delete_multi([_cache_key(name, namespace) for name in totals],
+                        namespace=MEMCACHE_NAMESPACE)
+  return totals
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Codec of dates, datetimes and times in the wire (JSON) format.
+
+Strings are parsed by slicing and built by string formatting, which is
+faster than strptime/strftime, does not depend on locale and works with
+years before 1900. Values not matching the format go through strptime, so
+errors are the same as before.'''
+
+import datetime
+
+__all__ = ['DATETIME_FORMAT', 'DATE_FORMAT', 'TIME_FORMAT', 'parse_datetime',
+           'parse_date', 'parse_time', 'format_datetime', 'format_date',
+           'format_time']
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+DATE_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%H:%M:%S'
+
+# Max parsed strings kept in cache by each parser. Repeated timestamps are
+# common in series and lists.
+PARSE_CACHE_SIZE = 1024
+
+
+_DIGITS = frozenset('0123456789')
+
+
+def _ints(value, *spans):
+  '''Returns the ints of the fields of value at spans (start, end), or None
+  if a field is not only ASCII digits, like strptime requires.'''
+  rv = []
+  for start, end in spans:
+    field = value[start:end]
+    if not _DIGITS.issuperset(field):
+      return None
+    rv.append(int(field))
+  return rv
+
+
+def _cached(parser):
+  cache = {}
+
+  def parse(value):
+    rv = cache.get(value, None)
+    if rv is None:
+      rv = parser(value)
+      if len(cache) >= PARSE_CACHE_SIZE:
+        cache.clear()
+      cache[value] = rv
+    return rv
+  parse.__name__ = parser.__name__
+  parse.__doc__ = parser.__doc__
+  parse.uncached = parser
+  return parse
+
+
+@_cached
+def parse_datetime(value):
+  '''Returns a datetime from a DATETIME_FORMAT string.'''
+  if len(value) == 20 and value[4] == value[7] == '-' and \
+      value[10] == 'T' and value[13] == value[16] == ':' and value[19] == 'Z':
+    fields = _ints(value, (0, 4), (5, 7), (8, 10), (11, 13), (14, 16),
+                   (17, 19))
+    if not fields is None:
+      try:
+        return datetime.datetime(*fields)
+      except ValueError:
+        pass
+  return datetime.datetime.strptime(value, DATETIME_FORMAT)
+
+
+@_cached
+def parse_date(value):
+  '''Returns a date from a DATE_FORMAT string.'''
+  if len(value) == 10 and value[4] == value[7] == '-':
+    fields = _ints(value, (0, 4), (5, 7), (8, 10))
+    if not fields is None:
+      try:
+        return datetime.date(*fields)
+      except ValueError:
+        pass
+  return datetime.datetime.strptime(value, DATE_FORMAT).date()
+
+
+@_cached
+def parse_time(value):
+  '''Returns a time from a TIME_FORMAT string.'''
+  if len(value) == 8 and value[2] == value[5] == ':':
+    fields = _ints(value, (0, 2), (3, 5), (6, 8))
+    if not fields is None:
+      try:
+        return datetime.time(*fields)
+      except ValueError:
+        pass
+  return datetime.datetime.strptime(value, TIME_FORMAT).time()
+
+
+def format_datetime(value):
+  '''Returns value (a datetime) in DATETIME_FORMAT.'''
+  return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (value.year, value.month,
+                                             value.day, value.hour,
+                                             value.minute, value.second)
+
+
+def format_date(value):
+  '''Returns value (a date) in DATE_FORMAT.'''
+  return '%04d-%02d-%02d' % (value.year, value.month, value.day)
+
+
+def format_time(value):
+  '''Returns value (a time) in TIME_FORMAT.'''
+  return '%02d:%02d:%02d' % (value.hour, value.minute, value.second)
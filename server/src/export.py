@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Streaming export of query results as CSV or newline delimited JSON.
+
+Queries are walked in batches with cursors, so memory use does not depend on
+the number of results and an export can be resumed from the cursor where it
+stopped. Large exports run as a chain of tasks appending to a blob. Queries
+without sort orders can also be read from key ranges in parallel (see
+stones.scan), but those exports cannot be resumed.'''
+
+import csv
+import cStringIO
+import logging
+import time
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+import webapp2
+from google.appengine.ext import ndb
+from google.appengine.api import files, namespace_manager, taskqueue
+from google.appengine.datastore import datastore_query
+
+import model
+import scan
+from utils import JSONEncoder
+from query_stats import orders_shape
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['FORMATS', 'CSVWriter', 'NDJSONWriter', 'get_writer',
+           'QueryExport', 'ScanExport', 'ExportJob', 'start_export', 'run_export_chunk',
+           'TASK_ROUTE']
+
+# Entities fetched by batch.
+BATCH_SIZE = 500
+# Seconds an export task works before enqueueing the next chunk.
+CHUNK_SECONDS = 240
+# Name of the route to ExportTaskHandler.
+TASK_ROUTE = 'stones.export.task'
+# Queue of export tasks.
+QUEUE = 'default'
+
+
+class CSVWriter(object):
+  '''Writes entities as CSV rows, UTF-8 encoded. First column is the
+  urlsafe key, the others are the properties given by code name (all
+  model properties, sorted by name, by default). Cells are built with
+  property _get_for_csv.'''
+  content_type = 'text/csv; charset=utf-8'
+  extension = 'csv'
+
+  def __init__(self, modelclass, properties=None):
+    props = dict((p._code_name, p)
+                 for p in modelclass._properties.itervalues())
+    self.columns = list(properties or sorted(props.keys()))
+    self._props = [props.get(name, None) for name in self.columns]
+
+  def _encode(self, rows):
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+      writer.writerow([(cell or u'').encode('utf-8')
+                       if isinstance(cell, unicode) else (cell or '')
+                       for cell in row])
+    return buf.getvalue()
+
+  def header(self):
+    return self._encode([['$$key$$'] + self.columns])
+
+  def _cell(self, entity, name, prop):
+    if prop is None:
+      # Dynamic property of an Expando.
+      prop = entity._properties.get(name, None)
+      if prop is None:
+        return u''
+    return model.get_for_csv(prop, entity)
+
+  def format(self, entities):
+    '''Returns entities as CSV rows.'''
+    rows = []
+    for entity in entities:
+      row = [entity.key.urlsafe() if entity.key else '']
+      for name, prop in zip(self.columns, self._props):
+        row.append(self._cell(entity, name, prop))
+      rows.append(row)
+    return self._encode(rows)
+
+
+class NDJSONWriter(object):
+  '''Writes entities as JSON objects (the same as in JSON responses), one
+  by line.'''
+  content_type = 'application/x-ndjson'
+  extension = 'ndjson'
+
+  def __init__(self, modelclass, properties=None):
+    self.properties = properties
+
+  def header(self):
+    return ''
+
+  def format(self, entities):
+    '''Returns entities as JSON lines.'''
+    lines = []
+    for entity in entities:
+      values = entity.to_dict()
+      if self.properties:
+        values = dict((name, values.get(name, None))
+                      for name in ['$$key$$', '$$id$$'] + self.properties)
+      lines.append(json.dumps(values, cls=JSONEncoder,
+                              separators=(',', ':')))
+      lines.append('\n')
+    return ''.join(lines)
+
+
+FORMATS = {
+  'csv': CSVWriter,
+  'ndjson': NDJSONWriter,
+}
+
+
+def get_writer(fmt, modelclass, properties=None):
+  '''Returns a writer of format fmt ("csv" or "ndjson").'''
+  if not fmt in FORMATS:
+    raise ValueError('Unknown export format %s. Expected one of: %s'
+                     % (fmt, ', '.join(sorted(FORMATS))))
+  return FORMATS[fmt](modelclass, properties)
+
+
+class QueryExport(object):
+  '''Iterable of the chunks (strings) of an export of query, one by batch.
+  The header goes first if cursor is None, i. e. a new export. Next batch is
+  fetched while the current one is being formatted.
+
+  If predicate is given, only entities for which it returns True are
+  written. Iteration stops when there are no more results, after limit
+  entities or when deadline (a time.time() value) passes. Then "more" tells
+  whether there are results left and "cursor" is the urlsafe cursor to
+  resume.'''
+  def __init__(self, query, writer, cursor=None, batch_size=BATCH_SIZE,
+               limit=None, deadline=None, predicate=None):
+    self.query = query
+    self.writer = writer
+    self.cursor = cursor or None
+    self.batch_size = batch_size
+    self.limit = limit
+    self.deadline = deadline
+    self.predicate = predicate
+    self.count = 0
+    self.more = True
+
+  def _fetch(self, cursor):
+    size = self.batch_size
+    if self.limit is not None:
+      size = min(size, self.limit - self.count)
+    return self.query.fetch_page_async(size, start_cursor=cursor)
+
+  def _stop(self):
+    if self.limit is not None and self.count >= self.limit:
+      return True
+    return not self.deadline is None and time.time() >= self.deadline
+
+  def __iter__(self):
+    if self.cursor is None:
+      header = self.writer.header()
+      if header:
+        yield header
+      start = None
+    else:
+      start = datastore_query.Cursor(urlsafe=self.cursor)
+    if self.limit is not None and self.limit <= 0:
+      return
+
+    future = self._fetch(start)
+    while future is not None:
+      entities, next_cursor, more = future.get_result()
+      self.count += len(entities)
+      self.more = bool(more and next_cursor)
+      if self.more:
+        self.cursor = next_cursor.urlsafe()
+      future = None
+      if self.more and not self._stop():
+        future = self._fetch(next_cursor)
+      if self.predicate:
+        entities = [e for e in entities if self.predicate(e)]
+      if entities:
+        yield self.writer.format(entities)
+
+
+class ScanExport(object):
+  '''Like QueryExport, but query results are read with a ParallelScan, in
+  no given order. There is no cursor: if "more" is True after iteration,
+  the export was stopped by limit or deadline and must be started again.'''
+  def __init__(self, query, writer, batch_size=BATCH_SIZE, limit=None,
+               deadline=None, predicate=None, shards=scan.SHARDS,
+               parallelism=scan.PARALLELISM):
+    self.scan = scan.ParallelScan(query, shards=shards,
+                                  parallelism=parallelism,
+                                  batch_size=batch_size)
+    self.writer = writer
+    self.batch_size = batch_size
+    self.limit = limit
+    self.deadline = deadline
+    self.predicate = predicate
+    self.cursor = None
+    self.count = 0
+    self.more = False
+
+  def _stop(self):
+    if self.limit is not None and self.count >= self.limit:
+      return True
+    return not self.deadline is None and time.time() >= self.deadline
+
+  def __iter__(self):
+    header = self.writer.header()
+    if header:
+      yield header
+    if self.limit is not None and self.limit <= 0:
+      return
+
+    batch = []
+    for entity in self.scan:
+      self.count += 1
+      if not self.predicate or self.predicate(entity):
+        batch.append(entity)
+      if len(batch) >= self.batch_size:
+        yield self.writer.format(batch)
+        batch = []
+      if self._stop():
+        self.more = True
+        break
+    if batch:
+      yield self.writer.format(batch)
+
+
+class ExportJob(model.Model):
+  '''Background export of a query to a blob. The query is kept as kind,
+  ancestor, filters and orders to be rebuilt by each task.'''
+  kind = model.StringProperty()
+  format = model.StringProperty(indexed=False)
+  properties = model.StringProperty(repeated=True, indexed=False)
+  batch_size = model.IntegerProperty(default=BATCH_SIZE, indexed=False)
+  query_namespace = model.StringProperty(indexed=False)
+  ancestor = model.KeyProperty(indexed=False)
+  filters = ndb.PickleProperty()
+  orders = model.StringProperty(repeated=True, indexed=False)
+  status = model.StringProperty(default='running',
+                                choices=['running', 'done'])
+  file_name = model.StringProperty(indexed=False)
+  blob_key = model.BlobKeyProperty(indexed=False)
+  cursor = model.StringProperty(indexed=False)
+  count = model.IntegerProperty(default=0, indexed=False)
+  chunks = model.IntegerProperty(default=0, indexed=False)
+  # Writes (header and batches) appended, the sequence key of the next one.
+  parts = model.IntegerProperty(default=0, indexed=False)
+  created = model.DateTimeProperty(auto_now_add=True)
+  updated = model.DateTimeProperty(auto_now=True)
+
+  def build_query(self):
+    '''Returns the query to export.'''
+    modelclass = ndb.Model._lookup_model(self.kind)
+    query = modelclass.query(ancestor=self.ancestor, filters=self.filters,
+                             namespace=self.query_namespace)
+    orders = []
+    for name in self.orders:
+      direction = datastore_query.PropertyOrder.ASCENDING
+      if name.startswith('-'):
+        name, direction = name[1:], datastore_query.PropertyOrder.DESCENDING
+      orders.append(datastore_query.PropertyOrder(name, direction))
+    if orders:
+      query = query.order(*orders)
+    return query
+
+  def get_writer(self):
+    modelclass = ndb.Model._lookup_model(self.kind)
+    return get_writer(self.format, modelclass, self.properties)
+
+  def to_dict(self):
+    return {
+      '$$key$$': self.key.urlsafe() if self.key else None,
+      'kind': self.kind,
+      'format': self.format,
+      'status': self.status,
+      'count': self.count,
+      'blob_key': str(self.blob_key) if self.blob_key else None,
+      'created': self.created,
+      'updated': self.updated,
+    }
+
+
+def _enqueue(job):
+  try:
+    taskqueue.add(url=webapp2.uri_for(TASK_ROUTE),
+                  params={'job': job.key.urlsafe()},
+                  name='export-%s-%d' % (job.key.id(), job.chunks),
+                  queue_name=QUEUE)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Chunk already enqueued by a previous try of the same task.
+    pass
+
+
+def start_export(query, fmt, properties=None, batch_size=BATCH_SIZE):
+  '''Starts a background export of query results to a blob. Returns the
+  ExportJob, whose status is "done" and blob_key is set when finished.
+  ExportTaskHandler must be routed with name TASK_ROUTE.'''
+  modelclass = ndb.Model._lookup_model(query.kind)
+  writer = get_writer(fmt, modelclass, properties)
+  file_name = files.blobstore.create(
+    mime_type=writer.content_type,
+    _blobinfo_uploaded_filename='%s.%s' % (query.kind, writer.extension))
+  job = ExportJob(kind=query.kind, format=fmt, properties=properties or [],
+                  batch_size=batch_size,
+                  query_namespace=query.namespace or
+                    namespace_manager.get_namespace(),
+                  ancestor=query.ancestor, filters=query.filters,
+                  orders=orders_shape(query.orders), file_name=file_name)
+  job.put()
+  _enqueue(job)
+  return job
+
+
+def run_export_chunk(job_key, seconds=CHUNK_SECONDS):
+  '''Appends to the blob of job the results found in seconds and enqueues
+  the next chunk, or finalizes the blob if there are no results left.
+  Returns the job.
+
+  Each write (the header or a batch) is keyed by its position in the whole
+  export. Batches are read from the saved cursor, so a write done by a try
+  whose job was not saved has the same position when read again, by a
+  retry or by the next chunk, and is not appended twice.'''
+  job = job_key.get()
+  if job is None or job.status != 'running':
+    return job
+
+  run = QueryExport(job.build_query(), job.get_writer(), cursor=job.cursor,
+                    batch_size=job.batch_size,
+                    deadline=time.time() + seconds)
+  with files.open(job.file_name, 'a') as f:
+    for chunk in run:
+      try:
+        f.write(chunk, sequence_key='%012d' % job.parts)
+      except files.SequenceKeyOutOfOrderError:
+        # Written by a previous try.
+        pass
+      job.parts += 1
+
+  job.count += run.count
+  job.chunks += 1
+  if run.more:
+    job.cursor = run.cursor
+    job.put()
+    _enqueue(job)
+  else:
+    files.finalize(job.file_name)
+    job.blob_key = files.blobstore.get_blob_key(job.file_name)
+    job.cursor = None
+    job.status = 'done'
+    job.put()
+    logger.info('Export of %s finished: %d entities.' % (job.kind, job.count))
+  return job
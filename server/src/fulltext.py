@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Full text search of models with the appengine Search API.
+
+A model opts in naming in _search_fields the properties (code names) to
+index. Model put and delete hooks enqueue a task which copies the stored
+entity to a document of the index of its kind (in its namespace), or
+removes the document if the entity is gone, so the write does not wait for
+the index. SearchIndexHandler must be routed with name INDEX_ROUTE.
+
+  class Book(stones.Model):
+    _search_fields = ('title', 'summary')
+
+  keys, cursor = search_keys(Book, u'dragons')'''
+
+import datetime
+import logging
+
+import webapp2
+from google.appengine.ext import ndb
+from google.appengine.api import search, taskqueue
+
+import scan
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['document_for', 'enqueue_index', 'index_entities', 'search_keys',
+           'rebuild_index', 'INDEX_ROUTE']
+
+# Name of the route to SearchIndexHandler.
+INDEX_ROUTE = 'stones.fulltext.index'
+# Queue of index tasks.
+QUEUE = 'default'
+# Max documents by index put or delete.
+BATCH_SIZE = 200
+# Results by page.
+LIMIT = 20
+# Max results by page allowed by the Search API.
+MAX_LIMIT = 1000
+# Max absolute value of a NumberField.
+MAX_NUMBER = 2147483647
+
+
+def get_index(kind, namespace=None):
+  '''Returns the index of kind in namespace (the current one if None).'''
+  return search.Index(name=kind, namespace=namespace)
+
+
+def _fields(name, value):
+  if value is None:
+    return []
+  if isinstance(value, list):
+    return sum([_fields(name, v) for v in value], [])
+  if isinstance(value, bool):
+    return [search.AtomField(name=name, value=unicode(value).lower())]
+  if isinstance(value, (int, long, float)):
+    if -MAX_NUMBER <= value <= MAX_NUMBER:
+      return [search.NumberField(name=name, value=value)]
+    # Out of NumberField range: searchable by exact value only.
+    return [search.AtomField(name=name, value=unicode(value))]
+  if isinstance(value, (datetime.datetime, datetime.date)):
+    return [search.DateField(name=name, value=value)]
+  if isinstance(value, ndb.Key):
+    return [search.AtomField(name=name, value=value.urlsafe())]
+  if isinstance(value, str):
+    value = value.decode('utf-8')
+  return [search.TextField(name=name, value=unicode(value))]
+
+
+def document_for(entity):
+  '''Returns the search document of entity. Its id is the urlsafe key.'''
+  fields = []
+  for name in entity._search_fields:
+    fields += _fields(name, getattr(entity, name, None))
+  return search.Document(doc_id=entity.key.urlsafe(), fields=fields)
+
+
+def enqueue_index(key):
+  '''Enqueues the update of the document of the entity of key, in the
+  transaction if there is one.'''
+  try:
+    url = webapp2.uri_for(INDEX_ROUTE)
+  except KeyError:
+    logger.warning('No %s route. %r is not indexed.' % (INDEX_ROUTE, key))
+    return
+  taskqueue.add(url=url, params={'key': key.urlsafe()}, queue_name=QUEUE,
+                transactional=ndb.in_transaction())
+
+
+def index_entities(keys):
+  '''Copies the stored entities of keys to their documents, deleting the
+  documents of the entities which no longer exist.'''
+  groups = {}
+  for key, entity in zip(keys, ndb.get_multi(keys)):
+    group = groups.setdefault((key.kind(), key.namespace()), ([], []))
+    if entity is None:
+      group[1].append(key.urlsafe())
+    else:
+      group[0].append(document_for(entity))
+  for (kind, namespace), (documents, removed) in groups.iteritems():
+    index = get_index(kind, namespace)
+    for start in xrange(0, len(documents), BATCH_SIZE):
+      index.put(documents[start:start + BATCH_SIZE])
+    for start in xrange(0, len(removed), BATCH_SIZE):
+      index.delete(removed[start:start + BATCH_SIZE])
+
+
+def search_keys(modelclass, query_string, limit=LIMIT, cursor=None,
+                namespace=None):
+  '''Returns (keys, cursor) of the entities of modelclass matching
+  query_string (Search API syntax), best matches first. cursor is the web
+  safe string of the next page, or None.
+
+  Raises ValueError if query_string is invalid.'''
+  sort = search.SortOptions(
+    match_scorer=search.MatchScorer(),
+    expressions=[search.SortExpression(
+      expression='_score', direction=search.SortExpression.DESCENDING,
+      default_value=0)])
+  options = search.QueryOptions(
+    limit=min(limit, MAX_LIMIT), ids_only=True, sort_options=sort,
+    cursor=search.Cursor(web_safe_string=cursor) if cursor
+      else search.Cursor())
+  try:
+    results = get_index(modelclass._get_kind(), namespace).search(
+      search.Query(query_string=query_string, options=options))
+  except search.QueryError, e:
+    raise ValueError(str(e))
+  keys = [ndb.Key(urlsafe=document.doc_id) for document in results]
+  next_cursor = results.cursor.web_safe_string if results.cursor else None
+  return keys, next_cursor
+
+
+def rebuild_index(modelclass, namespace=None):
+  '''Indexes every stored entity of modelclass. Run it once for data saved
+  before the model had _search_fields.'''
+  query = modelclass.query(namespace=namespace)
+  scan.parallel_map(query, index_entities,
+                    batch_size=BATCH_SIZE, keys_only=True)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Geohash index of GeoPtProperty values and radius / bounding box queries.
+
+A GeoPtProperty(geo_index=True) "location" adds to its model a computed
+repeated property "location_geohash" holding the geohash prefixes, from 1 to
+PRECISION characters, of its values. A query is run as one equality query by
+geohash cell covering the searched area, a few of them at a time, nearest
+cells first, and the results are filtered by exact distance.
+
+The geohashes are written when entities are put: entities saved before
+geo_index was set must be put again, e. g. with rebuild_geo_index.
+
+GET params (see stones.planner):
+
+  location__near=lat,lng,meters    sorted by distance
+  location__within=south,west,north,east'''
+
+import logging
+import math
+
+from google.appengine.ext import ndb
+
+import scan
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['encode', 'cell_size', 'prefixes', 'covering_cells', 'distance',
+           'parse_near', 'parse_within', 'fetch_geo', 'rebuild_geo_index']
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Longest prefix stored. 8 characters are cells of about 38 x 19 meters.
+PRECISION = 8
+# Max cells queried for an area.
+MAX_CELLS = 16
+# Cells queried at the same time.
+CELLS_BY_WAVE = 4
+# Mean Earth radius, in meters.
+EARTH_RADIUS = 6371009.0
+METERS_BY_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def encode(lat, lon, precision=PRECISION):
+  '''Returns the geohash of (lat, lon) with precision characters.'''
+  lat_range = [-90.0, 90.0]
+  lon_range = [-180.0, 180.0]
+  chars = []
+  bits = 0
+  count = 0
+  even = True
+  while len(chars) < precision:
+    if even:
+      value, bounds = lon, lon_range
+    else:
+      value, bounds = lat, lat_range
+    middle = (bounds[0] + bounds[1]) / 2
+    bits <<= 1
+    if value >= middle:
+      bits |= 1
+      bounds[0] = middle
+    else:
+      bounds[1] = middle
+    even = not even
+    count += 1
+    if count == 5:
+      chars.append(BASE32[bits])
+      bits = 0
+      count = 0
+  return ''.join(chars)
+
+
+def cell_size(precision):
+  '''Returns (height, width) in degrees of cells of precision characters.'''
+  bits = 5 * precision
+  lon_bits = (bits + 1) // 2
+  lat_bits = bits // 2
+  return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def prefixes(points, precision=PRECISION):
+  '''Returns the sorted geohash prefixes, 1 to precision characters long,
+  of a GeoPt or a list of them.'''
+  if points is None:
+    return []
+  if not isinstance(points, list):
+    points = [points]
+  rv = set()
+  for point in points:
+    if point is None:
+      continue
+    geohash = encode(point.lat, point.lon, precision)
+    rv.update(geohash[:i] for i in xrange(1, precision + 1))
+  return sorted(rv)
+
+
+def decode_box(geohash):
+  '''Returns the (south, west, north, east) box of a geohash cell.'''
+  lat_range = [-90.0, 90.0]
+  lon_range = [-180.0, 180.0]
+  even = True
+  for char in geohash:
+    bits = BASE32.index(char)
+    for shift in xrange(4, -1, -1):
+      bounds = lon_range if even else lat_range
+      middle = (bounds[0] + bounds[1]) / 2
+      if bits >> shift & 1:
+        bounds[0] = middle
+      else:
+        bounds[1] = middle
+      even = not even
+  return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def _cell_indexes(low, high, size, offset):
+  first = int(math.floor((low + offset) / size))
+  last = int(math.floor((min(high, offset - 1e-9) + offset) / size))
+  return range(first, last + 1)
+
+
+def covering_cells(south, west, north, east, max_cells=MAX_CELLS):
+  '''Returns the smallest geohash cells, at most max_cells of them, which
+  cover the box, or None if the box is too big even for 1 character cells.
+  west > east is a box across the antimeridian.'''
+  south, north = max(south, -90.0), min(north, 90.0)
+  if west > east:
+    east += 360
+  full_lon = east - west >= 360
+  for precision in xrange(PRECISION, 0, -1):
+    height, width = cell_size(precision)
+    rows = _cell_indexes(south, north, height, 90.0)
+    if full_lon:
+      columns = range(int(round(360.0 / width)))
+    else:
+      columns = range(int(math.floor((west + 180) / width)),
+                      int(math.floor((min(east, 540 - 1e-9) + 180) / width))
+                      + 1)
+    if len(rows) * len(columns) > max_cells:
+      continue
+    cells = set()
+    for row in rows:
+      for column in columns:
+        lat = -90 + (row + 0.5) * height
+        lon = (-180 + (column + 0.5) * width + 180) % 360 - 180
+        cells.add(encode(lat, lon, precision))
+    return sorted(cells)
+  return None
+
+
+def distance(lat1, lon1, lat2, lon2):
+  '''Returns the haversine distance in meters between two points.'''
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = math.sin((lat2 - lat1) / 2) ** 2 + \
+    math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+  return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _floats(raw, count):
+  if isinstance(raw, basestring):
+    raw = raw.split(',')
+  values = [float(v) for v in raw]
+  if len(values) != count:
+    raise ValueError('Expected %d numbers, got %d.' % (count, len(values)))
+  return values
+
+
+def parse_near(raw):
+  '''Returns (lat, lon, meters) of "lat,lng,meters".'''
+  lat, lon, meters = _floats(raw, 3)
+  if not -90 <= lat <= 90 or not -180 <= lon <= 180 or meters < 0:
+    raise ValueError('Invalid point or radius.')
+  return lat, lon, meters
+
+
+def parse_within(raw):
+  '''Returns (south, west, north, east) of "south,west,north,east".'''
+  south, west, north, east = _floats(raw, 4)
+  if not -90 <= south <= north <= 90 or not -180 <= west <= 180 or \
+      not -180 <= east <= 180:
+    raise ValueError('Invalid bounding box.')
+  return south, west, north, east
+
+
+def near_box(lat, lon, meters):
+  '''Returns the (south, west, north, east) box around a circle.'''
+  dlat = meters / METERS_BY_DEGREE
+  cos_lat = math.cos(math.radians(lat))
+  if cos_lat < 1e-6 or abs(lat) + dlat >= 90:
+    return max(lat - dlat, -90.0), -180.0, min(lat + dlat, 90.0), 180.0
+  dlon = dlat / cos_lat
+  if dlon >= 180:
+    return lat - dlat, -180.0, lat + dlat, 180.0
+  west = (lon - dlon + 180) % 360 - 180
+  east = (lon + dlon + 180) % 360 - 180
+  return lat - dlat, west, lat + dlat, east
+
+
+def in_box(point, south, west, north, east):
+  if not south <= point.lat <= north:
+    return False
+  if west <= east:
+    return west <= point.lon <= east
+  return point.lon >= west or point.lon <= east
+
+
+def box_distance(lat, lon, box):
+  '''Returns the distance in meters from (lat, lon) to the nearest point of
+  a box which does not cross the antimeridian.'''
+  south, west, north, east = box
+  return distance(lat, lon, min(max(lat, south), north),
+                  min(max(lon, west), east))
+
+
+def point_distance(spec, entity):
+  '''Returns the distance from the center of a near FilterSpec to the
+  nearest value of its property in entity.'''
+  lat, lon, unused = spec.values[0]
+  points = spec.prop._get_value(entity)
+  if not isinstance(points, list):
+    points = [points]
+  distances = [distance(lat, lon, p.lat, p.lon)
+               for p in points if not p is None]
+  return min(distances) if distances else None
+
+
+def fetch_geo(query, plan, limit=None, max_scan=None):
+  '''Returns up to limit entities of query in the area of the geo filter of
+  plan (plan.geo) which pass its post-filters, reading the geohash cells
+  covering the area CELLS_BY_WAVE at a time, nearest first. max_scan is
+  split among the cells. Reading stops once limit entities are found and no
+  unread cell can hold a nearer one. Near results are sorted by distance.'''
+  # Imported here, planner imports this module.
+  import planner
+  spec = plan.geo
+  if spec.op == 'near':
+    lat, lon, meters = spec.values[0]
+    box = near_box(lat, lon, meters)
+  else:
+    box = spec.values[0]
+  cells = covering_cells(*box)
+  if cells is None:
+    # Cells would be bigger than the whole world.
+    return planner.fetch_post_filtered(query, plan, limit, max_scan)
+
+  if spec.op == 'near':
+    sort_key = lambda e: point_distance(spec, e)
+    cells.sort(key=lambda cell: box_distance(lat, lon, decode_box(cell)))
+  else:
+    sort_key = lambda e: e.key
+  per_cell = max(1, max_scan // len(cells)) if max_scan else None
+  hash_prop = spec.prop._geo_hash_property
+  found = {}
+  scanned = 0
+  for start in xrange(0, len(cells), CELLS_BY_WAVE):
+    futures = [query.filter(hash_prop == cell).fetch_async(per_cell)
+               for cell in cells[start:start + CELLS_BY_WAVE]]
+    for future in futures:
+      entities = future.get_result()
+      scanned += len(entities)
+      if per_cell and len(entities) >= per_cell:
+        plan.truncated = True
+      for entity in entities:
+        if not entity.key in found and plan.match(entity):
+          found[entity.key] = entity
+    rest = cells[start + CELLS_BY_WAVE:]
+    if not limit or len(found) < limit or not rest:
+      continue
+    if spec.op != 'near':
+      break
+    farthest = sorted(point_distance(spec, e)
+                      for e in found.itervalues())[limit - 1]
+    if box_distance(lat, lon, decode_box(rest[0])) > farthest:
+      break
+  plan.scanned = scanned
+
+  rv = sorted(found.values(), key=sort_key)
+  if limit:
+    rv = rv[:limit]
+  return rv
+
+
+def _put_page(entities):
+  ndb.put_multi(entities)
+
+
+def rebuild_geo_index(modelclass, namespace=None):
+  '''Puts again every stored entity of modelclass, which writes the
+  geohashes of its GeoPtProperty(geo_index=True) properties. Run it once
+  for data saved before geo_index was set.'''
+  scan.parallel_map(modelclass.query(namespace=namespace), _put_page)
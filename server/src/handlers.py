@@ -19,6 +19,7 @@
 # Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
 
 import logging
+import random
 import sys
 import traceback
 
@@ -36,9 +37,22 @@ import oauth2
 from .oauth2 import get_service
 
 from .model_handler_mixin import ModelHandlerMixin
+from .ratelimit import RateLimiter
+import sessions
+import profiling
+import query_stats
+import export
+import writebehind
+import references
+import fulltext
+import push
 
 __all__ = ['BaseHandler', 'ModelHandlerMixin', 'NoKeyError',
-           'UserIdentifierUsedError', 'ConstantHandler', 'tasklet', 'Return']
+           'UserIdentifierUsedError', 'ConstantHandler', 'tasklet', 'Return',
+           'RateLimiter', 'QueryStatsHandler', 'ExportTaskHandler',
+           'WriteBehindWorkerHandler', 'WriteBehindStatusHandler',
+           'ReferenceRefreshHandler', 'ReferenceBacklinkHandler',
+           'SearchIndexHandler', 'PushHandler']
 logger = logging.getLogger(__name__)
 tasklet = ndb.tasklet
 Return = ndb.Return
@@ -67,9 +81,19 @@ class BaseHandler(webapp2.RequestHandler):
   # TODO: We need dynamic users groups?
   users_allowed = []
 
-  # Session backend used to mamnage sessions.
+  # Session backend used to mamnage sessions. 'securecookie', 'memcache',
+  # 'datastore' or 'hybrid'. See stones.sessions.
   session_backend = 'memcache'
 
+  # RateLimiter instances checked before any datastore or session work.
+  rate_limits = []
+
+  # Fraction (0 to 1) of requests profiled and sent to profile_sink.
+  # See stones.profiling.
+  profile_sample_rate = 0
+  profile_sink = profiling.LoggingSink()
+  profile = profiling.NullProfile()
+
   def __init__(self, *args, **kwargs):
     super(BaseHandler, self).__init__(*args, **kwargs)
 
@@ -111,8 +135,9 @@ class BaseHandler(webapp2.RequestHandler):
 
   def encode_json(self, jsonable, **kwargs):
     '''Encode in JSON format.'''
-    return webapp2_extras.json.encode(jsonable, ensure_ascii=False,
-                                      cls=JSONEncoder, **kwargs)
+    with self.profile.phase('serialization'):
+      return webapp2_extras.json.encode(jsonable, ensure_ascii=False,
+                                        cls=JSONEncoder, **kwargs)
 
   def extract_json(self):
     '''Convert request body in JSON'''
@@ -158,6 +183,10 @@ class BaseHandler(webapp2.RequestHandler):
   @webapp2.cached_property
   def user(self):
     '''Gets system user'''
+    with self.profile.phase('user'):
+      return self._get_user()
+
+  def _get_user(self):
     system_user = self.auth.get_user_by_session()
     user_model = self.auth.store.user_model
     if not system_user:
@@ -216,19 +245,80 @@ class BaseHandler(webapp2.RequestHandler):
       login_url = users.create_login_url(come_back_to)
     return login_url
 
+  def get_rate_limit_value(self, scope):
+    '''Returns the value requests are limited by for a RateLimiter scope.'''
+    if callable(scope):
+      return scope(self)
+    if scope == 'ip':
+      return self.request.remote_addr
+    elif scope == 'auth_id':
+      return self.request.get('username')
+    elif scope == 'route':
+      return ''
+    raise ValueError('Unknown rate limit scope %s.' % scope)
+
+  def check_rate_limits(self):
+    '''Returns if request is admitted by all rate_limits.'''
+    route = self.request.route.name or self.request.path
+    for limiter in self.rate_limits:
+      if not limiter.applies_to(self.request.method):
+        continue
+      value = self.get_rate_limit_value(limiter.scope)
+      if not limiter.admit(route, value):
+        return False
+    return True
+
+  def should_profile(self):
+    '''Returns if this request is profiled: sampled by profile_sample_rate
+    or asked for through profiling.HEADER (debug mode or admins only).'''
+    if self.request.headers.get(profiling.HEADER):
+      if self.app.debug or users.is_current_user_admin():
+        self._profile_requested = True
+        return True
+    return random.random() < self.profile_sample_rate
+
+  def finish_profile(self):
+    '''Sends the request profile to profile_sink and adds it to response
+    headers if it was asked for.'''
+    profile = profiling.stop()
+    if not profile.enabled:
+      return
+    if getattr(self, '_profile_requested', False):
+      self.response.headers[profiling.HEADER] = profile.to_header()
+    if not self.profile_sink is None:
+      self.profile_sink.record(self, profile)
+
   @ndb.toplevel
   def dispatch(self):
+    self.profile = profiling.start(self.should_profile())
+    try:
+      self._dispatch()
+    finally:
+      self.finish_profile()
+
+  def _dispatch(self):
+    profile = self.profile
     # Set namespace
-    self.set_namespace()
+    with profile.phase('namespace'):
+      self.set_namespace()
+
+    with profile.phase('rate_limits'):
+      admitted = self.check_rate_limits()
+    if not admitted:
+      self.response.set_status(429, 'Too Many Requests')
+      self.response.headers['Retry-After'] = '60'
+      return self.render_json({
+        'Error': 'RateLimitExceeded',
+        'Msg': u'Too many requests. Try again later.',
+      })
 
     # Get language to apply translations
-    self.locale = self.request.headers.get('Accept-Language', 'es-ES')
-    webapp2_extras.i18n.get_i18n().set_locale(self.locale)
+    with profile.phase('i18n'):
+      self.locale = self.request.headers.get('Accept-Language', 'es-ES')
+      webapp2_extras.i18n.get_i18n().set_locale(self.locale)
 
     # Get a session store for this request.
-    self.session_store = webapp2_extras.sessions.get_store(
-      request=self.request
-    )
+    self.session_store = sessions.get_store(request=self.request)
 
     _dispatch = False
     if self.users_allowed:
@@ -247,12 +337,14 @@ class BaseHandler(webapp2.RequestHandler):
 
     if _dispatch:
       try:
-        super(BaseHandler, self).dispatch()
+        with profile.phase('handler'):
+          super(BaseHandler, self).dispatch()
       except:
         raise
       finally:
         # Save all sessions.
-        self.session_store.save_sessions(self.response)
+        with profile.phase('session_save'):
+          self.session_store.save_sessions(self.response)
     else:
       come_back_to = self.request.route.build(
         self.request,
@@ -265,7 +357,8 @@ class BaseHandler(webapp2.RequestHandler):
   @webapp2.cached_property
   def session(self):
       # Returns a session using the default cookie key.
-      return self.session_store.get_session(backend=self.session_backend)
+      with self.profile.phase('session_load'):
+        return self.session_store.get_session(backend=self.session_backend)
 
   @webapp2.cached_property
   def auth(self):
@@ -287,3 +380,130 @@ class ConstantHandler(BaseHandler):
   def get(self):
     '''Returns a JSON format of a constant defined in 'constant' attribute.'''
     self.render_json([{'label': c[1], 'value': c[0]} for c in self.constant if c[1]])
+
+
+class QueryStatsHandler(BaseHandler):
+  '''Admin handler to retrieve stats of queries run by ModelHandlerMixin.
+  Optional "kind" param restricts stats to one kind.'''
+  users_allowed = ['admin']
+
+  def get(self):
+    self.render_json(query_stats.get_stats(kind=self.request.get('kind')))
+
+
+class ExportTaskHandler(BaseHandler):
+  '''Runs the chunks of background exports (POST, by the task queue) and
+  returns the status of an export (GET). Route it with name
+  stones.export.TASK_ROUTE and restrict it to admins in app.yaml.'''
+  def get(self):
+    job = ndb.Key(urlsafe=self.request.get('job')).get()
+    if job is None or not isinstance(job, export.ExportJob):
+      return self.abort(404, 'Export not found.')
+    self.render_json(job.to_dict())
+
+  def post(self):
+    job = export.run_export_chunk(ndb.Key(urlsafe=self.request.get('job')))
+    if job is None:
+      logger.warning('Export %s not found.' % self.request.get('job'))
+
+
+class WriteBehindWorkerHandler(BaseHandler):
+  '''Commits the writes of ModelHandlerMixin in write-behind mode. Route it
+  with name stones.writebehind.WORKER_ROUTE; it can also be run by cron.
+  Restrict it to admins in app.yaml.'''
+  queue = writebehind.QUEUE
+
+  def get(self):
+    count = writebehind.run(queue=self.queue)
+    logger.info('%d write-behind writes processed.' % count)
+  post = get
+
+
+class WriteBehindStatusHandler(BaseHandler):
+  '''Returns the status of a write-behind write given by "write" param (the
+  token returned as $$write$$).'''
+  def get(self):
+    token = self.request.get('write')
+    if not token:
+      return self.abort(400, 'No write given.')
+    status, error = writebehind.get_status(token)
+    self.render_json({'write': token, 'status': status, 'error': error})
+
+
+class ReferenceRefreshHandler(BaseHandler):
+  '''Task handler to refresh the displays of references to an entity, a
+  page of referencing entities by task. Route it with name
+  stones.references.REFRESH_ROUTE and restrict it to admins in app.yaml.'''
+  def post(self):
+    key = ndb.Key(urlsafe=self.request.get('key'))
+    cursor = references.refresh_displays(key,
+                                         cursor=self.request.get('cursor'))
+    if cursor:
+      references.enqueue_refresh(key, cursor)
+
+
+class ReferenceBacklinkHandler(BaseHandler):
+  '''Task handler to retry the write of backlinks of references. Route it
+  with name stones.references.BACKLINKS_ROUTE and restrict it to admins in
+  app.yaml.'''
+  def post(self):
+    references.write_backlinks(ndb.Key(urlsafe=self.request.get('key')),
+                               self.request.get_all('added'),
+                               self.request.get_all('removed'))
+
+
+class SearchIndexHandler(BaseHandler):
+  '''Task handler to copy an entity to its search document. Route it with
+  name stones.fulltext.INDEX_ROUTE and restrict it to admins in app.yaml.'''
+  def post(self):
+    fulltext.index_entities([ndb.Key(urlsafe=self.request.get('key'))])
+
+
+class PushHandler(BaseHandler):
+  '''Long-poll of the change notifications of entities of the current
+  namespace (see stones.push).
+
+  Params: "kinds" (comma separated, all if empty), "since" (cursor of the
+  previous response; only new notifications if empty) and "timeout"
+  (seconds, up to push.MAX_WAIT). Answers {"changes": [...], "since":
+  cursor, "reset": bool} or, if the client accepts text/event-stream, one
+  server-sent event by notification; EventSource reconnects and sends the
+  cursor back in Last-Event-ID. "reset" (a "reset" event) means that
+  notifications were lost: the client must sync again (see stones.changes).'''
+  def get(self):
+    kinds = [k for k in self.request.get('kinds').split(',') if k]
+    since = self.request.get('since') or \
+      self.request.headers.get('Last-Event-ID', None)
+    try:
+      timeout = min(float(self.request.get('timeout') or push.MAX_WAIT),
+                    push.MAX_WAIT)
+    except ValueError:
+      return self.abort(400, 'Invalid timeout.')
+
+    seq = push.parse_since(since)
+    notifications = []
+    reset = seq is None
+    if not reset:
+      notifications, seq, reset = push.broker.wait(
+        namespace_manager.get_namespace(), seq, kinds=kinds or None,
+        timeout=timeout)
+    if reset:
+      notifications = []
+      seq = push.broker.seq
+    cursor = push.format_since(seq)
+
+    if 'text/event-stream' in self.request.headers.get('Accept', ''):
+      self.response.content_type = 'text/event-stream'
+      self.response.headers['Cache-Control'] = 'no-cache'
+      events = ['retry: 1000\n']
+      if reset:
+        events.append('id: %s\nevent: reset\ndata: {}\n\n' % cursor)
+      for notification in notifications:
+        events.append('id: %s\ndata: %s\n\n' % (
+          push.format_since(notification['version']),
+          self.encode_json(notification)))
+      if not notifications and not reset:
+        events.append('id: %s\n\n' % cursor)
+      return self.response.write(''.join(events))
+    return self.render_json({'changes': notifications, 'since': cursor,
+                             'reset': reset})
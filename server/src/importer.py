@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Bulk import of NDJSON or CSV (as written by stones.export) rows.
+
+Rows are read from a stream one by one, decoded with Model.from_dict and
+put by batches with put_multi_async, keeping a bounded number of batches in
+flight. Progress is checkpointed in an ImportJob after each batch, so an
+import which fails or runs out of time is resumed by running it again with
+the same job (ModelHandlerMixin names it after the "job" param chosen by the
+client) and the same rows: rows already done are skipped. Rows without
+"$$key$$" of a batch put but not checkpointed when the import stopped are
+created again.'''
+
+import base64
+import collections
+import csv
+import logging
+import time
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+import model
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['CONTENT_TYPES', 'NDJSONReader', 'CSVReader', 'get_reader',
+           'prefetch_references', 'ImportJob', 'Importer']
+
+# Rows put by batch.
+BATCH_SIZE = 200
+# Batches being put at the same time.
+MAX_IN_FLIGHT = 4
+# Batches done between checkpoints. Rows without key of batches not
+# checkpointed are created again on resume.
+CHECKPOINT_EVERY = 1
+# Row errors kept in ImportJob. The others are only counted.
+MAX_ERRORS = 100
+
+# Request content types of imports and their formats.
+CONTENT_TYPES = {
+  'application/x-ndjson': 'ndjson',
+  'application/ndjson': 'ndjson',
+  'text/csv': 'csv',
+}
+
+
+class NDJSONReader(object):
+  '''Reads one JSON object by line.'''
+  def __init__(self, stream, modelclass):
+    self.stream = stream
+    self.modelclass = modelclass
+
+  def rows(self):
+    '''Yields raw rows. Blank lines are not rows.'''
+    for line in self.stream:
+      line = line.strip()
+      if line:
+        yield line
+
+  def decode(self, row):
+    '''Returns the dict of a raw row. Raises ValueError if invalid.'''
+    value = json.loads(row)
+    if not isinstance(value, dict):
+      raise ValueError('Expected JSON object, got %r.' % (value,))
+    return value
+
+
+class CSVReader(object):
+  '''Reads UTF-8 CSV rows whose first row is the header: "$$key$$" and
+  property code names. Cells are decoded back from the format of
+  _get_for_csv. Reference columns hold displays only, so they are ignored;
+  use NDJSON to import references.'''
+  def __init__(self, stream, modelclass):
+    self.stream = stream
+    self.modelclass = modelclass
+    self.columns = None
+    self._props = dict((p._code_name, p)
+                       for p in modelclass._properties.itervalues())
+
+  def rows(self):
+    '''Yields raw rows (lists of cells). The header is not a row.'''
+    for row in csv.reader(self.stream):
+      if self.columns is None:
+        self.columns = [c.decode('utf-8') for c in row]
+        continue
+      if row:
+        yield row
+
+  def _decode_value(self, prop, cell):
+    if isinstance(prop, (model.StructuredProperty,
+                         model.LocalStructuredProperty, model.JsonProperty)):
+      return json.loads(cell)
+    if isinstance(prop, model.GeoPtProperty):
+      return cell.split(',')
+    if isinstance(prop, model.BlobProperty):
+      return base64.b64decode(cell)
+    return cell
+
+  def decode(self, row):
+    '''Returns the dict of a raw row. Raises ValueError if invalid.'''
+    if len(row) > len(self.columns):
+      raise ValueError('Expected %d cells, got %d.'
+                       % (len(self.columns), len(row)))
+    value = {}
+    for name, cell in zip(self.columns, row):
+      cell = cell.decode('utf-8')
+      if not cell:
+        continue
+      if name in ('$$key$$', '$$id$$'):
+        value[name] = cell
+        continue
+      prop = self._props.get(name, None)
+      if prop is None or isinstance(prop, (model.ReferenceProperty,
+                                           ndb.ComputedProperty)):
+        continue
+      if prop._repeated and not isinstance(prop, (model.StructuredProperty,
+                                                  model.JsonProperty)):
+        value[name] = [self._decode_value(prop, c)
+                       for c in cell.split(u', ')]
+      else:
+        value[name] = self._decode_value(prop, cell)
+    return value
+
+
+READERS = {
+  'ndjson': NDJSONReader,
+  'csv': CSVReader,
+}
+
+
+def get_reader(fmt, stream, modelclass):
+  '''Returns a reader of format fmt ("ndjson" or "csv") from stream.'''
+  if not fmt in READERS:
+    raise ValueError('Unknown import format %s. Expected one of: %s'
+                     % (fmt, ', '.join(sorted(READERS))))
+  return READERS[fmt](stream, modelclass)
+
+
+def prefetch_references(modelclass, values):
+  '''Gets with one get_multi the entities referenced without display in
+  values (dicts to be passed to from_dict). Then ReferenceProperty finds
+  them in the context cache instead of getting them one by one.'''
+  urlsafe_keys = set()
+  for prop in modelclass._properties.itervalues():
+    if not isinstance(prop, model.ReferenceProperty):
+      continue
+    for value in values:
+      refs = value.get(prop._code_name, None)
+      if not refs:
+        continue
+      if not prop._repeated:
+        refs = [refs]
+      for ref in refs:
+        if isinstance(ref, dict) and not ref.get('display', None):
+          urlsafe_key = ref.get('urlsafe_key', '') or ref.get('$$key$$', '')
+          if urlsafe_key:
+            urlsafe_keys.add(urlsafe_key)
+
+  keys = []
+  for urlsafe_key in urlsafe_keys:
+    try:
+      keys.append(ndb.Key(urlsafe=urlsafe_key))
+    except (ProtocolBufferDecodeError, TypeError):
+      # from_dict reports it in the row.
+      pass
+  if keys:
+    ndb.get_multi(keys)
+
+
+class ImportJob(model.Model):
+  '''Progress of an import. rows_done is the number of rows whose batches
+  are done (put or failed), the point to resume from.'''
+  kind = model.StringProperty()
+  format = model.StringProperty(indexed=False)
+  status = model.StringProperty(default='running',
+                                choices=['running', 'done'])
+  rows_done = model.IntegerProperty(default=0, indexed=False)
+  imported = model.IntegerProperty(default=0, indexed=False)
+  failed = model.IntegerProperty(default=0, indexed=False)
+  errors = model.JsonProperty(default=[])
+  seconds = model.FloatProperty(default=0.0, indexed=False)
+  created = model.DateTimeProperty(auto_now_add=True)
+  updated = model.DateTimeProperty(auto_now=True)
+
+  def add_error(self, row, error):
+    self.failed += 1
+    if len(self.errors) < MAX_ERRORS:
+      self.errors = self.errors + [{'row': row, 'error': unicode(error)}]
+
+  def to_dict(self):
+    return {
+      '$$key$$': self.key.urlsafe() if self.key else None,
+      'kind': self.kind,
+      'format': self.format,
+      'status': self.status,
+      'rows': self.rows_done,
+      'imported': self.imported,
+      'failed': self.failed,
+      'errors': self.errors,
+      'seconds': round(self.seconds, 3),
+      'rows_per_second': round(self.rows_done / self.seconds, 1)
+                         if self.seconds else None,
+    }
+
+
+class Importer(object):
+  '''Imports the rows of reader into modelclass entities.
+
+  Args:
+    modelclass: model of entities.
+    reader: NDJSONReader or CSVReader.
+    job: ImportJob to checkpoint in. Rows up to job.rows_done are skipped.
+    create: function which returns a new entity from a dict. By default,
+      modelclass.from_dict.
+    on_put: function called with each entity put.
+    batch_size: rows put by batch.
+    max_in_flight: batches being put at the same time.
+    checkpoint_every: batches done between job saves.
+    deadline: time.time() value to stop at. The job stays "running" and the
+      import can be resumed.'''
+  def __init__(self, modelclass, reader, job, create=None, on_put=None,
+               batch_size=BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT,
+               checkpoint_every=CHECKPOINT_EVERY, deadline=None):
+    self.modelclass = modelclass
+    self.reader = reader
+    self.job = job
+    self.create = create or modelclass.from_dict
+    self.on_put = on_put
+    self.batch_size = batch_size
+    self.max_in_flight = max_in_flight
+    self.checkpoint_every = checkpoint_every
+    self.deadline = deadline
+    self._in_flight = collections.deque()
+    self._batches_done = 0
+
+  def build_entity(self, value):
+    '''Returns the entity of a decoded row. "$$key$$" sets the key, so
+    imported rows with keys are updated instead of duplicated.'''
+    urlsafe_key = value.pop('$$key$$', None)
+    value.pop('$$id$$', None)
+    entity = self.create(value)
+    if urlsafe_key:
+      key = ndb.Key(urlsafe=urlsafe_key)
+      if key.kind() != self.modelclass._get_kind():
+        raise ValueError('Key of kind %s, expected %s.'
+                         % (key.kind(), self.modelclass._get_kind()))
+      entity.key = key
+    return entity
+
+  def _submit(self, rows):
+    '''Decodes and starts the put of a batch of (row number, raw row).'''
+    values = []
+    for number, raw in rows:
+      try:
+        values.append((number, self.reader.decode(raw)))
+      except ValueError, e:
+        self.job.add_error(number, e)
+    prefetch_references(self.modelclass, [value for unused, value in values])
+
+    numbers = []
+    entities = []
+    for number, value in values:
+      try:
+        entities.append(self.build_entity(value))
+        numbers.append(number)
+      except Exception, e:
+        self.job.add_error(number, e)
+    if getattr(self.modelclass, '_counter_shards', 0):
+      # Put hooks of counted entities read the stored ones, if any.
+      built = [e for e in entities if e._has_complete_key()]
+      for entity, stored in zip(built, ndb.get_multi([e.key for e in built])):
+        entity._set_stored(stored)
+    futures = ndb.put_multi_async(entities) if entities else []
+    self._in_flight.append((rows[-1][0], zip(numbers, entities, futures)))
+    while len(self._in_flight) > self.max_in_flight:
+      self._complete()
+
+  def _complete(self):
+    '''Waits for the oldest batch in flight.'''
+    last_row, futures = self._in_flight.popleft()
+    for number, entity, future in futures:
+      try:
+        future.get_result()
+      except Exception, e:
+        self.job.add_error(number, e)
+        continue
+      self.job.imported += 1
+      if not self.on_put is None:
+        self.on_put(entity)
+    self.job.rows_done = last_row
+    self._batches_done += 1
+    if self._batches_done % self.checkpoint_every == 0:
+      self.job.put()
+
+  def run(self):
+    '''Imports rows until the end of reader or the deadline. Returns the
+    job, saved.'''
+    started = time.time()
+    if self.job.key is None:
+      self.job.put()
+    skip = self.job.rows_done
+    number = 0
+    rows = []
+    finished = True
+    for raw in self.reader.rows():
+      number += 1
+      if number <= skip:
+        continue
+      rows.append((number, raw))
+      if len(rows) >= self.batch_size:
+        self._submit(rows)
+        rows = []
+        if not self.deadline is None and time.time() >= self.deadline:
+          finished = False
+          break
+    if rows:
+      self._submit(rows)
+    while self._in_flight:
+      self._complete()
+
+    if finished:
+      self.job.status = 'done'
+    self.job.seconds += time.time() - started
+    self.job.put()
+    logger.info('Import of %s: %d rows, %d imported, %d failed (%s).'
+                % (self.job.kind, self.job.rows_done, self.job.imported,
+                   self.job.failed, self.job.status))
+    return self.job
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Load generator for stones apps.
+
+Requests are sent to a WSGI app in process (against appengine local stubs)
+or to a running server, by several threads, following a weighted mix of
+RequestSpec. OAuth2 providers are replaced by local stand-ins: in process,
+oauth2 HTTP calls are answered by StubProviderHttp; for a running server,
+serve_stub_providers starts a WSGI server to be set as 'access_token_uri'
+and 'user_info_uri' of providers in 'stones.auth' config.
+
+E. g., the default mix against the default app, in process:
+  python -m stones.loadtest --concurrency 10 --requests 2000
+'''
+
+import argparse
+import cookielib
+import itertools
+import logging
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+import webapp2
+
+import benchmark
+import handlers
+import model
+import oauth2
+from model_handler_mixin import ModelHandlerMixin
+from query_stats import LATENCY_BUCKETS, _bucket
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['RequestSpec', 'LoadTest', 'Report', 'StubProviderHttp',
+           'stub_providers', 'stub_providers_app', 'serve_stub_providers',
+           'build_app', 'default_mix']
+
+
+# OAuth2 providers stand-ins.
+
+def _provider_response(method, uri, body=None, headers=None):
+  '''Returns (status, content) as token or user info endpoints would do.
+  POST is a token request: code "xyz" gets token "token-xyz". GET is a user
+  info request: token "token-xyz" belongs to "xyz@example.com".'''
+  if method == 'POST':
+    params = urlparse.parse_qs(body or '')
+    code = params.get('code', [''])[0]
+    if not code:
+      return 400, json.dumps({'error': 'invalid_request'})
+    return 200, json.dumps({'access_token': 'token-%s' % code,
+                            'token_type': 'Bearer', 'expires_in': 3600})
+
+  query = urlparse.parse_qs(urlparse.urlparse(uri).query)
+  token = (query.get('access_token', None) or
+           query.get('oauth2_access_token', None) or [''])[0]
+  if not token and headers:
+    token = headers.get('Authorization', '').split(' ')[-1]
+  if not token.startswith('token-'):
+    return 401, json.dumps({'error': 'invalid_token'})
+  email = '%s@example.com' % token[len('token-'):]
+  return 200, json.dumps({'email': email, 'emailAddress': email,
+                          'name': email})
+
+
+class _StubResponse(dict):
+  def __init__(self, status):
+    super(_StubResponse, self).__init__(status=str(status))
+    self.status = status
+
+
+class StubProviderHttp(object):
+  '''Replaces httplib2.Http in oauth2 module. latency (seconds) is added to
+  every call to look like a real provider.'''
+  latency = 0
+
+  def __init__(self, *args, **kwargs):
+    pass
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    if self.latency:
+      time.sleep(self.latency)
+    status, content = _provider_response(method, uri, body, headers)
+    return _StubResponse(status), content
+
+
+class stub_providers(object):
+  '''Context manager to answer oauth2 HTTP calls with StubProviderHttp.'''
+  def __init__(self, latency=0):
+    self.latency = latency
+
+  def __enter__(self):
+    self._original = oauth2.httplib2.Http
+    http_class = type('StubProviderHttp', (StubProviderHttp,),
+                      {'latency': self.latency})
+    oauth2.httplib2.Http = http_class
+    return http_class
+
+  def __exit__(self, *args):
+    oauth2.httplib2.Http = self._original
+    return False
+
+
+def stub_providers_app(environ, start_response):
+  '''WSGI app answering token (POST) and user info (GET) requests.'''
+  method = environ['REQUEST_METHOD']
+  body = ''
+  if method == 'POST':
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(length)
+  uri = '?'.join([environ.get('PATH_INFO', ''),
+                  environ.get('QUERY_STRING', '')])
+  headers = {'Authorization': environ.get('HTTP_AUTHORIZATION', '')}
+  status, content = _provider_response(method, uri, body, headers)
+  reasons = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized'}
+  start_response('%d %s' % (status, reasons[status]),
+                 [('Content-Type', 'application/json')])
+  return [content]
+
+
+def serve_stub_providers(port=8089, host='localhost'):
+  '''Serves stub_providers_app in a daemon thread. Returns the server.'''
+  from wsgiref.simple_server import make_server
+  server = make_server(host, port, stub_providers_app)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+# Default app and mix.
+
+class LoadItem(model.Model):
+  name = model.StringProperty()
+  value = model.IntegerProperty()
+
+
+class LoadItemHandler(handlers.BaseHandler, ModelHandlerMixin):
+  model = LoadItem
+
+
+class HomeHandler(handlers.BaseHandler):
+  def get(self):
+    self.response.write('ok')
+
+
+PASSWORD = 'secret'
+
+
+def build_app(rate_limits=False):
+  '''Returns a WSGI app with stones.auth handlers and LoadItem CRUD.
+  Auth handlers are not rate limited unless rate_limits is True.'''
+  from auth import handlers as auth_handlers
+
+  def handler(cls):
+    if rate_limits:
+      return cls
+    return type(cls.__name__, (cls,), {'rate_limits': []})
+
+  provider = {
+    'client_id': 'load', 'client_secret': 'load', 'scope': 'email',
+    'request_token_uri': 'http://localhost/authorize',
+    'access_token_uri': 'http://localhost/token',
+  }
+  config = {
+    'webapp2_extras.sessions': {'secret_key': 'loadtest'},
+    'webapp2_extras.auth': {'user_model': 'stones.auth.models.BaseUser'},
+    'stones.auth': {
+      'providers': {'google': provider, 'facebook': provider},
+    },
+  }
+  return webapp2.WSGIApplication([
+    webapp2.Route('/', HomeHandler, name='home'),
+    webapp2.Route('/welcome', HomeHandler, name='welcome'),
+    webapp2.Route('/login', handler(auth_handlers.BaseLoginHandler),
+                  name='login'),
+    webapp2.Route('/signup', handler(auth_handlers.BaseSignupHandler),
+                  name='signup'),
+    webapp2.Route('/verify/<signup_token>',
+                  handler(auth_handlers.BaseAccountVerificationHandler),
+                  name='verify.account'),
+    webapp2.Route('/tasks/verification/<user_id>',
+                  auth_handlers.BaseAccountVerificationEmailHandler,
+                  name='send.account.verification'),
+    webapp2.Route('/oauth2/<provider>',
+                  auth_handlers.BaseOAuth2BeginHandler, name='oauth2.begin'),
+    webapp2.Route('/oauth2/<provider>/callback',
+                  auth_handlers.BaseOAuth2CallbackHandler,
+                  name='oauth2.callback'),
+    webapp2.Route('/items', LoadItemHandler),
+    webapp2.Route('/items/<key>', LoadItemHandler),
+  ], config=config)
+
+
+class RequestSpec(object):
+  '''One kind of request in a mix.
+  path and body may be functions receiving the request sequence number.
+  body is form encoded unless json is True.'''
+  def __init__(self, name, method, path, body=None, json=False, weight=1):
+    self.name = name
+    self.method = method
+    self.path = path
+    self.body = body
+    self.json = json
+    self.weight = weight
+
+  def build(self, n):
+    path = self.path(n) if callable(self.path) else self.path
+    body = self.body(n) if callable(self.body) else self.body
+    if body is None:
+      return path, None, None
+    if self.json:
+      return path, json.dumps(body), 'application/json'
+    return path, urllib.urlencode(body), 'application/x-www-form-urlencoded'
+
+
+def prepare_default_data(users=50, items=200):
+  '''Creates users (loadN@example.com, password PASSWORD) and LoadItems used
+  by default_mix. Returns the LoadItem urlsafe keys.'''
+  from auth.models import BaseUser
+  for index in range(users):
+    ok, user = BaseUser.create_user('own:load%d@example.com' % index,
+                                    email='load%d@example.com' % index,
+                                    type=['u'])
+    if ok:
+      user.set_password(PASSWORD)
+      user.put()
+  entities = [LoadItem(name=u'item %d' % i, value=i) for i in range(items)]
+  return [key.urlsafe() for key in model.ndb.put_multi(entities)]
+
+
+def default_mix(item_keys, users=50):
+  '''Mix of logins, signups, OAuth2 callbacks and LoadItem CRUD.'''
+  def key(n):
+    return item_keys[n % len(item_keys)]
+
+  return [
+    RequestSpec('login', 'POST', '/login', weight=2,
+                body=lambda n: {'username': 'load%d@example.com' % (n % users),
+                                'password': PASSWORD}),
+    RequestSpec('signup', 'POST', '/signup', weight=1,
+                body=lambda n: {'username': 'new%d@example.com' % n}),
+    RequestSpec('oauth2.callback', 'GET', weight=1,
+                path=lambda n: '/oauth2/google/callback?code=oauth%d' % n),
+    RequestSpec('items.list', 'GET', '/items?l=20', weight=4),
+    RequestSpec('items.get', 'GET', lambda n: '/items/%s' % key(n), weight=6),
+    RequestSpec('items.post', 'POST', '/items', json=True, weight=2,
+                body=lambda n: {'name': u'new %d' % n, 'value': n}),
+    RequestSpec('items.put', 'PUT', lambda n: '/items/%s' % key(n),
+                json=True, weight=2,
+                body=lambda n: {'name': u'changed %d' % n, 'value': n}),
+  ]
+
+
+# Driver.
+
+class Report(object):
+  '''Latencies, statuses and errors by request name.'''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.samples = {}
+    self.statuses = {}
+    self.errors = {}
+    self.started = None
+    self.finished = None
+
+  def record(self, name, seconds, status, error=None):
+    with self._lock:
+      self.samples.setdefault(name, []).append(seconds)
+      statuses = self.statuses.setdefault(name, {})
+      statuses[status] = statuses.get(status, 0) + 1
+      if error or status >= 500 or status == 0:
+        errors = self.errors.setdefault(name, [])
+        if len(errors) < 10:
+          errors.append(error or status)
+
+  def to_dict(self):
+    elapsed = (self.finished or time.time()) - self.started
+    routes = {}
+    total = 0
+    for name, samples in self.samples.iteritems():
+      total += len(samples)
+      failed = sum(count for status, count in self.statuses[name].iteritems()
+                   if status >= 400 or status == 0)
+      histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+      for seconds in samples:
+        histogram[_bucket(seconds * 1000)] += 1
+      routes[name] = {
+        'requests': len(samples),
+        'throughput': len(samples) / elapsed,
+        'error_rate': float(failed) / len(samples),
+        'statuses': self.statuses[name],
+        'latency': benchmark.summarize(samples),
+        'histogram': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['inf'],
+                              histogram)),
+        'errors': [str(e) for e in self.errors.get(name, [])],
+      }
+    return {
+      'elapsed': elapsed,
+      'requests': total,
+      'throughput': total / elapsed,
+      'routes': routes,
+    }
+
+  def format(self):
+    data = self.to_dict()
+    lines = ['%d requests in %.1f s: %.1f req/s'
+             % (data['requests'], data['elapsed'], data['throughput']),
+             '%-18s %8s %8s %8s %8s %8s %8s' % ('route', 'requests', 'req/s',
+                                                'errors', 'p50 ms', 'p90 ms',
+                                                'p99 ms')]
+    for name, route in sorted(data['routes'].iteritems()):
+      latency = route['latency']
+      lines.append('%-18s %8d %8.1f %7.1f%% %8.1f %8.1f %8.1f'
+                   % (name, route['requests'], route['throughput'],
+                      route['error_rate'] * 100, latency['p50'],
+                      latency['p90'], latency['p99']))
+    return '\n'.join(lines)
+
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+  def redirect_request(self, *args, **kwargs):
+    return None
+
+
+class LoadTest(object):
+  '''Sends requests from mix (RequestSpec list) with concurrency threads
+  until requests are sent or duration (seconds) is over. If base_url is
+  set, requests go to that server; else they are sent to app in process.'''
+  def __init__(self, mix, app=None, base_url=None, concurrency=10,
+               requests=1000, duration=None):
+    if app is None and base_url is None:
+      raise ValueError('app or base_url must be set.')
+    self.mix = mix
+    self.app = app
+    self.base_url = base_url
+    self.concurrency = concurrency
+    self.requests = requests
+    self.duration = duration
+    self._weighted = []
+    for spec in mix:
+      self._weighted += [spec] * spec.weight
+    self._sequence = itertools.count()
+    self._lock = threading.Lock()
+
+  def _next(self):
+    with self._lock:
+      n = self._sequence.next()
+    if self.requests and n >= self.requests:
+      return None, None
+    if self.deadline and time.time() > self.deadline:
+      return None, None
+    return n, random.choice(self._weighted)
+
+  def _send_wsgi(self, state, method, path, body, content_type):
+    request = webapp2.Request.blank(path)
+    request.method = method
+    if not body is None:
+      request.body = body
+      request.content_type = content_type
+    response = request.get_response(self.app)
+    return response.status_int
+
+  def _send_http(self, state, method, path, body, content_type):
+    opener = state.get('opener', None)
+    if opener is None:
+      opener = state['opener'] = urllib2.build_opener(
+        _NoRedirect(), urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+    request = urllib2.Request(urlparse.urljoin(self.base_url, path), body)
+    request.get_method = lambda: method
+    if content_type:
+      request.add_header('Content-Type', content_type)
+    try:
+      response = opener.open(request)
+      response.read()
+      return response.getcode()
+    except urllib2.HTTPError, e:
+      return e.code
+
+  def _worker(self, report):
+    send = self._send_http if self.base_url else self._send_wsgi
+    state = {}
+    while True:
+      n, spec = self._next()
+      if spec is None:
+        return
+      path, body, content_type = spec.build(n)
+      started = time.time()
+      try:
+        status = send(state, spec.method, path, body, content_type)
+        error = None
+      except Exception, e:
+        status = 0
+        error = '%s: %s' % (e.__class__.__name__, e)
+      report.record(spec.name, time.time() - started, status, error)
+
+  def run(self):
+    '''Runs the load test and returns a Report.'''
+    report = Report()
+    report.started = time.time()
+    self.deadline = None
+    if self.duration:
+      self.deadline = report.started + self.duration
+    threads = [threading.Thread(target=self._worker, args=(report,))
+               for unused in range(self.concurrency)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    report.finished = time.time()
+    return report
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Stones load test.')
+  parser.add_argument('--concurrency', type=int, default=10)
+  parser.add_argument('--requests', type=int, default=1000)
+  parser.add_argument('--duration', type=float, default=None,
+                      help='Seconds. Overrides --requests.')
+  parser.add_argument('--provider-latency', type=float, default=0,
+                      help='Seconds added to stub OAuth2 provider calls.')
+  parser.add_argument('--rate-limits', action='store_true',
+                      help='Keep auth handlers rate limits.')
+  parser.add_argument('--output', help='File to write JSON report.')
+  args = parser.parse_args(argv[1:])
+
+  requests = 0 if args.duration else args.requests
+  with benchmark.stubs():
+    with stub_providers(latency=args.provider_latency):
+      item_keys = prepare_default_data()
+      test = LoadTest(default_mix(item_keys),
+                      app=build_app(rate_limits=args.rate_limits),
+                      concurrency=args.concurrency, requests=requests,
+                      duration=args.duration)
+      report = test.run()
+
+  print report.format()
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(report.to_dict(), output, indent=2, sort_keys=True)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
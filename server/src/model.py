@@ -18,20 +18,35 @@
 
 # Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
 
+import base64
 import datetime
 import logging
+import threading
 import traceback
+try:
+  import simplejson as json
+except ImportError:
+  import json
 
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.model import _StructuredGetForDictMixin as ndb_StructuredGetForDictMixin
 from google.appengine.ext.ndb.google_imports import datastore_errors
 from google.appengine.api.users import User
 
+import allocation
+import dates
+from dates import DATETIME_FORMAT, DATE_FORMAT, TIME_FORMAT
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 logger = logging.getLogger(__name__)
 
-DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
-DATE_FORMAT = '%Y-%m-%d'
-TIME_FORMAT = '%H:%M:%S'
+# Repeated values with at least this length are cast with numpy, if it is
+# installed.
+BULK_CAST_MIN_SIZE = 64
 
 
 def check_list(value):
@@ -40,6 +55,65 @@ def check_list(value):
                                          ' got %r' % (value,))
 
 
+def _bulk_cast(prop, value, cast, dtype=None, typed=True):
+  '''Casts all repeated values at once. If cast always returns values of
+  the property type (typed), elements are validated one by one only if prop
+  has validator or choices.
+
+  Args:
+    prop: repeated property.
+    value: list of values.
+    cast: function to cast one value.
+    dtype: numpy dtype to cast the whole list with, if numpy is installed.
+    typed: False if cast may return values of other types.'''
+  check_list(value)
+  if not numpy is None and dtype and len(value) >= BULK_CAST_MIN_SIZE:
+    value = numpy.asarray(value, dtype=dtype).tolist()
+  else:
+    value = map(cast, value)
+  if typed and prop._validator is None and prop._choices is None:
+    return value
+  return [prop._do_validate(v) for v in value]
+
+
+def _csv_value(value):
+  '''Returns a single property value as a CSV cell (unicode).'''
+  if value is None:
+    return u''
+  if isinstance(value, datetime.datetime):
+    return unicode(dates.format_datetime(value))
+  if isinstance(value, datetime.date):
+    return unicode(dates.format_date(value))
+  if isinstance(value, datetime.time):
+    return unicode(dates.format_time(value))
+  if isinstance(value, ndb.Key):
+    return unicode(value.urlsafe())
+  if isinstance(value, ndb.GeoPt):
+    return u'%s,%s' % (value.lat, value.lon)
+  if isinstance(value, User):
+    return unicode(value.email())
+  if isinstance(value, ndb.Model):
+    return json.dumps(value.to_dict(), default=_csv_value)
+  if isinstance(value, (dict, list, tuple)):
+    return json.dumps(value, default=_csv_value)
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  return unicode(value)
+
+
+def get_for_csv(prop, entity):
+  '''Returns the value of prop in entity as a CSV cell. Works with
+  properties without _get_for_csv, e. g. dynamic properties of Expando.'''
+  if hasattr(prop, '_get_for_csv'):
+    return prop._get_for_csv(entity)
+  value = prop._get_value(entity)
+  if value is None:
+    return u''
+  if prop._repeated:
+    return u', '.join([_csv_value(v) for v in value])
+  return _csv_value(value)
+
+
 class _SetFromDictPropertyMixin(object):
   '''Mixin to add "from_dict" functionality.'''
   def _set_from_dict(self, value):
@@ -49,6 +123,19 @@ class _SetFromDictPropertyMixin(object):
       return [self._do_validate(v) for v in value]
     return self._do_validate(value)
 
+  def _get_for_csv(self, instance):
+    '''Returns the value in instance as a CSV cell. Repeated values are
+    joined by ", ".'''
+    value = self._get_value(instance)
+    if value is None:
+      return u''
+    if self._repeated:
+      return u', '.join([self._csv_cell(v) for v in value])
+    return self._csv_cell(value)
+
+  def _csv_cell(self, value):
+    return _csv_value(value)
+
 
 class GenericProperty(ndb.GenericProperty, _SetFromDictPropertyMixin):
   '''GenericProperty modified.'''
@@ -63,9 +150,7 @@ class IntegerProperty(ndb.IntegerProperty, _SetFromDictPropertyMixin):
   def _set_from_dict(self, value):
     '''Returns a proper value to property but not sets it.'''
     if self._repeated:
-      check_list(value)
-      value = [int(val) for val in value]
-      return [self._do_validate(v) for v in value]
+      return _bulk_cast(self, value, int, 'int64')
     return self._do_validate(int(value))
 
 
@@ -74,9 +159,7 @@ class FloatProperty(ndb.FloatProperty, _SetFromDictPropertyMixin):
   def _set_from_dict(self, value):
     '''Returns a proper value to property but not sets it.'''
     if self._repeated:
-      check_list(value)
-      value = [float(val) for val in value]
-      return [self._do_validate(v) for v in value]
+      return _bulk_cast(self, value, float, 'float64')
     return self._do_validate(float(value))
 
 
@@ -90,9 +173,7 @@ class BooleanProperty(ndb.BooleanProperty, _SetFromDictPropertyMixin):
       return bool(val)
 
     if self._repeated:
-      check_list(value)
-      value = [cast(val) for val in value]
-      return [self._do_validate(v) for v in value]
+      return _bulk_cast(self, value, cast)
     return self._do_validate(cast(value))
 
 
@@ -110,6 +191,9 @@ class BlobProperty(ndb.BlobProperty, _SetFromDictPropertyMixin):
       return [self._do_validate(cast(v)) for v in value]
     return self._do_validate(cast(value))
 
+  def _csv_cell(self, value):
+    return unicode(base64.b64encode(value))
+
 
 class JsonProperty(ndb.JsonProperty, _SetFromDictPropertyMixin):
   '''JsonProperty modified.'''
@@ -120,21 +204,25 @@ class DateProperty(ndb.DateProperty, _SetFromDictPropertyMixin):
   def _set_from_dict(self, value):
     def cast(val):
       if isinstance(val, basestring):
-        val = datetime.datetime.strptime(val, DATE_FORMAT)
-        val = val.date()
+        val = dates.parse_date(val)
       return val
 
-      if self._repeated:
-        return [self._do_validate(cast(value)) for v in value]
+    if self._repeated:
+      return _bulk_cast(self, value, cast, typed=False)
     return self._do_validate(cast(value))
 
 
 class DateTimeProperty(ndb.DateTimeProperty, _SetFromDictPropertyMixin):
   ''''DateTimeProperty modified.'''
   def _set_from_dict(self, value):
-    if isinstance(value, basestring):
-      value = datetime.datetime.strptime(value, DATETIME_FORMAT)
-    return self._do_validate(value)
+    def cast(val):
+      if isinstance(val, basestring):
+        val = dates.parse_datetime(val)
+      return val
+
+    if self._repeated:
+      return _bulk_cast(self, value, cast, typed=False)
+    return self._do_validate(cast(value))
 
 
 class TimeProperty(ndb.TimeProperty, _SetFromDictPropertyMixin):
@@ -142,12 +230,11 @@ class TimeProperty(ndb.TimeProperty, _SetFromDictPropertyMixin):
   def _set_from_dict(self, value):
     def cast(val):
       if isinstance(val, basestring):
-        value = datetime.datetime.strptime(val, TIME_FORMAT)
-        value = val.time()
+        val = dates.parse_time(val)
       return val
 
     if self._repeated:
-      return [self._do_validate(cast(v)) for v in value]
+      return _bulk_cast(self, value, cast, typed=False)
     return self._do_validate(cast(value))
 
 
@@ -212,8 +299,41 @@ class ComputedProperty(ndb.ComputedProperty, _SetFromDictPropertyMixin):
     return None
 
 
+class GeoHashProperty(ComputedProperty):
+  '''Geohash prefixes of the values of a GeoPtProperty. See stones.geo.'''
+  def __init__(self, geo_prop, **kwds):
+    # Imported here, geo is loaded only by models with geo_index.
+    import geo
+    super(GeoHashProperty, self).__init__(
+      lambda entity: geo.prefixes(geo_prop._get_value(entity)),
+      repeated=True, **kwds)
+    self._geo_prop = geo_prop
+
+
 class GeoPtProperty(ndb.GeoPtProperty, _SetFromDictPropertyMixin):
-  '''GeoPtProperty modified.'''
+  '''GeoPtProperty modified.
+
+  If geo_index is True, a GeoHashProperty named "<name>_geohash" is added to
+  the model, to query by radius or bounding box (see stones.geo). It is
+  written on put: entities stored before geo_index was set are not found
+  until they are put again (see stones.geo.rebuild_geo_index).'''
+  def __init__(self, *args, **kwds):
+    self._geo_index = kwds.pop('geo_index', False)
+    super(GeoPtProperty, self).__init__(*args, **kwds)
+    self._geo_hash_property = None
+
+  def _fix_up(self, cls, code_name):
+    super(GeoPtProperty, self)._fix_up(cls, code_name)
+    if not self._geo_index:
+      return
+    name = '%s_geohash' % code_name
+    prop = GeoHashProperty(self, name='%s_geohash' % self._name)
+    setattr(cls, name, prop)
+    # Added while the model properties are being fixed up.
+    prop._fix_up(cls, name)
+    cls._properties[prop._name] = prop
+    cls._has_repeated = True
+    self._geo_hash_property = prop
   def _set_from_dict(self, value):
     def cast(val):
       if isinstance(val, (list, tuple, frozenset)):
@@ -244,6 +364,13 @@ class _StructuredSetFromDictMixin(object):
                                              % (value,))
       return self._modelclass.from_dict(value)
 
+  def _get_for_csv(self, instance):
+    '''Returns the value in instance as a JSON CSV cell.'''
+    value = self._get_value(instance)
+    if value is None:
+      return u''
+    return _csv_value(value)
+
 
 class StructuredProperty(ndb.StructuredProperty, _StructuredSetFromDictMixin):
   '''StructuredProperty modified.'''
@@ -263,8 +390,158 @@ def get_prop(prop_name, properties):
   logger.warning('%s attribute not found.' % prop_name)
 
 
+# Values passed from pre to post hooks, by thread. See
+# Model._keep_for_post_hook.
+_hook_values = threading.local()
+
+
 class Model(ndb.Model):
   '''New Model "from_dict" capable.'''
+  # Properties whose stored values are kept when the entity is loaded, so put
+  # hooks can find out what changed. See _get_snapshot.
+  _tracked_properties = ()
+  # Shards of the counter of entities of this model. 0 if not counted. See
+  # stones.counters.
+  _counter_shards = 0
+  # Properties (code names) whose values are counted too.
+  _counted_properties = ()
+  # Properties (code names) indexed for full text search. See
+  # stones.fulltext.
+  _search_fields = ()
+  # If True, changes are logged for the change feed. See stones.changes.
+  _change_log = False
+  # If True, changes are notified to connected clients. See stones.push.
+  _push_changes = False
+
+  @classmethod
+  def _from_pb(cls, pb, *args, **kwargs):
+    ent = super(Model, cls)._from_pb(pb, *args, **kwargs)
+    ent._take_snapshot()
+    return ent
+
+  def _take_snapshot(self):
+    '''Keeps current values of tracked properties as the stored ones.'''
+    snapshot = {}
+    for name in self._tracked_properties:
+      value = getattr(self, name, None)
+      if isinstance(value, list):
+        value = list(value)
+      snapshot[name] = value
+    self._snapshot = snapshot
+    if not self._projection:
+      self._reference_snapshot = self._reference_state()
+      self._display_snapshot = self._display_state()
+      if self._counter_shards:
+        self._count_snapshot = self._count_state()
+
+  def _set_stored(self, stored):
+    '''Takes the snapshots of stored, the entity of the same key read
+    beforehand (None if there is none), as those of this built entity, so
+    its put hooks do not read it again.'''
+    if stored is None:
+      if self._counter_shards:
+        self._count_snapshot = set()
+      return
+    for name in ('_snapshot', '_reference_snapshot', '_display_snapshot',
+                 '_count_snapshot'):
+      if hasattr(stored, name):
+        setattr(self, name, getattr(stored, name))
+
+  def _reference_state(self):
+    '''Returns the set of (property name, urlsafe key) of the references
+    whose display is kept fresh (refresh_display).'''
+    state = set()
+    for prop in self._properties.itervalues():
+      if not isinstance(prop, ReferenceProperty) or \
+          not prop._refresh_display:
+        continue
+      values = prop._get_value(self)
+      if values is None:
+        continue
+      if not prop._repeated:
+        values = [values]
+      for value in values:
+        if isinstance(value, _ReferenceModel) and value.urlsafe_key:
+          state.add((prop._name, value.urlsafe_key))
+    return state
+
+  def _display_state(self):
+    '''Returns the displays of this entity for the properties referencing
+    its kind with refresh_display, by property id.'''
+    props = _refreshed_displays.get(self._get_kind(), None)
+    if not props:
+      return {}
+    return dict((id(prop), prop._get_display(self)) for prop in props)
+
+  def _update_reference_index(self):
+    '''Updates the backlinks of references with refresh_display and, if the
+    display of this entity changed, enqueues the refresh of references to
+    it. See stones.references.'''
+    # Imported here, references imports this module.
+    import references
+    current = self._reference_state()
+    previous = getattr(self, '_reference_snapshot', set())
+    if current != previous:
+      references.update_backlinks(self.key, current - previous,
+                                  previous - current)
+    self._reference_snapshot = current
+
+    displays = self._display_state()
+    before = getattr(self, '_display_snapshot', None)
+    if displays and not before is None and displays != before:
+      references.enqueue_refresh(self.key)
+    self._display_snapshot = displays
+
+  def _count_state(self):
+    '''Returns the set of names of the counters this entity counts in.'''
+    # Imported here, counters imports this module.
+    import counters
+    kind = self._get_kind()
+    state = set([counters.counter_name(kind)])
+    for name in self._counted_properties:
+      prop = get_prop(name, self._properties)
+      values = prop._get_value(self)
+      if not prop._repeated:
+        values = [values]
+      for value in values:
+        if not value is None:
+          state.add(counters.counter_name(kind, prop._name, value))
+    return state
+
+  def _update_counters(self):
+    '''Counts this entity in the counters of its current values and
+    discounts it from those of its stored ones.'''
+    import counters
+    previous = getattr(self, '_count_snapshot', None) or set()
+    current = self._count_state()
+    counters.update_counts(self.key, current - previous, previous - current,
+                           self._counter_shards)
+    self._count_snapshot = current
+
+  def _get_snapshot(self, name, default=None):
+    '''Returns the stored value of a tracked property or default if entity
+    has not been loaded or saved yet.'''
+    return getattr(self, '_snapshot', {}).get(name, default)
+
+  @classmethod
+  def _keep_for_post_hook(cls, key, name, value):
+    '''Keeps value, e. g. the entity loaded by _pre_delete_hook, for the
+    post hook of the same call. See _take_from_pre_hook.'''
+    values = _hook_values.__dict__.setdefault('values', {})
+    values.setdefault((key, name), []).append(value)
+
+  @classmethod
+  def _take_from_pre_hook(cls, key, name, default=None):
+    '''Returns the value kept by _keep_for_post_hook, or default.'''
+    values = getattr(_hook_values, 'values', {})
+    kept = values.get((key, name), None)
+    if not kept:
+      return default
+    value = kept.pop(0)
+    if not kept:
+      del values[(key, name)]
+    return value
+
   def __unicode__(self):
     if hasattr(self, 'display'):
       if self.display is None:
@@ -319,6 +596,17 @@ class Model(ndb.Model):
   def _pre_put_hook(self):
     '''Determines if any inner ReferenceProperty must be saved after save
     the entity.'''
+    if self._counter_shards and self._has_complete_key() and \
+        getattr(self, '_count_snapshot', None) is None:
+      if getattr(self, '_allocated_key', None) == self.key:
+        # Key allocated by _prepare_references: nothing stored yet.
+        self._count_snapshot = set()
+      else:
+        # Not loaded: it may overwrite a stored entity, counted already.
+        # Read before the put is issued, or it could read this put.
+        stored = self.key.get(use_cache=False, use_memcache=False)
+        self._count_snapshot = stored._count_state() \
+          if not stored is None else set()
     self._unsaved_references = []
     for unused, prop in self._properties.iteritems():
       if isinstance(prop, ReferenceProperty):
@@ -326,20 +614,38 @@ class Model(ndb.Model):
         if prop._repeated:
           for v_index, value in enumerate(prop_value):
             if not value is None:
-              if not value.urlsafe_key and prop._original[v_index]:
+              if not value.urlsafe_key and \
+                  prop._get_original(self)[v_index]:
                 self._unsaved_references.append(prop)
                 break
         else:
           value = prop_value
           if not value is None:
             urlsafe_key = value.urlsafe_key
-            if not urlsafe_key and prop._original:
+            if not urlsafe_key and prop._get_original(self):
               # we need to save it after save the entity.
               self._unsaved_references.append(prop)
 
   def _post_put_hook(self, future):
-    '''Saves the unsaved references.'''
-    if not self._unsaved_references:
+    '''Saves the unsaved references, keeps the reference index, counters,
+    search index and change log, and notifies the change.'''
+    if future.get_exception() is None:
+      self._update_reference_index()
+      if self._counter_shards:
+        self._update_counters()
+      if self._search_fields:
+        # Imported here, only searched models load the Search API.
+        import fulltext
+        fulltext.enqueue_index(self.key)
+      if self._change_log:
+        # Imported here, changes imports this module.
+        import changes
+        changes.log_change(self.key)
+      if self._push_changes:
+        # Imported here, only models with _push_changes start the broker.
+        import push
+        push.publish_change(self.key)
+    if not getattr(self, '_unsaved_references', None):
       return
 
     self._save_again = False
@@ -347,7 +653,7 @@ class Model(ndb.Model):
     saved_originals = []
     for prop in self._unsaved_references:
       prop_value = prop._get_value(self)
-      prop_original = prop._original
+      prop_original = prop._get_original(self)
       if prop._repeated:
         inner_originals = []  # to hold original entity from each value
         for v_index, value in enumerate(prop_value):
@@ -369,13 +675,14 @@ class Model(ndb.Model):
         value = prop_value
         if not value.urlsafe_key:
           if prop._allow_new:
-            original_args = prop._original._to_dict()
+            original_args = prop_original._to_dict()
             if prop._is_child:
-              prop._original = prop._original_class(parent=self_key,
-                                                    **original_args)
+              prop_original = prop._original_class(parent=self_key,
+                                                   **original_args)
             else:
-              prop._original = prop._original_class(**original_args)
-            saved_originals.append(prop._original.put_async())
+              prop_original = prop._original_class(**original_args)
+            prop._set_original(self, prop_original)
+            saved_originals.append(prop_original.put_async())
 
     for index, reference_future in enumerate(saved_originals):
       # we are going to manipulate the first property always until
@@ -406,10 +713,119 @@ class Model(ndb.Model):
       if self._save_again:
         self.put_async()
 
+  @classmethod
+  def _pre_delete_hook(cls, key):
+    '''Reads the counted values of the entity of key, to discount it once
+    deleted.'''
+    if not cls._counter_shards:
+      return
+    entity = key.get(use_cache=False, use_memcache=False)
+    if not entity is None:
+      cls._keep_for_post_hook(key, 'count_state', entity._count_state())
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    '''Discounts the entity of key, if counted, removes it from the search
+    index, logs its deletion and notifies it.'''
+    state = None
+    if cls._counter_shards:
+      state = cls._take_from_pre_hook(key, 'count_state')
+    if not future.get_exception() is None:
+      return
+    if not state is None:
+      # Imported here, counters imports this module.
+      import counters
+      counters.update_counts(key, set(), state, cls._counter_shards)
+    if cls._search_fields:
+      import fulltext
+      fulltext.enqueue_index(key)
+    if cls._change_log:
+      import changes
+      changes.log_change(key, deleted=True)
+    if cls._push_changes:
+      import push
+      push.publish_change(key, deleted=True)
+
+  def _prepare_references(self, allocator=None):
+    '''Gives complete keys, allocated by allocator (the global
+    KeyAllocator by default), to this entity and to the new entities of its
+    references (children of this entity if is_child) and points the
+    references to them. Returns the entities to put, this one first. Put
+    together, no entity is put again by _post_put_hook.'''
+    allocator = allocator or allocation.allocator
+    if not self._has_complete_key():
+      parent = namespace = None
+      if not self.key is None:
+        # Incomplete key: keeps its parent and namespace.
+        parent, namespace = self.key.parent(), self.key.namespace()
+      self.key = allocator.allocate_key(self.__class__, parent=parent,
+                                        namespace=namespace)
+      self._allocated_key = self.key
+
+    props = []
+    new_entities = {}
+    for prop in self._properties.itervalues():
+      if not isinstance(prop, ReferenceProperty) or not prop._allow_new:
+        continue
+      values = prop._get_value(self)
+      if values is None:
+        continue
+      if not prop._repeated:
+        values = [values]
+      found = False
+      for value in values:
+        if isinstance(value, ndb.Model) and \
+            not isinstance(value, _ReferenceModel) and \
+            not value._has_complete_key():
+          if prop._is_child:
+            parent, namespace = self.key, None
+          elif not value.key is None:
+            parent, namespace = value.key.parent(), value.key.namespace()
+          else:
+            parent = namespace = None
+          new_entities.setdefault((value.__class__, parent, namespace),
+                                  []).append(value)
+          found = True
+      if found:
+        props.append(prop)
+
+    entities = [self]
+    for (modelclass, parent, namespace), values in new_entities.iteritems():
+      keys = allocator.allocate_keys(modelclass, len(values), parent=parent,
+                                     namespace=namespace)
+      for value, key in zip(values, keys):
+        value.key = key
+        if isinstance(value, Model):
+          value._allocated_key = key
+          entities.extend(value._prepare_references(allocator))
+        else:
+          entities.append(value)
+
+    for prop in props:
+      value = prop._get_value(self)
+      if prop._repeated:
+        prop._set_value(self, [prop._to_base_type(v) for v in value])
+      else:
+        prop._set_value(self, prop._to_base_type(value))
+    return entities
+
+  def put_with_references(self, **ctx_options):
+    '''Puts the entity and the new entities of its references with a single
+    put_multi. Returns the key.'''
+    return ndb.put_multi(self._prepare_references(), **ctx_options)[0]
+
+  def put_with_references_async(self, **ctx_options):
+    '''Async version of put_with_references. Returns the future of the entity
+    key; the other entities are put with it.'''
+    return ndb.put_multi_async(self._prepare_references(), **ctx_options)[0]
+
   def to_dict(self):
     '''Returns a dict with special keys $$key$$ and $$id$$ added to
     entity values dict.'''
     _to_dict = super(Model, self).to_dict()
+    for prop in self._properties.itervalues():
+      if isinstance(prop, GeoHashProperty):
+        _to_dict.pop(prop._code_name, None)
     if self._has_complete_key():
       _to_dict['$$id$$'] = self.key.id()
       _to_dict['$$key$$'] = self.key.urlsafe()
@@ -487,11 +903,15 @@ class _ReferenceModel(Model):
   display = StringProperty('d')
 
 
+# Properties with refresh_display by kind of the entities they reference.
+_refreshed_displays = {}
+
+
 class ReferenceProperty(StructuredProperty):
   '''Property to store references to real entities with a description of the
   entity and string that represents urlsafe key.'''
   def __init__(self, modelclass=None, display=None, is_child=True,
-               allow_new=True, **kwds):
+               allow_new=True, refresh_display=False, **kwds):
     '''Constructor.
     Args:
       modelclass: Entity model class. If no modelclass is provided, we assume
@@ -506,6 +926,9 @@ class ReferenceProperty(StructuredProperty):
         to main entity; else, no parent is set. If True, allow_new is set to
         True.
       allow_new: If True, we allow the creation of new entities.
+      refresh_display: If True, a reverse index of the references is kept
+        and, when the display of a referenced entity changes, a task
+        rewrites it in the entities referencing it.
 
     E. g.:
       class MyReferencedModel(Model):
@@ -535,11 +958,9 @@ class ReferenceProperty(StructuredProperty):
     super(ReferenceProperty, self).__init__(_ReferenceModel, **kwds)
     self._display = display
     self._original_class = modelclass
-    self._original = None
-    if self._repeated:
-      self._original = []
     self._is_child = is_child
     self._allow_new = allow_new or is_child
+    self._refresh_display = refresh_display
 
   def _fix_up(self, cls, code_name):
     super(ReferenceProperty, self)._fix_up(cls, code_name)
@@ -556,9 +977,30 @@ class ReferenceProperty(StructuredProperty):
           not callable(self._display):
         raise datastore_errors.BadValueError('Display argument is not valid.')
 
+    if self._refresh_display:
+      props = _refreshed_displays.setdefault(
+        self._original_class._get_kind(), [])
+      if not [p for p in props if p is self]:
+        props.append(self)
+
   def _set_value(self, entity, value):
     super(ReferenceProperty, self)._set_value(entity, value)
-    self._original = value
+    self._set_original(entity, value)
+
+  def _get_original(self, entity):
+    '''Returns the value last set in entity, i. e. the entities to be
+    referenced before they are converted to _ReferenceModel. It is kept in
+    the entity, not in the property, which is shared by all entities of the
+    model in all threads.'''
+    default = [] if self._repeated else None
+    return getattr(entity, '_reference_originals', {}).get(self._name,
+                                                           default)
+
+  def _set_original(self, entity, value):
+    originals = getattr(entity, '_reference_originals', None)
+    if originals is None:
+      originals = entity._reference_originals = {}
+    originals[self._name] = value
 
   def _validate(self, value):
     if isinstance(value, dict):
@@ -578,16 +1020,19 @@ class ReferenceProperty(StructuredProperty):
       return value
 
     urlsafe_key = ''
-    display = ''
     if not value.key is None:
       urlsafe_key = value.key.urlsafe()
+    return _ReferenceModel(urlsafe_key=urlsafe_key,
+                           display=self._get_display(value))
+
+  def _get_display(self, entity):
+    '''Returns the display of a referenced entity.'''
     if isinstance(self._display, ndb.StringProperty) or \
         isinstance(self._display, ndb.TextProperty):
-      display = getattr(value, self._display._code_name)
+      return getattr(entity, self._display._code_name)
     elif callable(self._display):
-      display = self._display(value)
-
-    return _ReferenceModel(urlsafe_key=urlsafe_key, display=display)
+      return self._display(entity)
+    return ''
 
   def _from_base_type(self, value):
     return value
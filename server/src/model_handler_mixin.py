@@ -19,13 +19,25 @@
 # Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
 
 import logging
+import time
 
 import webapp2_extras
-from .model import Key
+from .model import Key, datastore_errors
 
 from google.appengine.ext import ndb
 
 from .utils import *
+import query_stats
+import export
+import importer
+import writebehind
+import references
+import planner
+import scan
+import counters
+import geo
+import fulltext
+import changes
 
 from google.appengine.ext.ndb import Property
 from google.appengine.datastore.datastore_query import PropertyOrder
@@ -49,6 +61,32 @@ class NoEntityError(Error):
   '''Occurs when is imposible to find an entity.'''
 
 
+class BadFilterError(Error):
+  '''Occurs when a filter param has an invalid value.'''
+
+
+def _equality_only(qry):
+  '''Returns True if qry has no filters but equality ones.'''
+  nodes = qry.filters
+  if nodes is None:
+    return True
+  if isinstance(nodes, ndb.ConjunctionNode):
+    nodes = list(nodes)
+  else:
+    nodes = [nodes]
+  return all(isinstance(node, ndb.FilterNode) and node._opsymbol == '='
+             for node in nodes)
+
+
+def _property_values(entity):
+  '''Returns the values of entity properties by name, lists copied.'''
+  rv = {}
+  for name, prop in entity._properties.iteritems():
+    value = prop._get_value(entity)
+    rv[name] = list(value) if isinstance(value, list) else value
+  return rv
+
+
 def get_entity_by_key(key):
   '''Retrieves an entity by a key.'''
   try:
@@ -72,6 +110,50 @@ class ModelHandlerMixin(object):
   # model properties to be retrieved in GET responses
   # it should be strings, e.g., 'myproperty'
   GET_properties = []
+  # If True, GET queries are recorded in stones.query_stats.
+  record_query_stats = True
+  # Entities fetched by batch in exports (GET with "format" param).
+  export_batch_size = export.BATCH_SIZE
+  # Properties (code names) exported. All if empty.
+  export_properties = []
+  # Seconds an export in a request can last. When done, the cursor to resume
+  # is returned in X-Export-Cursor header.
+  export_seconds = 50
+  # Key ranges read at the same time in exports without sort orders nor
+  # inequality filters. 0 reads the query sequentially (and the export can
+  # be resumed; parallel exports which stop early answer with
+  # X-Export-Incomplete header instead of X-Export-Cursor). See stones.scan.
+  export_parallelism = 0
+  # Key ranges in which those exports are split.
+  export_shards = scan.SHARDS
+  # Rows put by batch in imports (POST with NDJSON or CSV body).
+  import_batch_size = importer.BATCH_SIZE
+  # Batches being put at the same time in imports.
+  import_max_in_flight = importer.MAX_IN_FLIGHT
+  # Seconds an import in a request can last. Then it is resumed by sending
+  # the same body with "job" param.
+  import_seconds = 50
+  # If True, POST and PUT build the entity with create_model or update_model,
+  # enqueue the write and return 202 with the entity key and a "$$write$$"
+  # token to check the write status. _post_post_hook and _post_put_hook get
+  # the entity before it is written. See stones.writebehind.
+  write_behind = False
+  # Pull queue of write-behind writes.
+  write_behind_queue = writebehind.QUEUE
+  # Max nesting of references inlined by "expand" param in GET.
+  expand_max_depth = references.MAX_EXPAND_DEPTH
+  # Composite indexes available to the query planner.
+  index_yaml = 'index.yaml'
+  # Max entities read to post-filter a GET.
+  post_filter_max_scan = 5000
+  # If True and the model is counted (see stones.counters), GET queries
+  # without parent and with no filter or one equality filter on a counted
+  # property return the total number of results in X-Total-Count header.
+  total_count = False
+  # Changes by page of GET with "since" param. See stones.changes.
+  sync_page_size = changes.PAGE_SIZE
+  # QueryPlan of the filters of request params, set by build_filters.
+  query_plan = None
 
   def _pre_get_hook(self):
     '''To run before GET.'''
@@ -81,23 +163,124 @@ class ModelHandlerMixin(object):
     result: Array with found entities to be returned.'''
     return result
 
-  def build_filters(self, kwargs):
-    '''Builds filters to retrieve entities.'''
+  def parse_filters(self, kwargs):
+    '''Returns the FilterSpecs of request params. See stones.planner for the
+    grammar. Params which are not model properties are ignored.'''
     params = kwargs.copy()
     params.update(self.request.params)
 
-    qry_params = []
+    specs = []
     for param_key, param_value in params.iteritems():
-      if param_value:
-        try:
-          attr = getattr(self.model, param_key)
-          qry_params.append(attr == attr._set_from_dict(param_value))
-        except:
-          # i don't take care about non _set_from_dict properties and
-          # inexistent model properties
-          pass
+      if not param_value:
+        continue
+      name, op = planner.split_param(param_key)
+      attr = getattr(self.model, name, None)
+      if not isinstance(attr, Property) or \
+          not hasattr(attr, '_set_from_dict') or \
+          isinstance(attr, ndb.ComputedProperty):
+        continue
+      try:
+        specs.append(planner.FilterSpec(attr, op, param_value))
+      except (ValueError, TypeError, datastore_errors.BadValueError), e:
+        raise BadFilterError('Invalid filter %s=%s: %s'
+                             % (param_key, param_value, e))
+    return specs
 
-    return qry_params
+  def build_filters(self, kwargs):
+    '''Builds filters to retrieve entities. Filters of request params which
+    the datastore can serve are returned; the rest are applied to results
+    by the QueryPlan left in self.query_plan. Override it to add filters,
+    e. g. to restrict results to the current user: the returned filters are
+    always run by the datastore.'''
+    specs = self.parse_filters(kwargs)
+    self.query_plan = self.plan_query(specs, self.build_order(), kwargs)
+    return self.query_plan.filter_nodes()
+
+  def extra_filters(self, filters):
+    '''Returns the filters, from build_filters, which are not of request
+    params (added by an override).'''
+    if self.query_plan is None:
+      return filters
+    nodes = self.query_plan.filter_nodes()
+    return [node for node in filters if not node in nodes]
+
+  def restrict_entities(self, entities, filters, kwargs):
+    '''Returns the entities (not read by a query, like search and sync
+    results) which also pass filters, checking them with the datastore.'''
+    if not filters or not entities:
+      return entities
+    qry = self.create_query(filters, [], kwargs)
+    keys = [entity.key for entity in entities]
+    # Datastore allows up to 30 values in an IN filter.
+    futures = [qry.filter(self.model.key.IN(keys[i:i + 30])).fetch_async(
+               keys_only=True) for i in xrange(0, len(keys), 30)]
+    allowed = set()
+    for future in futures:
+      allowed.update(future.get_result())
+    return [entity for entity in entities if entity.key in allowed]
+
+  def plan_query(self, specs, order, kwargs):
+    '''Returns the QueryPlan of filters and order. See stones.planner.'''
+    return planner.plan_query(self.model, specs, order,
+                              ancestor='parent' in kwargs,
+                              indexes=planner.load_indexes(self.index_yaml))
+
+  def sync_entities(self, token):
+    '''Renders the changes since sync token (see stones.changes): a dict
+    with "changed" entities, "deleted" urlsafe keys, "since" token of the
+    next sync and "more", True if there are more changes to read now.'''
+    self.query_plan = None
+    try:
+      extra = self.extra_filters(self.build_filters({}))
+      rv = changes.changes_since(self.model, token,
+                                 page_size=self.sync_page_size)
+    except changes.ExpiredTokenError, e:
+      return self.abort(410, unicode(e))
+    except ValueError, e:
+      return self.abort(400, unicode(e))
+    except BadFilterError, e:
+      return self.abort(400, unicode(e))
+    # Filters of request params do not apply to syncs, those of
+    # build_filters overrides do.
+    rv['changed'] = self._post_get_hook(
+      self.restrict_entities(rv['changed'], extra, {}))
+    return self.render_json(rv)
+
+  def search_entities(self, query_string, kwargs):
+    '''Returns the entities matching query_string (see stones.fulltext),
+    best matches first, which pass the filters of request params. "l" limits
+    the number of results and "cursor" resumes a previous search; the cursor
+    of the next page is returned in X-Search-Cursor header.'''
+    self.query_plan = None
+    extra = self.extra_filters(self.build_filters(kwargs))
+    specs = self.parse_filters(kwargs)
+    limit = self.limit(kwargs.get('l', None)) or fulltext.LIMIT
+    try:
+      keys, cursor = fulltext.search_keys(self.model, query_string,
+                                          limit=limit,
+                                          cursor=kwargs.get('cursor', None))
+    except ValueError, e:
+      raise BadFilterError('Invalid search %s: %s' % (query_string, e))
+    entities = [entity for entity in ndb.get_multi(keys)
+                if not entity is None and
+                  not [s for s in specs if not s.match(entity)]]
+    entities = self.restrict_entities(entities, extra, kwargs)
+    if cursor:
+      self.response.headers['X-Search-Cursor'] = cursor
+    return entities
+
+  def count_total(self, specs, kwargs):
+    '''Returns the total number of entities matching specs, from the model
+    counters, or None if there is no counter for them.'''
+    if not self.model._counter_shards or 'parent' in kwargs:
+      return None
+    if not specs:
+      return counters.count(self.model)
+    if len(specs) == 1 and specs[0].op == 'eq' and \
+        specs[0].prop._code_name in self.model._counted_properties:
+      return counters.count(self.model, specs[0].prop._code_name,
+                            specs[0].values[0])
+    return None
 
   def build_order(self):
     '''Builds entities sorting.'''
@@ -138,6 +321,69 @@ class ModelHandlerMixin(object):
       raise ValueError('Limit should be an integer. Found %s' % limit)
     return limit
 
+  def record_query(self, qry, seconds, results, cursor=False):
+    '''Records query stats if record_query_stats is set.'''
+    if self.record_query_stats:
+      query_stats.collector.record(qry, seconds, results, cursor=cursor)
+
+  def export_entities(self, qry, fmt, kwargs, plan=None):
+    '''Writes query results in format fmt ("csv" or "ndjson") by batches.
+    "cursor" param resumes a previous export and "l" limits the number of
+    entities. If "background" param is set, the export runs in tasks and
+    the ExportJob is returned with status 202. Post-filters of plan are
+    applied to each batch. If export_parallelism is set, queries without
+    sort orders nor inequality filters are read from key ranges in
+    parallel; those cannot be resumed, and X-Export-Incomplete header is
+    set if they stop before the end.'''
+    properties = self.export_properties or None
+    predicate = plan.match if plan and plan.post_filters else None
+    if kwargs.get('background', None):
+      if predicate:
+        return self.abort(400, 'Background exports need filters run by the '
+                          'datastore. Query plan: %s' % plan.describe())
+      job = export.start_export(qry, fmt, properties=properties,
+                                batch_size=self.export_batch_size)
+      self.response.set_status(202)
+      return self.render_json(job.to_dict())
+
+    cursor = kwargs.get('cursor', None) or None
+    writer = export.get_writer(fmt, self.model, properties)
+    limit = self.limit(kwargs.get('l', None))
+    deadline = time.time() + self.export_seconds
+    if self.export_parallelism and not cursor and not qry.orders and \
+        _equality_only(qry):
+      run = export.ScanExport(qry, writer, batch_size=self.export_batch_size,
+                              limit=limit, deadline=deadline,
+                              predicate=predicate, shards=self.export_shards,
+                              parallelism=self.export_parallelism)
+    else:
+      run = export.QueryExport(qry, writer, cursor=cursor,
+                               batch_size=self.export_batch_size,
+                               limit=limit, deadline=deadline,
+                               predicate=predicate)
+    self.response.content_type = writer.content_type
+    self.response.headers['Content-Disposition'] = \
+      'attachment; filename="%s.%s"' % (qry.kind, writer.extension)
+    started = time.time()
+    for chunk in run:
+      self.response.write(chunk)
+    self.record_query(qry, time.time() - started, run.count,
+                      cursor=bool(cursor))
+    if run.more and run.cursor:
+      self.response.headers['X-Export-Cursor'] = run.cursor
+    elif run.more:
+      # Parallel exports stopped by export_seconds cannot be resumed.
+      self.response.headers['X-Export-Incomplete'] = 'true'
+
+  def expand_references(self, entities, expand):
+    '''Returns entities (a list or a single entity) as dicts with the
+    references in expand inlined. See stones.references.'''
+    if isinstance(entities, list):
+      return references.expand_references(entities, expand,
+                                          max_depth=self.expand_max_depth)
+    return references.expand_references([entities], expand,
+                                        max_depth=self.expand_max_depth)[0]
+
   def get(self, **kwargs):
     '''GET verb.
     Returns a list of entities, even if the result is a single entity.
@@ -161,19 +407,66 @@ class ModelHandlerMixin(object):
       entities = self.model.get_by_id(id)
       if not entities:
         return self.abort(404, '%s not found.' % self.model.__class__.__name__)
+    elif 'since' in self.request.params:
+      # "since" is a reserved query parameter to get the changes since a sync
+      # token, "0" for the first sync
+      return self.sync_entities(self.request.get('since'))
+    elif self.model._search_fields and self.request.get('q'):
+      # "q" is a reserved query parameter to search entities by text
+      kwargs.update(self.request.params)
+      try:
+        entities = self.search_entities(self.request.get('q'), kwargs)
+      except BadFilterError, e:
+        return self.abort(400, unicode(e))
     else:
         # No key or id. We need to return entities by query filters.
         kwargs.update(self.request.params)
-        filters = self.build_filters(kwargs)
+        self.query_plan = None
+        try:
+          filters = self.build_filters(kwargs)
+        except BadFilterError, e:
+          return self.abort(400, unicode(e))
         order = self.build_order()
-        qry = self.create_query(filters, order, kwargs)
+        plan = self.query_plan
+        if plan is None:
+          # build_filters override which does not call this one: its filters
+          # are run as they are.
+          plan = self.plan_query([], order, kwargs)
+        # Geo queries are sorted by distance, not by ordering.
+        qry = self.create_query(filters,
+                                order if plan.geo is None else [], kwargs)
+        # "format" is a reserved query parameter to export results as CSV or
+        # NDJSON
+        fmt = kwargs.get('format', None)
+        if fmt in export.FORMATS:
+          self.response.headers['X-Query-Plan'] = plan.describe()
+          return self.export_entities(qry, fmt, kwargs, plan=plan)
         # "l" is a reserved query parameter to limit how many results should be
         # retrieved
         limit = self.limit(kwargs.get('l', None))
-        entities = get_entities(qry, limit).get_result()
+        started = time.time()
+        if plan.geo:
+          entities = geo.fetch_geo(qry, plan, limit,
+                                   max_scan=self.post_filter_max_scan)
+        elif plan.post_filters:
+          entities = planner.fetch_post_filtered(
+            qry, plan, limit, max_scan=self.post_filter_max_scan)
+        else:
+          entities = get_entities(qry, limit).get_result()
+        self.record_query(qry, time.time() - started, len(entities))
+        self.response.headers['X-Query-Plan'] = plan.describe()
+        if self.total_count and not self.extra_filters(filters):
+          total = self.count_total(plan.filters + plan.post_filters, kwargs)
+          if not total is None:
+            self.response.headers['X-Total-Count'] = str(total)
 
     entities = self._post_get_hook(entities)
 
+    # "expand" is a reserved query parameter to inline referenced entities,
+    # e. g. expand=author,parts.author
+    expand = self.request.get('expand')
+    if expand:
+      return self.render_json(self.expand_references(entities, expand))
     return self.render_json(entities)
 
   def _pre_post_hook(self):
@@ -188,16 +481,67 @@ class ModelHandlerMixin(object):
     Specially for build key parents or special key ids.'''
     return self.model.from_dict(model_args)
 
+  def import_entities(self, fmt, kwargs):
+    '''Imports the rows of request body (NDJSON or CSV) with create_model
+    and returns the import report. _pre_post_hook runs once and
+    _post_post_hook for each entity imported. "job" param is an id chosen
+    by the client: sending the same body with the same job resumes a failed
+    or unfinished import.'''
+    job_id = kwargs.get('job', None)
+    if job_id:
+      job = importer.ImportJob.get_or_insert(
+        '%s:%s' % (self.model._get_kind(), job_id),
+        kind=self.model._get_kind(), format=fmt, errors=[])
+    else:
+      job = importer.ImportJob(kind=self.model._get_kind(), format=fmt,
+                               errors=[])
+    if job.status != 'done':
+      self._pre_post_hook()
+      reader = importer.get_reader(fmt, self.request.body_file, self.model)
+      run = importer.Importer(self.model, reader, job,
+                              create=lambda value: self.create_model(**value),
+                              on_put=self._post_post_hook,
+                              batch_size=self.import_batch_size,
+                              max_in_flight=self.import_max_in_flight,
+                              deadline=time.time() + self.import_seconds)
+      job = run.run()
+    if job.status != 'done':
+      self.response.set_status(202)
+    return self.render_json(job.to_dict())
+
+  def enqueue_write(self, op, entity, names=None, references=()):
+    '''Enqueues a write-behind write and answers with 202.'''
+    token = writebehind.enqueue(op, entity, names=names,
+                                references=references,
+                                queue=self.write_behind_queue)
+    self.response.set_status(202)
+    return token
+
   def post(self, **kwargs):
     '''POST verb.
     Returns a new entity created from request body as JSON formatted
-    input'''
+    input. NDJSON or CSV bodies (by content type) are imported in bulk.'''
+    fmt = importer.CONTENT_TYPES.get(self.request.content_type, None)
+    if fmt:
+      kwargs.update(self.request.params)
+      return self.import_entities(fmt, kwargs)
     self._pre_post_hook()
     new_entity_json = self.extract_json()
     new_entity_json.pop('$$key$$', None)
     new_entity_json.pop('$$id$$', None)
     entity = self.create_model(**new_entity_json)
-    entity.put()
+    if self.write_behind:
+      # The entity is written later, but its key (and those of its new
+      # references) are known now.
+      references = entity._prepare_references()[1:]
+      token = self.enqueue_write('post', entity, references=references)
+      self._post_post_hook(entity)
+      rv = entity.to_dict()
+      rv['$$write$$'] = token
+      return self.render_json(rv)
+    # Keys are allocated up front, so new references are written with the
+    # entity in one put_multi.
+    entity.put_with_references()
     self._post_post_hook(entity)
 
     return self.render_json(entity.to_dict())
@@ -223,6 +567,30 @@ class ModelHandlerMixin(object):
     if not key and not id:
       raise NoKeyOrIdError
 
+    if self.write_behind:
+      try:
+        entity_key = Key(urlsafe=key) if key else Key(self.model, id)
+      except ProtocolBufferDecodeError:
+        return self.abort(404, '%s not found.' % self.model.__class__.__name__)
+      entity_json = self.extract_json()
+      entity_json.pop('$$key$$', None)
+      entity_json.pop('$$id$$', None)
+      entity = entity_key.get()
+      if entity is None:
+        # Its creation may not be written yet. The write checks it.
+        entity = self.model(key=entity_key)
+      before = _property_values(entity)
+      self.update_model(entity, **entity_json)
+      references = entity._prepare_references()[1:]
+      # Only the properties changed by update_model are written.
+      names = [name for name, value in _property_values(entity).iteritems()
+               if not name in before or before[name] != value]
+      token = self.enqueue_write('put', entity, names=names,
+                                 references=references)
+      self._post_put_hook(entity)
+      return self.render_json({'$$key$$': entity_key.urlsafe(),
+                               '$$write$$': token})
+
     if key:
       try:
         entity = get_entity_by_key(key)
@@ -222,15 +222,20 @@ class OAuth2Service(object):
   redirect_uri = ''
   scope = []
   display = ''
+  # Where user info is requested.
+  user_info_uri = ''
 
   def __init__(self, client_id, client_secret, request_token_uri,
-               access_token_uri, redirect_uri, scope, display=''):
+               access_token_uri, redirect_uri, scope, display='',
+               user_info_uri=None):
     self.client_id = client_id
     self.client_secret = client_secret
     self.request_token_uri = request_token_uri
     self.access_token_uri = access_token_uri
     self.redirect_uri = redirect_uri
     self.display = display
+    if user_info_uri:
+      self.user_info_uri = user_info_uri
 
     if isinstance(scope, basestring):
       self.scope = scope.split(' ')
@@ -292,14 +297,15 @@ class OAuth2Service(object):
 
 class GoogleOAuth2Service(OAuth2Service):
   '''Google OAuth2 specific service'''
+  user_info_uri = 'https://www.googleapis.com/oauth2/v1/userinfo'
+
   def get_user_info(self, token=None):
     if token is None:
       token = self.token
     else:
       self.token = token
 
-    base_uri = 'https://www.googleapis.com/oauth2/v1/userinfo'
-    response, content = self.make_request(base_uri)
+    response, content = self.make_request(self.user_info_uri)
 
     if not response.status == 200:
       raise OAuth2ServicesError(content)
@@ -310,14 +316,15 @@ class GoogleOAuth2Service(OAuth2Service):
 
 class FacebookOAuth2Service(OAuth2Service):
   '''Facebook OAuth2 specific service'''
+  user_info_uri = 'https://graph.facebook.com/me'
+
   def get_user_info(self, token=None):
     if token is None:
       token = self.token
     else:
       self.token = token
 
-    base_uri = 'https://graph.facebook.com/me'
-    response, content = self.make_request(base_uri)
+    response, content = self.make_request(self.user_info_uri)
 
     if not response.status == 200:
         raise OAuth2ServicesError(content)
@@ -328,6 +335,8 @@ class FacebookOAuth2Service(OAuth2Service):
 
 class LinkedInOAuth2Service(OAuth2Service):
   '''LinkedIn OAuth2 specific service'''
+  user_info_uri = 'https://api.linkedin.com/v1/people/~:(email-address)'
+
   def __init__(self, client_id, client_secret, redirect_uri, **kwargs):
     defaults = {
       'client_id': client_id,
@@ -360,9 +369,8 @@ class LinkedInOAuth2Service(OAuth2Service):
     else:
       self.token = token
 
-    base_uri = 'https://api.linkedin.com/v1/people/'
     params = {'format': 'json'}
-    response, content = self.make_request(base_uri + '~:(email-address)',
+    response, content = self.make_request(self.user_info_uri,
                                           token_param='oauth2_access_token',
                                           params=params)
 
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Filter grammar of GET params and a small query planner.
+
+A param "name__op=value" filters property name with operator op:
+
+  eq (default)  name=value or name__eq=value
+  ne            name__ne=value
+  gt, ge        name__gt=value, name__ge=value
+  lt, le        name__lt=value, name__le=value
+  in            name__in=value1,value2
+  startswith    name__startswith=prefix (string properties)
+  near          name__near=lat,lng,meters (GeoPtProperty)
+  within        name__within=south,west,north,east (GeoPtProperty)
+
+The planner runs in the datastore every filter it can serve with built-in
+indexes or the composite indexes of index.yaml. The others are applied to
+the results (post-filtering). "in" and "ne" filters run as merged
+multi-queries. A near or within filter on a GeoPtProperty with geo_index
+runs as parallel queries by geohash cell (see stones.geo); without geo_index
+it is post-filtered.'''
+
+import logging
+import os
+import threading
+
+from google.appengine.ext import ndb
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore.datastore_query import PropertyOrder
+
+import geo
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['OPERATORS', 'FilterSpec', 'QueryPlan', 'split_param',
+           'load_indexes', 'plan_query', 'fetch_post_filtered']
+
+OPERATORS = ('eq', 'ne', 'gt', 'ge', 'lt', 'le', 'in', 'startswith', 'near',
+             'within')
+# Operators which are inequalities for the datastore.
+INEQUALITY_OPERATORS = ('ne', 'gt', 'ge', 'lt', 'le', 'startswith')
+# Operators on GeoPtProperty areas.
+GEO_OPERATORS = ('near', 'within')
+# Last character of ranges of prefixes.
+PREFIX_END = u'\ufffd'
+ASCENDING = PropertyOrder.ASCENDING
+DESCENDING = PropertyOrder.DESCENDING
+
+
+def split_param(param):
+  '''Returns (property name, operator) of a filter param.'''
+  name, sep, op = param.rpartition('__')
+  if sep and op in OPERATORS:
+    return name, op
+  return param, 'eq'
+
+
+class FilterSpec(object):
+  '''A filter on a model property. Raw values are cast with the property
+  _set_from_dict; ValueError, TypeError or BadValueError are raised if
+  invalid.'''
+  def __init__(self, prop, op, raw):
+    if not op in OPERATORS:
+      raise ValueError('Unknown operator %s.' % op)
+    self.prop = prop
+    self.op = op
+    if op == 'startswith':
+      if not isinstance(prop, (ndb.StringProperty, ndb.TextProperty)):
+        raise ValueError('startswith needs a string property.')
+      self.values = [unicode(raw)]
+    elif op in GEO_OPERATORS:
+      if not isinstance(prop, ndb.GeoPtProperty):
+        raise ValueError('%s needs a GeoPt property.' % op)
+      parse = geo.parse_near if op == 'near' else geo.parse_within
+      self.values = [parse(raw)]
+    elif op == 'in':
+      if isinstance(raw, basestring):
+        raw = raw.split(',')
+      self.values = [self._cast(v) for v in raw]
+    else:
+      self.values = [self._cast(raw)]
+
+  def _cast(self, raw):
+    if self.prop._repeated:
+      return self.prop._set_from_dict([raw])[0]
+    return self.prop._set_from_dict(raw)
+
+  @property
+  def name(self):
+    return self.prop._name
+
+  def is_inequality(self):
+    return self.op in INEQUALITY_OPERATORS
+
+  def is_geo(self):
+    return self.op in GEO_OPERATORS
+
+  def describe(self):
+    return '%s__%s' % (self.prop._code_name, self.op)
+
+  def to_node(self):
+    '''Returns the ndb filter node. Geo filters have none.'''
+    if self.is_geo():
+      raise ValueError('%s filters are not run by the datastore.' % self.op)
+    prop = self.prop
+    value = self.values[0]
+    if self.op == 'eq':
+      return prop == value
+    if self.op == 'ne':
+      return prop != value
+    if self.op == 'gt':
+      return prop > value
+    if self.op == 'ge':
+      return prop >= value
+    if self.op == 'lt':
+      return prop < value
+    if self.op == 'le':
+      return prop <= value
+    if self.op == 'in':
+      return prop.IN(self.values)
+    return ndb.AND(prop >= value, prop < value + PREFIX_END)
+
+  def _match_value(self, value):
+    target = self.values[0]
+    if self.op == 'eq':
+      return value == target
+    if self.op == 'ne':
+      return value != target
+    if self.op == 'in':
+      return value in self.values
+    if value is None:
+      return False
+    if self.op == 'gt':
+      return value > target
+    if self.op == 'ge':
+      return value >= target
+    if self.op == 'lt':
+      return value < target
+    if self.op == 'le':
+      return value <= target
+    return isinstance(value, basestring) and value.startswith(target)
+
+  def _match_geo(self, value):
+    if value is None:
+      return False
+    if self.op == 'near':
+      lat, lon, meters = self.values[0]
+      return geo.distance(lat, lon, value.lat, value.lon) <= meters
+    return geo.in_box(value, *self.values[0])
+
+  def match(self, entity):
+    '''Returns True if entity passes the filter. Like in the datastore, a
+    repeated property passes if any of its values does.'''
+    value = self.prop._get_value(entity)
+    if self.is_geo():
+      if self.prop._repeated:
+        return any(self._match_geo(v) for v in value)
+      return self._match_geo(value)
+    if self.prop._repeated:
+      return any(self._match_value(v) for v in value)
+    return self._match_value(value)
+
+
+class QueryPlan(object):
+  '''Result of plan_query.
+
+  Attributes:
+    filters: FilterSpecs run in the datastore.
+    post_filters: FilterSpecs applied to the results.
+    orders: list of (datastore name, direction).
+    strategy: "datastore", "multi-query" or "geo-cells".
+    geo: near or within FilterSpec run by geohash cells (also in
+      post_filters, for the exact distance), or None.
+    missing_index: True if the datastore query still needs an index which is
+      not in index.yaml.
+    scanned: entities read by fetch_post_filtered.
+    truncated: True if fetch_post_filtered stopped at max_scan.'''
+  def __init__(self, filters, post_filters, orders, missing_index=False,
+               geo=None):
+    self.filters = filters
+    self.post_filters = post_filters
+    self.orders = orders
+    self.missing_index = missing_index
+    self.geo = geo
+    self.scanned = None
+    self.truncated = False
+    multi = [f for f in filters if f.op in ('in', 'ne')]
+    if geo:
+      self.strategy = 'geo-cells'
+    else:
+      self.strategy = 'multi-query' if multi else 'datastore'
+
+  def filter_nodes(self):
+    return [f.to_node() for f in self.filters]
+
+  def match(self, entity):
+    for f in self.post_filters:
+      if not f.match(entity):
+        return False
+    return True
+
+  def describe(self):
+    '''Returns the plan as a header value, e. g.
+    "multi-query; post-filter=price__gt; scanned=120".'''
+    parts = [self.strategy]
+    if self.post_filters:
+      parts.append('post-filter=%s' % ','.join(f.describe()
+                                               for f in self.post_filters))
+    if self.missing_index:
+      parts.append('missing-index')
+    if not self.scanned is None:
+      parts.append('scanned=%d' % self.scanned)
+    if self.truncated:
+      parts.append('truncated')
+    return '; '.join(parts)
+
+
+_indexes_cache = {}
+_indexes_lock = threading.Lock()
+
+
+def load_indexes(path='index.yaml'):
+  '''Returns the composite indexes of index.yaml by kind: {kind: [(ancestor,
+  [(name, direction)])]}. Parsed once by file modification time. Empty if
+  the file is missing.'''
+  try:
+    mtime = os.path.getmtime(path)
+  except OSError:
+    return {}
+  with _indexes_lock:
+    cached = _indexes_cache.get(path, None)
+    if cached and cached[0] == mtime:
+      return cached[1]
+  indexes = {}
+  try:
+    with open(path) as f:
+      definitions = datastore_index.ParseIndexDefinitions(f)
+  except Exception, e:
+    logger.error('Invalid %s: %s' % (path, e))
+    definitions = None
+  if definitions and definitions.indexes:
+    for index in definitions.indexes:
+      props = [(p.name, DESCENDING if p.direction == 'desc' else ASCENDING)
+               for p in index.properties or []]
+      indexes.setdefault(index.kind, []).append((bool(index.ancestor), props))
+  with _indexes_lock:
+    _indexes_cache[path] = (mtime, indexes)
+  return indexes
+
+
+def _order_pairs(orders):
+  rv = []
+  for order in orders:
+    if isinstance(order, PropertyOrder):
+      rv.append((order.prop, order.direction))
+    else:
+      rv.append((order._name, ASCENDING))
+  return rv
+
+
+def _servable(kind, ancestor, equalities, inequality, orders, indexes):
+  '''Returns True if built-in or index.yaml indexes serve the query.'''
+  if not inequality and not orders:
+    # Merge join of built-in indexes.
+    return True
+  names = set([name for name, unused in orders])
+  if inequality:
+    names.add(inequality)
+  if not ancestor and not equalities and len(names) == 1 and \
+      len(orders) <= 1:
+    return True
+
+  suffix = list(orders)
+  if inequality and (not orders or orders[0][0] != inequality):
+    suffix.insert(0, (inequality, ASCENDING))
+  count = len(equalities)
+  for index_ancestor, props in indexes.get(kind, []):
+    if index_ancestor != ancestor or len(props) != count + len(suffix):
+      continue
+    if set([name for name, unused in props[:count]]) == equalities and \
+        props[count:] == suffix:
+      return True
+  return False
+
+
+def plan_query(modelclass, specs, orders, ancestor=False, indexes=None):
+  '''Returns the QueryPlan of specs (FilterSpecs) and orders (properties or
+  PropertyOrders) on modelclass.
+
+  Filters on unindexed properties are post-filtered. Inequalities are run in
+  the datastore only for one property, the first order one if any. If the
+  query needs an index which is not in indexes (see load_indexes), the
+  inequality and then the equalities are moved to post-filters.
+
+  If there is a geo filter on a property with geo_index, the query runs by
+  geohash cells with the indexed "eq" filters (built-in indexes serve them
+  without orders) and all other filters are post-filtered.'''
+  kind = modelclass._get_kind()
+  indexes = indexes or {}
+  orders = _order_pairs(orders)
+  geo_specs = [s for s in specs if s.is_geo()]
+  specs = [s for s in specs if not s.is_geo()]
+  indexed_geo = [s for s in geo_specs
+                 if getattr(s.prop, '_geo_hash_property', None)]
+  if indexed_geo:
+    equality = [s for s in specs if s.prop._indexed and s.op == 'eq']
+    post = geo_specs + [s for s in specs if not s in equality]
+    return QueryPlan(equality, post, [], geo=indexed_geo[0])
+
+  post = geo_specs + [s for s in specs if not s.prop._indexed]
+  specs = [s for s in specs if s.prop._indexed]
+  equality = [s for s in specs if not s.is_inequality()]
+  inequality = [s for s in specs if s.is_inequality()]
+
+  inequality_name = None
+  if inequality:
+    names = [s.name for s in inequality]
+    if orders and orders[0][0] in names:
+      inequality_name = orders[0][0]
+    elif not orders:
+      inequality_name = names[0]
+  post += [s for s in inequality if s.name != inequality_name]
+  inequality = [s for s in inequality if s.name == inequality_name]
+
+  equalities = set([s.name for s in equality])
+  if not _servable(kind, ancestor, equalities, inequality_name, orders,
+                   indexes):
+    post += inequality
+    inequality = []
+    inequality_name = None
+    if not _servable(kind, ancestor, equalities, None, orders, indexes):
+      post += equality
+      equality = []
+  missing_index = not _servable(kind, ancestor,
+                                set([s.name for s in equality]),
+                                inequality_name, orders, indexes)
+  return QueryPlan(equality + inequality, post, orders,
+                   missing_index=missing_index)
+
+
+def fetch_post_filtered(query, plan, limit=None, max_scan=None,
+                        batch_size=100):
+  '''Returns up to limit entities of query passing the post-filters of
+  plan, reading at most max_scan entities.'''
+  rv = []
+  scanned = 0
+  for entity in query.iter(batch_size=batch_size):
+    scanned += 1
+    if plan.match(entity):
+      rv.append(entity)
+      if limit and len(rv) >= limit:
+        break
+    if max_scan and scanned >= max_scan:
+      plan.truncated = True
+      break
+  plan.scanned = scanned
+  return rv
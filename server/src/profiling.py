@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Per request profiling: time spent by phase and RPCs by service.'''
+
+import logging
+import threading
+import time
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+from google.appengine.api import apiproxy_stub_map
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['RequestProfile', 'MetricsSink', 'LoggingSink', 'HEADER', 'start',
+           'stop', 'get_current']
+
+# Request header to ask for a profile and response header holding it.
+HEADER = 'X-Stones-Profile'
+
+_local = threading.local()
+_hooks_installed = False
+
+
+class _NullPhase(object):
+  '''Phase of requests not profiled. Does nothing.'''
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+class _Phase(object):
+  def __init__(self, profile, name):
+    self.profile = profile
+    self.name = name
+
+  def __enter__(self):
+    self.started = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.profile.add_time(self.name, time.time() - self.started)
+    return False
+
+
+class NullProfile(object):
+  '''Profile of requests not sampled. It costs nearly nothing.'''
+  enabled = False
+  _phase = _NullPhase()
+
+  def phase(self, name):
+    return self._phase
+
+  def add_time(self, name, seconds):
+    pass
+
+  def record_rpc(self, service, call, request, response):
+    pass
+
+
+class RequestProfile(object):
+  '''Wall time by phase and RPC calls and bytes by service of one request.
+  Phases with the same name are added up; phases may be nested, e. g.
+  'serialization' is part of 'handler' time.'''
+  enabled = True
+
+  def __init__(self):
+    self.started = time.time()
+    self.total = None
+    self.phases = {}
+    self.rpcs = {}
+
+  def phase(self, name):
+    '''Context manager which adds its wall time to phase name.'''
+    return _Phase(self, name)
+
+  def add_time(self, name, seconds):
+    self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+  def record_rpc(self, service, call, request, response):
+    stats = self.rpcs.setdefault(service, {'calls': 0, 'request_bytes': 0,
+                                           'response_bytes': 0})
+    stats['calls'] += 1
+    try:
+      stats['request_bytes'] += request.ByteSize()
+      stats['response_bytes'] += response.ByteSize()
+    except AttributeError:
+      pass
+
+  def finish(self):
+    self.total = time.time() - self.started
+
+  def to_dict(self):
+    return {
+      'total_ms': round((self.total or 0) * 1000, 2),
+      'phases_ms': dict((name, round(seconds * 1000, 2))
+                        for name, seconds in self.phases.iteritems()),
+      'rpcs': self.rpcs,
+    }
+
+  def to_header(self):
+    return json.dumps(self.to_dict(), separators=(',', ':'), sort_keys=True)
+
+
+class MetricsSink(object):
+  '''Receives the profiles of sampled requests. Override record to send them
+  to a metrics service.'''
+  def record(self, handler, profile):
+    pass
+
+
+class LoggingSink(MetricsSink):
+  '''Logs profiles.'''
+  def record(self, handler, profile):
+    logger.info('Profile %s %s: %s' % (handler.request.method,
+                                       handler.request.path,
+                                       profile.to_header()))
+
+
+def _post_call_hook(service, call, request, response):
+  profile = getattr(_local, 'profile', None)
+  if not profile is None:
+    profile.record_rpc(service, call, request, response)
+
+
+def _install_hooks():
+  global _hooks_installed
+  if _hooks_installed:
+    return
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('stones.profiling',
+                                                       _post_call_hook)
+  _hooks_installed = True
+
+
+_null_profile = NullProfile()
+
+
+def start(enabled=True):
+  '''Starts the profile of current request (thread). Returns a NullProfile if
+  not enabled.'''
+  if not enabled:
+    _local.profile = None
+    return _null_profile
+  _install_hooks()
+  profile = _local.profile = RequestProfile()
+  return profile
+
+
+def stop():
+  '''Stops and returns the profile of current request.'''
+  profile = getattr(_local, 'profile', None)
+  _local.profile = None
+  if profile is None:
+    return _null_profile
+  profile.finish()
+  return profile
+
+
+def get_current():
+  '''Returns the profile of current request or a NullProfile.'''
+  return getattr(_local, 'profile', None) or _null_profile
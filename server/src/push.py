@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Push of entity changes to connected clients.
+
+A model opts in setting _push_changes; Model put and delete hooks then
+publish, when the transaction commits, a compact notification:
+
+  {"kind": "Book", "key": "<urlsafe key>", "version": 42, "deleted": false}
+
+to the topic of the entity namespace. PushHandler serves them by long-poll
+or server-sent events; clients fetch only the entities which changed.
+
+Notifications go through "broker". MemoryBroker, the default, keeps them in
+the instance memory: it is the local stand-in of a broker shared by all
+instances, which must have the same interface (publish and wait).'''
+
+import collections
+import logging
+import threading
+import time
+import uuid
+
+from google.appengine.ext import ndb
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['MemoryBroker', 'broker', 'publish_change', 'parse_since',
+           'format_since']
+
+# Notifications kept by topic.
+BUFFER_SIZE = 1000
+# Max seconds a client waits for notifications.
+MAX_WAIT = 25
+# Seconds notifications are gathered after the first one, to send a burst
+# of changes at once.
+COALESCE_SECONDS = 0.2
+
+
+class MemoryBroker(object):
+  '''Notifications by topic held in a ring buffer, numbered with a sequence
+  shared by all topics. Waiting clients are woken up on publish.'''
+  def __init__(self, buffer_size=BUFFER_SIZE):
+    # Sequences of other brokers (or of this one before a restart) mean
+    # nothing here.
+    self.id = uuid.uuid4().hex[:8]
+    self.buffer_size = buffer_size
+    self.seq = 0
+    self._topics = {}
+    # Sequence of the last notification dropped by topic.
+    self._dropped = {}
+    self._condition = threading.Condition()
+
+  def publish(self, topic, notification):
+    '''Adds notification to topic, with its sequence number as "version".
+    Returns the sequence number.'''
+    with self._condition:
+      self.seq += 1
+      buf = self._topics.get(topic, None)
+      if buf is None:
+        buf = self._topics[topic] = collections.deque(maxlen=self.buffer_size)
+      if len(buf) == self.buffer_size:
+        self._dropped[topic] = buf[0][0]
+      buf.append((self.seq, dict(notification, version=self.seq)))
+      self._condition.notify_all()
+      return self.seq
+
+  def _read(self, topic, since, kinds):
+    lost = since < self._dropped.get(topic, 0)
+    events = [(seq, n) for seq, n in self._topics.get(topic, ())
+              if seq > since and (not kinds or n['kind'] in kinds)]
+    return events, lost
+
+  def wait(self, topic, since, kinds=None, timeout=MAX_WAIT,
+           coalesce=COALESCE_SECONDS):
+    '''Returns (notifications, last sequence, lost) of topic after sequence
+    since, waiting up to timeout seconds for some. Notifications of the
+    same entity are coalesced to the last one. lost is True if some
+    notifications after since are no longer kept.'''
+    deadline = time.time() + timeout
+    with self._condition:
+      events, lost = self._read(topic, since, kinds)
+      while not events and not lost:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._condition.wait(remaining)
+        events, lost = self._read(topic, since, kinds)
+    if events and coalesce:
+      # Gathers the rest of a burst.
+      time.sleep(coalesce)
+      with self._condition:
+        events, lost = self._read(topic, since, kinds)
+
+    latest = collections.OrderedDict()
+    for seq, notification in events:
+      latest.pop(notification['key'], None)
+      latest[notification['key']] = notification
+    last = events[-1][0] if events else max(since, 0)
+    return latest.values(), last, lost
+
+
+broker = MemoryBroker()
+
+
+def format_since(seq, broker_id=None):
+  '''Returns the cursor clients send back to get notifications after seq.'''
+  return '%s:%d' % (broker_id or broker.id, seq)
+
+
+def parse_since(since):
+  '''Returns the sequence of a cursor given by format_since, the current
+  one if empty (only new notifications) or None if it is invalid or from
+  another broker.'''
+  if not since:
+    return broker.seq
+  broker_id, sep, seq = since.rpartition(':')
+  if broker_id != broker.id:
+    return None
+  try:
+    return int(seq)
+  except ValueError:
+    return None
+
+
+def publish_change(key, deleted=False):
+  '''Publishes the change of the entity of key to the topic of its
+  namespace, when the current transaction commits (now, if there is
+  none).'''
+  def publish():
+    broker.publish(key.namespace(), {
+      'kind': key.kind(),
+      'key': key.urlsafe(),
+      'deleted': deleted,
+    })
+
+  ndb.get_context().call_on_commit(publish)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Statistics of queries run by ModelHandlerMixin grouped by query shape:
+kind, filtered properties with their operators, sort orders and ancestor.
+Values are not part of the shape. Useful to choose composite indexes and
+what to cache.
+
+Each instance keeps its own totals of the day and writes them to its own
+QueryStats entities, one by shape and day, so instances never overwrite
+each other's counts; get_stats adds up those of the last days. Run
+purge_stats (e. g. by cron) to delete older ones.'''
+
+import datetime
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+from google.appengine.ext import ndb
+from google.appengine.datastore import datastore_query
+
+import model
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['QueryStats', 'QueryStatsCollector', 'query_shape', 'orders_shape',
+           'collector', 'purge_stats',
+           'get_stats', 'SLOW_QUERY_MS']
+
+# Upper bounds (ms) of latency histogram buckets. Last bucket has no bound.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000)
+# Queries slower than this (ms) are logged.
+SLOW_QUERY_MS = 1000
+# Days of stats added up by get_stats and kept by purge_stats.
+KEEP_DAYS = 7
+# QueryStats entities read by batch.
+BATCH_SIZE = 500
+
+
+def _filters_shape(node):
+  '''Returns a list of "property operator" strings from a filters node.'''
+  if node is None:
+    return []
+  if isinstance(node, ndb.FilterNode):
+    name, opsymbol, unused = node.__getnewargs__()
+    return ['%s %s' % (name, opsymbol)]
+  if isinstance(node, ndb.DisjunctionNode):
+    parts = sorted(set(['(%s)' % ' AND '.join(_filters_shape(n))
+                        for n in node]))
+    return ['(%s)' % ' OR '.join(parts)]
+  if isinstance(node, ndb.ConjunctionNode):
+    rv = []
+    for n in node:
+      rv += _filters_shape(n)
+    return sorted(rv)
+  return [node.__class__.__name__]
+
+
+def orders_shape(order):
+  '''Returns the property names of a query order, "-" prefixed if
+  descending.'''
+  if order is None:
+    return []
+  if isinstance(order, datastore_query.CompositeOrder):
+    rv = []
+    for o in order.orders:
+      rv += orders_shape(o)
+    return rv
+  if isinstance(order, datastore_query.PropertyOrder):
+    prefix = '-' if order.direction == datastore_query.PropertyOrder.DESCENDING else ''
+    return [prefix + order.prop]
+  return [repr(order)]
+
+
+def query_shape(query):
+  '''Returns the normalized shape of an ndb query as a string.'''
+  return '%s | %s | %s | %s' % (
+    query.kind,
+    ', '.join(_filters_shape(query.filters)),
+    ', '.join(orders_shape(query.orders)),
+    'ancestor' if not query.ancestor is None else '',
+  )
+
+
+def _bucket(ms):
+  for index, bound in enumerate(LATENCY_BUCKETS):
+    if ms <= bound:
+      return index
+  return len(LATENCY_BUCKETS)
+
+
+def _histogram_percentile(histogram, p):
+  '''Returns the upper bound (ms) of the bucket holding p percentile.'''
+  total = sum(histogram)
+  if not total:
+    return 0
+  threshold = total * p / 100.0
+  seen = 0
+  for index, count in enumerate(histogram):
+    seen += count
+    if seen >= threshold:
+      if index < len(LATENCY_BUCKETS):
+        return LATENCY_BUCKETS[index]
+      return None
+  return None
+
+
+class QueryStats(model.Model):
+  '''Accumulated stats of a query shape in an instance and a day. Stored in
+  the empty namespace, key id is the md5 of shape, the day and the collector
+  id.'''
+  shape = model.StringProperty(indexed=False)
+  kind = model.StringProperty()
+  day = model.DateProperty()
+  count = model.IntegerProperty(default=0)
+  cursor_count = model.IntegerProperty(default=0, indexed=False)
+  latency_total_ms = model.FloatProperty(default=0.0, indexed=False)
+  latency_max_ms = model.FloatProperty(default=0.0, indexed=False)
+  latency_histogram = model.IntegerProperty(repeated=True, indexed=False)
+  results_total = model.IntegerProperty(default=0, indexed=False)
+  results_max = model.IntegerProperty(default=0, indexed=False)
+  updated = model.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def key_for(cls, shape, day, collector_id):
+    if isinstance(shape, unicode):
+      shape = shape.encode('utf-8')
+    return ndb.Key(cls, '%s:%s:%s' % (hashlib.md5(shape).hexdigest(),
+                                      day.strftime('%Y%m%d'), collector_id),
+                   namespace='')
+
+  def merge(self, other):
+    '''Adds stats of other (a QueryStats) to this one.'''
+    self.count += other.count
+    self.cursor_count += other.cursor_count
+    self.latency_total_ms += other.latency_total_ms
+    self.latency_max_ms = max(self.latency_max_ms, other.latency_max_ms)
+    histogram = list(self.latency_histogram) or \
+      [0] * (len(LATENCY_BUCKETS) + 1)
+    for index, count in enumerate(other.latency_histogram):
+      histogram[index] += count
+    self.latency_histogram = histogram
+    self.results_total += other.results_total
+    self.results_max = max(self.results_max, other.results_max)
+
+  def to_dict(self):
+    count = self.count or 1
+    return {
+      'shape': self.shape,
+      'kind': self.kind,
+      'count': self.count,
+      'cursor_ratio': float(self.cursor_count) / count,
+      'latency_mean_ms': self.latency_total_ms / count,
+      'latency_max_ms': self.latency_max_ms,
+      'latency_p50_ms': _histogram_percentile(self.latency_histogram, 50),
+      'latency_p90_ms': _histogram_percentile(self.latency_histogram, 90),
+      'latency_p99_ms': _histogram_percentile(self.latency_histogram, 99),
+      'results_mean': float(self.results_total) / count,
+      'results_max': self.results_max,
+    }
+
+
+class QueryStatsCollector(object):
+  '''Accumulates query stats of the day in the instance and writes its
+  totals to QueryStats entities of its own every flush_interval seconds.'''
+  flush_interval = 60
+
+  def __init__(self):
+    self.id = uuid.uuid4().hex[:12]
+    self._day = datetime.date.today()
+    self._stats = {}
+    self._dirty = set()
+    self._lock = threading.Lock()
+    self._last_flush = time.time()
+
+  def record(self, query, seconds, results, cursor=False):
+    '''Records one query run.
+    Args:
+      query: ndb query.
+      seconds: time taken.
+      results: number of entities retrieved.
+      cursor: True if query started from a cursor.'''
+    shape = query_shape(query)
+    ms = seconds * 1000
+    if ms >= SLOW_QUERY_MS:
+      logger.warning('Slow query (%.1f ms, %d results): %s'
+                     % (ms, results, shape))
+    today = datetime.date.today()
+    if today != self._day:
+      # Totals of the day before are written, next ones start from zero.
+      self.flush()
+      with self._lock:
+        if today != self._day:
+          self._day = today
+          self._stats = {}
+    with self._lock:
+      stats = self._stats.get(shape, None)
+      if stats is None:
+        stats = self._stats[shape] = QueryStats(
+          key=QueryStats.key_for(shape, self._day, self.id), shape=shape,
+          kind=query.kind, day=self._day,
+          latency_histogram=[0] * (len(LATENCY_BUCKETS) + 1))
+      self._dirty.add(shape)
+      stats.count += 1
+      stats.cursor_count += int(bool(cursor))
+      stats.latency_total_ms += ms
+      stats.latency_max_ms = max(stats.latency_max_ms, ms)
+      stats.latency_histogram[_bucket(ms)] += 1
+      stats.results_total += results
+      stats.results_max = max(stats.results_max, results)
+      due = time.time() - self._last_flush >= self.flush_interval
+    if due:
+      self.flush()
+
+  def flush(self):
+    '''Writes the totals of shapes recorded since the last flush. Entities
+    are only written by this collector, so no read is needed.'''
+    with self._lock:
+      entities = []
+      for shape in self._dirty:
+        stats = self._stats[shape]
+        entity = QueryStats(key=stats.key, shape=shape, kind=stats.kind,
+                            day=stats.day)
+        entity.merge(stats)
+        entities.append(entity)
+      self._dirty = set()
+      self._last_flush = time.time()
+    if entities:
+      # Not waited for: the request does not block on it.
+      ndb.put_multi_async(entities)
+
+
+collector = QueryStatsCollector()
+
+
+def _since(days):
+  return datetime.date.today() - datetime.timedelta(days=days - 1)
+
+
+def get_stats(kind=None, days=KEEP_DAYS):
+  '''Returns the stats (dicts) of all instances in the last days, most
+  frequent shapes first.'''
+  collector.flush()
+  # Kind is filtered here, so no composite index is needed.
+  query = QueryStats.query(QueryStats.day >= _since(days), namespace='')
+  by_shape = {}
+  for entity in query.iter(batch_size=BATCH_SIZE):
+    if kind and entity.kind != kind:
+      continue
+    stats = by_shape.get(entity.shape, None)
+    if stats is None:
+      stats = by_shape[entity.shape] = QueryStats(shape=entity.shape,
+                                                  kind=entity.kind)
+    stats.merge(entity)
+  stats = [s.to_dict() for s in by_shape.itervalues()]
+  return sorted(stats, key=lambda s: s['count'], reverse=True)
+
+
+def purge_stats(days=KEEP_DAYS):
+  '''Deletes the QueryStats entities older than days. Returns how many.'''
+  query = QueryStats.query(QueryStats.day < _since(days), namespace='')
+  keys = list(query.iter(keys_only=True, batch_size=BATCH_SIZE))
+  for start in xrange(0, len(keys), BATCH_SIZE):
+    ndb.delete_multi(keys[start:start + BATCH_SIZE])
+  return len(keys)
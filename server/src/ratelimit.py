@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['RateLimiter', 'MemoryBackend', 'MemcacheBackend',
+           'RateLimitMetrics', 'metrics']
+
+MEMCACHE_NAMESPACE = 'stones.ratelimit'
+
+
+class MemoryBackend(object):
+  '''Token buckets held by the instance. Cheap, but every instance has its
+  own buckets.'''
+  def __init__(self, max_keys=10000):
+    self.max_keys = max_keys
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def _evict(self, now):
+    '''Drops buckets that are full again, i. e. idle keys.'''
+    for key, (tokens, stamp, rate, burst) in self._buckets.items():
+      if tokens + (now - stamp) * rate >= burst:
+        del self._buckets[key]
+
+  def consume(self, key, rate, burst, cost=1):
+    '''Takes cost tokens from key bucket. Returns False if there are not
+    enough tokens.'''
+    now = time.time()
+    with self._lock:
+      tokens, stamp = self._buckets.get(key, (burst, now, rate, burst))[:2]
+      tokens = min(burst, tokens + (now - stamp) * rate)
+      admitted = tokens >= cost
+      if admitted:
+        tokens -= cost
+      if len(self._buckets) >= self.max_keys:
+        self._evict(now)
+      self._buckets[key] = (tokens, now, rate, burst)
+    return admitted
+
+
+class MemcacheBackend(object):
+  '''Counters shared by all instances. Buckets are approximated with fixed
+  windows of burst / rate seconds allowing burst requests each.'''
+  def consume(self, key, rate, burst, cost=1):
+    window = max(int(burst / rate), 1)
+    slot = int(time.time() / window)
+    mkey = '%s:%d' % (key, slot)
+    count = memcache.incr(mkey, delta=cost, namespace=MEMCACHE_NAMESPACE)
+    if count is None:
+      if memcache.add(mkey, cost, time=window * 2,
+                      namespace=MEMCACHE_NAMESPACE):
+        count = cost
+      else:
+        count = memcache.incr(mkey, delta=cost, namespace=MEMCACHE_NAMESPACE)
+    if count is None:
+      # memcache unavailable, let it go.
+      return True
+    return count <= burst
+
+
+class RateLimitMetrics(object):
+  '''Admitted and rejected requests by limiter name, in this instance.'''
+  def __init__(self):
+    self._counters = {}
+    self._lock = threading.Lock()
+
+  def record(self, name, admitted):
+    outcome = 'admitted' if admitted else 'rejected'
+    with self._lock:
+      counters = self._counters.setdefault(name, {'admitted': 0,
+                                                  'rejected': 0})
+      counters[outcome] += 1
+
+  def get_stats(self, reset=False):
+    '''Returns a dict name -> {'admitted': n, 'rejected': n}.'''
+    with self._lock:
+      rv = dict((name, dict(counters))
+                for name, counters in self._counters.iteritems())
+      if reset:
+        self._counters = {}
+    return rv
+
+
+metrics = RateLimitMetrics()
+
+
+class RateLimiter(object):
+  '''Token bucket rate limiter.
+
+  Buckets are checked in the instance first, so requests rejected there cost
+  no RPC at all; admitted ones are then checked against memcache counters
+  shared by all instances (if shared is True).
+
+  E. g., 5 login attempts by username and then one every minute:
+    RateLimiter('auth_id', rate=1 / 60.0, burst=5, methods=('POST',))
+  '''
+  local_backend = MemoryBackend()
+  shared_backend = MemcacheBackend()
+
+  def __init__(self, scope='ip', rate=1.0, burst=10, shared=True,
+               methods=None, name=None):
+    '''Constructor.
+    Args:
+      scope: what requests are limited by. 'ip', 'auth_id', 'route' or a
+        function receiving the handler and returning the key value.
+      rate: tokens added to buckets per second.
+      burst: bucket capacity.
+      shared: If True, memcache counters are checked too.
+      methods: HTTP methods limited. None means all of them.
+      name: limiter name used in keys and metrics.'''
+    self.scope = scope
+    self.rate = float(rate)
+    self.burst = burst
+    self.shared = shared
+    self.methods = methods
+    if name is None:
+      name = scope if isinstance(scope, basestring) else scope.__name__
+    self.name = name
+
+  def applies_to(self, method):
+    return self.methods is None or method in self.methods
+
+  def admit(self, route, value, cost=1):
+    '''Returns if a request for route and scope value is admitted.'''
+    key = '%s:%s:%s' % (route, self.name, value)
+    admitted = self.local_backend.consume(key, self.rate, self.burst, cost)
+    if admitted and self.shared:
+      admitted = self.shared_backend.consume(key, self.rate, self.burst,
+                                             cost)
+    metrics.record('%s:%s' % (route, self.name), admitted)
+    if not admitted:
+      logger.warning('Rate limit %s exceeded by %s.' % (key, value))
+    return admitted
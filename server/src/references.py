@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Batched work on ReferenceProperty values.'''
+
+import logging
+
+import webapp2
+from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+import model
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['parse_expand', 'expand_references', 'EXPANDED_KEY',
+           'ReferenceBacklink', 'update_backlinks', 'write_backlinks',
+           'enqueue_refresh', 'refresh_displays', 'REFRESH_ROUTE',
+           'BACKLINKS_ROUTE']
+
+# Key of the referenced entity inlined in a reference dict.
+EXPANDED_KEY = '$$entity$$'
+# Max nesting of expanded references.
+MAX_EXPAND_DEPTH = 3
+# Max entities fetched by level of expansion.
+MAX_EXPAND_KEYS = 1000
+# Name of the route to ReferenceRefreshHandler.
+REFRESH_ROUTE = 'stones.references.refresh'
+# Name of the route to ReferenceBacklinkHandler.
+BACKLINKS_ROUTE = 'stones.references.backlinks'
+# Queue of display refresh and backlink retry tasks.
+REFRESH_QUEUE = 'default'
+# Referencing entities rewritten by refresh task.
+REFRESH_BATCH_SIZE = 100
+
+
+def parse_expand(paths, max_depth=MAX_EXPAND_DEPTH):
+  '''Returns the tree ({name: {name: ...}}) of reference paths, e. g.
+  ['author', 'parts.author'] -> {'author': {}, 'parts': {'author': {}}}.
+  Path parts deeper than max_depth are dropped.'''
+  if isinstance(paths, basestring):
+    paths = paths.split(',')
+  tree = {}
+  for path in paths:
+    node = tree
+    for name in path.strip().split('.')[:max_depth]:
+      if name:
+        node = node.setdefault(name, {})
+  return tree
+
+
+def _references(entity, values, tree):
+  '''Yields (reference dict, subtree) of values (entity.to_dict()) for the
+  ReferenceProperty names in tree.'''
+  for name, children in tree.iteritems():
+    prop = getattr(entity.__class__, name, None)
+    if not isinstance(prop, model.ReferenceProperty):
+      continue
+    refs = values.get(name, None)
+    if not refs:
+      continue
+    if not isinstance(refs, list):
+      refs = [refs]
+    for ref in refs:
+      if isinstance(ref, dict) and ref.get('urlsafe_key', None):
+        yield ref, children
+
+
+def expand_references(entities, paths, max_depth=MAX_EXPAND_DEPTH,
+                      max_keys=MAX_EXPAND_KEYS):
+  '''Returns entities as dicts (to_dict) with referenced entities inlined as
+  dicts under EXPANDED_KEY of their reference dicts. All references of a
+  level of paths, across all entities, are fetched with a single
+  get_multi_async.
+
+  Args:
+    entities: list of entities.
+    paths: list (or comma separated string) of ReferenceProperty names,
+      dotted to expand references of referenced entities.
+    max_depth: max levels of nesting.
+    max_keys: max entities fetched by level. Other references are not
+      expanded.'''
+  tree = parse_expand(paths, max_depth)
+  dicts = [entity.to_dict() for entity in entities]
+  level = [(entity, values, tree)
+           for entity, values in zip(entities, dicts) if tree]
+  while level:
+    refs = []
+    for entity, values, subtree in level:
+      refs.extend(_references(entity, values, subtree))
+
+    keys = {}
+    for ref, unused in refs:
+      urlsafe_key = ref['urlsafe_key']
+      if urlsafe_key in keys:
+        continue
+      if len(keys) >= max_keys:
+        logger.warning('More than %d references to expand.' % max_keys)
+        break
+      try:
+        keys[urlsafe_key] = ndb.Key(urlsafe=urlsafe_key)
+      except (ProtocolBufferDecodeError, TypeError):
+        logger.warning('Invalid reference key %r.' % urlsafe_key)
+    if not keys:
+      break
+
+    urlsafe_keys = keys.keys()
+    futures = ndb.get_multi_async([keys[k] for k in urlsafe_keys])
+    found = dict(zip(urlsafe_keys, [f.get_result() for f in futures]))
+
+    level = []
+    for ref, children in refs:
+      entity = found.get(ref['urlsafe_key'], None)
+      if entity is None:
+        continue
+      values = ref[EXPANDED_KEY] = entity.to_dict()
+      if children:
+        level.append((entity, values, children))
+  return dicts
+
+
+class ReferenceBacklink(model.Model):
+  '''Reverse index of ReferenceProperty with refresh_display, pointing from
+  the referenced entity to the referencing one. Backlinks are root entities,
+  in the namespace of the referenced entity, so the backlinks of a much
+  referenced entity are not written to a single entity group. Key id is
+  "<urlsafe key of referenced entity>|<urlsafe key of referencing
+  entity>|<property name>".'''
+  referenced = model.KeyProperty()
+  referencing = model.KeyProperty(indexed=False)
+  name = model.StringProperty(indexed=False)
+
+  @classmethod
+  def key_for(cls, referenced, referencing, name):
+    return ndb.Key(cls, '%s|%s|%s' % (referenced.urlsafe(),
+                                      referencing.urlsafe(), name),
+                   namespace=referenced.namespace())
+
+
+def update_backlinks(key, added, removed):
+  '''Adds and removes (asynchronously) backlinks of the entity of key. In
+  a transaction, they are written once it commits, so the transaction does
+  not span the entity groups of the backlinks. If the writes fail, a task
+  retries them (see write_backlinks).
+
+  Args:
+    key: key of the referencing entity.
+    added: set of (property name, urlsafe key of referenced entity).
+    removed: the same, of references no longer held.'''
+  added = sorted(added)
+  removed = sorted(removed)
+  if ndb.in_transaction():
+    ndb.get_context().call_on_commit(
+      lambda: _write_backlinks(key, added, removed))
+  else:
+    _write_backlinks(key, added, removed)
+
+
+@ndb.tasklet
+def _write_backlinks(key, added, removed, retry=True):
+  '''Puts and deletes the backlinks of update_backlinks. If retry, failed
+  writes are enqueued for ReferenceBacklinkHandler instead of raised.'''
+  futures = []
+  if added:
+    futures.extend(ndb.put_multi_async([
+      ReferenceBacklink(
+        key=ReferenceBacklink.key_for(ndb.Key(urlsafe=urlsafe_key), key,
+                                      name),
+        referenced=ndb.Key(urlsafe=urlsafe_key), referencing=key, name=name)
+      for name, urlsafe_key in added]))
+  if removed:
+    futures.extend(ndb.delete_multi_async([
+      ReferenceBacklink.key_for(ndb.Key(urlsafe=urlsafe_key), key, name)
+      for name, urlsafe_key in removed]))
+  try:
+    yield futures
+  except Exception, e:
+    if not retry:
+      raise
+    logger.warning('Backlinks of %r not written (%s), retried by task.'
+                   % (key, e))
+    _enqueue_backlinks(key, added, removed)
+
+
+def _enqueue_backlinks(key, added, removed):
+  '''Enqueues the write of backlinks of update_backlinks.
+  ReferenceBacklinkHandler must be routed with name BACKLINKS_ROUTE.'''
+  try:
+    url = webapp2.uri_for(BACKLINKS_ROUTE)
+  except KeyError:
+    logger.error('No %s route. Backlinks of %r are lost.'
+                 % (BACKLINKS_ROUTE, key))
+    return
+  params = {'key': key.urlsafe(),
+            'added': ['%s|%s' % ref for ref in added],
+            'removed': ['%s|%s' % ref for ref in removed]}
+  taskqueue.add(url=url, params=params, queue_name=REFRESH_QUEUE)
+
+
+def write_backlinks(key, added, removed):
+  '''Writes the backlinks of key enqueued by update_backlinks, raising on
+  failure so the task is retried. added and removed are lists of
+  "<property name>|<urlsafe key of referenced entity>".'''
+  _write_backlinks(key, [tuple(ref.rsplit('|', 1)) for ref in added],
+                   [tuple(ref.rsplit('|', 1)) for ref in removed],
+                   retry=False).get_result()
+
+
+def enqueue_refresh(key, cursor=None):
+  '''Enqueues the refresh of the displays of references to the entity of
+  key. ReferenceRefreshHandler must be routed with name REFRESH_ROUTE.'''
+  try:
+    url = webapp2.uri_for(REFRESH_ROUTE)
+  except KeyError:
+    logger.warning('No %s route. Displays of references to %r are not '
+                   'refreshed.' % (REFRESH_ROUTE, key))
+    return
+  params = {'key': key.urlsafe()}
+  if cursor:
+    params['cursor'] = cursor
+  taskqueue.add(url=url, params=params, queue_name=REFRESH_QUEUE,
+                transactional=ndb.in_transaction())
+
+
+def _refresh_reference(owner, name, entity):
+  '''Sets the display of entity to the references to it of property name of
+  owner. Returns (found, changed): if there are such references and if some
+  display changed.'''
+  prop = owner._properties.get(name, None) if not owner is None else None
+  if not isinstance(prop, model.ReferenceProperty):
+    return False, False
+  urlsafe_key = entity.key.urlsafe()
+  display = prop._get_display(entity)
+  values = prop._get_value(owner)
+  if not prop._repeated:
+    values = [values]
+  found = False
+  dirty = False
+  refreshed = []
+  for value in values:
+    if isinstance(value, model._ReferenceModel) and \
+        value.urlsafe_key == urlsafe_key:
+      found = True
+      if value.display != display:
+        value = model._ReferenceModel(urlsafe_key=urlsafe_key,
+                                      display=display)
+        dirty = True
+    refreshed.append(value)
+  if dirty:
+    prop._set_value(owner, refreshed if prop._repeated else refreshed[0])
+  return found, dirty
+
+
+@ndb.tasklet
+def _refresh_group(entity, backlinks):
+  '''Refreshes, in one transaction, the references to entity of backlinks,
+  whose owners are in the same entity group. Returns (owners changed, stale
+  backlink keys).'''
+  @ndb.tasklet
+  def txn():
+    keys = list(set(b.referencing for b in backlinks))
+    owners = dict(zip(keys, (yield ndb.get_multi_async(keys))))
+    changed = {}
+    stale = []
+    for backlink in backlinks:
+      owner = owners[backlink.referencing]
+      found, dirty = _refresh_reference(owner, backlink.name, entity)
+      if not found:
+        stale.append(backlink.key)
+      elif dirty:
+        changed[owner.key] = owner
+    if changed:
+      yield ndb.put_multi_async(changed.values())
+    raise ndb.Return((len(changed), stale))
+
+  rv = yield ndb.transaction_async(txn)
+  raise ndb.Return(rv)
+
+
+def refresh_displays(key, cursor=None, batch_size=REFRESH_BATCH_SIZE):
+  '''Rewrites the stale displays of references to the entity of key held by
+  a page of its backlinks. Owners are read and written in a transaction by
+  entity group, all of them at the same time, so concurrent edits of owners
+  are not lost. Backlinks of entities no longer referencing it are deleted.
+  Backlinks are queried by an index, so the ones just written may be missed.
+  Returns the urlsafe cursor of the next page or None.'''
+  entity = key.get()
+  if entity is None:
+    return None
+  start = Cursor(urlsafe=cursor) if cursor else None
+  backlinks, next_cursor, more = ReferenceBacklink.query(
+    ReferenceBacklink.referenced == key,
+    namespace=key.namespace()).fetch_page(batch_size, start_cursor=start)
+
+  groups = {}
+  for backlink in backlinks:
+    groups.setdefault(backlink.referencing.root(), []).append(backlink)
+  futures = [_refresh_group(entity, group) for group in groups.itervalues()]
+  changed = 0
+  stale = []
+  for future in futures:
+    count, group_stale = future.get_result()
+    changed += count
+    stale += group_stale
+
+  if stale:
+    ndb.delete_multi(stale)
+  logger.info('%d references to %r refreshed.' % (changed, key))
+  if more and next_cursor:
+    return next_cursor.urlsafe()
+  return None
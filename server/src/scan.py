@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Parallel scans of a kind or an ancestor split in key ranges.
+
+Ranges are found sampling __scatter__ (like mapreduce does) or, if there are
+no samples, bisecting the numeric ids between the first and the last key.
+Each range is walked by its own query and up to "parallelism" of them have
+a page being fetched at the same time. Queries are the given one (kind,
+ancestor, namespace and equality filters) plus a __key__ range, so they
+cannot have sort orders; results come in key order if ordered is True, or
+as pages complete otherwise.
+
+  for entity in ParallelScan(MyModel.query(), shards=16, parallelism=8):
+    ...'''
+
+import logging
+
+from google.appengine.ext import ndb
+from google.appengine.datastore import datastore_query
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['split_ranges', 'ParallelScan', 'parallel_map']
+
+# Scatter samples by range.
+OVERSAMPLING = 32
+BATCH_SIZE = 200
+SHARDS = 8
+PARALLELISM = 4
+# Pages kept by range, in ordered scans, while previous ranges are read.
+MAX_BUFFERED_PAGES = 2
+
+
+def _base_query(query):
+  return ndb.Query(kind=query.kind, ancestor=query.ancestor,
+                   namespace=query.namespace)
+
+
+def _scatter_split_keys(query, shards):
+  '''Returns split keys from a __scatter__ sample, sorted.'''
+  if not query.ancestor is None:
+    # Ancestor scatter queries need a composite index.
+    return []
+  sample = _base_query(query).order(
+    datastore_query.PropertyOrder('__scatter__')).fetch(
+      shards * OVERSAMPLING, keys_only=True)
+  if len(sample) < shards:
+    return []
+  sample.sort()
+  step = float(len(sample)) / shards
+  return [sample[int(i * step)] for i in xrange(1, shards)]
+
+
+def _bisect_split_keys(query, shards):
+  '''Returns split keys bisecting numeric ids of the first and last keys
+  if they have the same parent.'''
+  base = _base_query(query)
+  first = base.order(ndb.Model.key).get(keys_only=True)
+  last = base.order(-ndb.Model.key).get(keys_only=True)
+  if first is None or last is None or first.parent() != last.parent():
+    return []
+  low, high = first.integer_id(), last.integer_id()
+  if low is None or high is None or high - low < shards:
+    return []
+  pairs = list(first.parent().pairs()) if first.parent() else []
+  step = float(high - low) / shards
+  return [ndb.Key(pairs=pairs + [(first.kind(), low + int(i * step))],
+                  namespace=first.namespace())
+          for i in xrange(1, shards)]
+
+
+def split_ranges(query, shards=SHARDS):
+  '''Returns a list of up to shards (start key, end key) ranges covering
+  the kind or ancestor of query, in key order. None is an open end.'''
+  split_keys = _scatter_split_keys(query, shards) or \
+    _bisect_split_keys(query, shards)
+  bounds = [None]
+  for key in split_keys:
+    if bounds[-1] is None or key > bounds[-1]:
+      bounds.append(key)
+  bounds.append(None)
+  return zip(bounds[:-1], bounds[1:])
+
+
+class _Range(object):
+  '''Walk of a key range by pages.'''
+  def __init__(self, query, start, end, batch_size, options):
+    if not start is None:
+      query = query.filter(ndb.Model.key >= start)
+    if not end is None:
+      query = query.filter(ndb.Model.key < end)
+    self.query = query
+    self.batch_size = batch_size
+    self.options = options
+    self.future = None
+    self.cursor = None
+    self.pages = []
+    self.done = False
+
+  def fetch(self, cursor=None):
+    self.future = self.query.fetch_page_async(self.batch_size,
+                                              start_cursor=cursor,
+                                              **self.options)
+
+  def collect(self):
+    '''Buffers the fetched page and keeps the cursor of the next one.'''
+    results, cursor, more = self.future.get_result()
+    self.future = None
+    if results:
+      self.pages.append(results)
+    if more and cursor:
+      self.cursor = cursor
+    else:
+      self.done = True
+
+  def resume(self):
+    '''Fetches the next page unless buffered pages are at max.'''
+    if not self.done and self.future is None and \
+        len(self.pages) < MAX_BUFFERED_PAGES:
+      self.fetch(self.cursor)
+
+
+class ParallelScan(object):
+  '''Iterable of the entities (or keys) of query read from key ranges in
+  parallel.
+
+  Args:
+    query: ndb query without sort orders.
+    shards: ranges to split the query in.
+    parallelism: max ranges being fetched at the same time.
+    batch_size: entities by page.
+    ordered: if True, entities come in key order.
+    keys_only, projection...: options of the queries.'''
+  def __init__(self, query, shards=SHARDS, parallelism=PARALLELISM,
+               batch_size=BATCH_SIZE, ordered=False, **options):
+    if query.orders:
+      raise ValueError('Parallel scans cannot have sort orders.')
+    self.query = query
+    self.shards = shards
+    self.parallelism = max(1, parallelism)
+    self.batch_size = batch_size
+    self.ordered = ordered
+    self.options = options
+    self.count = 0
+
+  def ranges(self):
+    return [_Range(self.query, start, end, self.batch_size, self.options)
+            for start, end in split_ranges(self.query, self.shards)]
+
+  def __iter__(self):
+    pending = self.ranges()
+    pending.reverse()
+    active = []
+    while pending or active:
+      while pending and len(active) < self.parallelism:
+        walk = pending.pop()
+        walk.fetch()
+        active.append(walk)
+
+      if self.ordered:
+        # Pages of the first range go out as they come; others are buffered.
+        head = active[0]
+        while head.pages:
+          page = head.pages.pop(0)
+          self.count += len(page)
+          for entity in page:
+            yield entity
+        if head.done and head.future is None:
+          active.pop(0)
+          continue
+        head.resume()
+        futures = [w.future for w in active if not w.future is None]
+        ndb.Future.wait_any(futures)
+        for walk in active:
+          if not walk.future is None and walk.future.done():
+            walk.collect()
+            walk.resume()
+      else:
+        futures = [w.future for w in active]
+        ndb.Future.wait_any(futures)
+        for walk in list(active):
+          if not walk.future.done():
+            continue
+          walk.collect()
+          while walk.pages:
+            page = walk.pages.pop(0)
+            self.count += len(page)
+            for entity in page:
+              yield entity
+          if walk.done:
+            active.remove(walk)
+          else:
+            walk.fetch(walk.cursor)
+
+
+def parallel_map(query, func, shards=SHARDS, parallelism=PARALLELISM,
+                 batch_size=BATCH_SIZE, **options):
+  '''Calls func with each page (list of entities) of a parallel scan of
+  query, as pages complete. Returns the list of func results. Useful for
+  migrations (func puts the page) and aggregations (func returns a partial
+  result).'''
+  results = []
+  scan = ParallelScan(query, shards=shards, parallelism=parallelism,
+                      batch_size=batch_size, **options)
+  page = []
+  for entity in scan:
+    page.append(entity)
+    if len(page) >= batch_size:
+      results.append(func(page))
+      page = []
+  if page:
+    results.append(func(page))
+  return results
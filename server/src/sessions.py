@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Session backends which only save sessions whose data changed.
+
+Backends 'securecookie' and 'memcache' replace webapp2 ones (unless app
+config sets other classes) and 'hybrid' is added: small sessions travel in
+the signed cookie, big ones live in memcache and are written behind to the
+datastore.'''
+
+import hashlib
+import logging
+import time
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+import webapp2
+from webapp2_extras import sessions
+from webapp2_extras.appengine import sessions_memcache
+from webapp2_extras.appengine import sessions_ndb
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['SessionStore', 'SecureCookieSessionFactory',
+           'MemcacheSessionFactory', 'HybridSessionFactory', 'get_store']
+
+
+def _digest(data):
+  '''Fingerprint of session data to find out if it changed.'''
+  dumped = json.dumps(data, sort_keys=True, default=repr)
+  return hashlib.md5(dumped).digest()
+
+
+class _DirtyTrackingMixin(object):
+  '''Keeps a fingerprint of loaded data, so unchanged sessions (even if
+  they were set with the same values) are not saved again. Nested changes,
+  missed by SessionDict.modified, are noticed too.'''
+  _loaded_digest = None
+
+  def _remember(self):
+    self._loaded_digest = _digest(dict(self.session))
+
+  def is_dirty(self):
+    if self.session is None:
+      return False
+    return _digest(dict(self.session)) != self._loaded_digest
+
+
+class SecureCookieSessionFactory(_DirtyTrackingMixin,
+                                 sessions.SecureCookieSessionFactory):
+  '''Secure cookie sessions re-signed only if data changed.'''
+  def get_session(self, max_age=sessions._default_value):
+    if self.session is None:
+      super(SecureCookieSessionFactory, self).get_session(max_age=max_age)
+      self._remember()
+    return self.session
+
+  def save_session(self, response):
+    if not self.is_dirty():
+      return
+    self.session_store.save_secure_cookie(response, self.name,
+                                          dict(self.session),
+                                          **self.session_args)
+
+
+class MemcacheSessionFactory(_DirtyTrackingMixin,
+                             sessions_memcache.MemcacheSessionFactory):
+  '''Memcache sessions saved only if data changed. The cookie, which only
+  holds the session id, is signed once when the session is created.'''
+  def get_session(self, max_age=sessions._default_value):
+    if self.session is None:
+      super(MemcacheSessionFactory, self).get_session(max_age=max_age)
+      self._remember()
+    return self.session
+
+  def save_session(self, response):
+    if not self.is_dirty():
+      return
+    memcache.set(self.sid, dict(self.session))
+    if self.session.new:
+      self.session_store.save_secure_cookie(response, self.name,
+                                            {'_sid': self.sid},
+                                            **self.session_args)
+
+
+class HybridSessionFactory(_DirtyTrackingMixin,
+                           sessions.CustomBackendSessionFactory):
+  '''Sessions up to max_cookie_size bytes are kept in the signed cookie.
+  Bigger ones are kept in memcache and copied to the datastore at most every
+  persist_interval seconds; copies of all sessions of a request are written
+  with one put_multi_async by SessionStore.'''
+  max_cookie_size = 2048
+  persist_interval = 60
+
+  _persisted_at = 0
+
+  def get_session(self, max_age=sessions._default_value):
+    if self.session is None:
+      data = self.session_store.get_secure_cookie(self.name, max_age=max_age)
+      if data and '_sid' in data:
+        self.session = self._get_by_sid(data['_sid'])
+      else:
+        self.sid = None
+        self.session = sessions.SessionDict(self, data=data,
+                                            new=data is None)
+      self._remember()
+    return self.session
+
+  def _get_by_sid(self, sid):
+    data = None
+    if self._is_valid_sid(sid):
+      data = memcache.get(sid)
+      if data is None:
+        entity = sessions_ndb.Session.get_by_id(sid)
+        if not entity is None:
+          data = entity.data
+    if data is None:
+      self.sid = None
+      return sessions.SessionDict(self, new=True)
+    self.sid = sid
+    data = dict(data)
+    self._persisted_at = data.pop('_persisted', 0)
+    return sessions.SessionDict(self, data=data)
+
+  def save_session(self, response):
+    if not self.is_dirty():
+      return
+    data = dict(self.session)
+    serialized = self.session_store.serializer.serialize(self.name, data)
+    if len(serialized) <= self.max_cookie_size:
+      self.session_store.save_secure_cookie(response, self.name, data,
+                                            **self.session_args)
+      return
+
+    new_sid = self.sid is None
+    if new_sid:
+      self.sid = self._get_new_sid()
+    now = int(time.time())
+    if now - self._persisted_at >= self.persist_interval:
+      self._persisted_at = now
+      self.session_store.persist(sessions_ndb.Session(id=self.sid, data=data))
+    data['_persisted'] = self._persisted_at
+    memcache.set(self.sid, data)
+    if new_sid:
+      self.session_store.save_secure_cookie(response, self.name,
+                                            {'_sid': self.sid},
+                                            **self.session_args)
+
+
+BACKENDS = {
+  'securecookie': SecureCookieSessionFactory,
+  'memcache': MemcacheSessionFactory,
+  'hybrid': HybridSessionFactory,
+}
+
+
+class SessionStore(sessions.SessionStore):
+  '''Session store using stones backends.'''
+  def __init__(self, *args, **kwargs):
+    super(SessionStore, self).__init__(*args, **kwargs)
+    self._to_persist = []
+
+  def get_backend(self, name):
+    backend = self.config['backends'].get(name, None)
+    default = sessions.default_config['backends'].get(name, None)
+    if name in BACKENDS:
+      if backend is None or backend == default or \
+          (default and backend is webapp2.import_string(default)):
+        return BACKENDS[name]
+    return super(SessionStore, self).get_backend(name)
+
+  def persist(self, entity):
+    '''Queues a session entity to be written by save_sessions.'''
+    self._to_persist.append(entity)
+
+  def save_sessions(self, response):
+    super(SessionStore, self).save_sessions(response)
+    if self._to_persist:
+      entities, self._to_persist = self._to_persist, []
+      ndb.put_multi_async(entities)
+
+
+def get_store(request=None):
+  '''Returns the stones SessionStore for request. webapp2 auth shares it.'''
+  return sessions.get_store(factory=SessionStore, request=request)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Concurrency stress of entity saves against appengine local stubs.
+
+Many threads save at the same time entities whose ReferenceProperty values
+are new entities, each with values of its own. Then every saved entity is
+checked: its references must point to entities holding its values and, for
+children, to entities whose parent is the saved one. Any mismatch means
+state shared between threads. Run it from the app root, with appengine SDK
+in the path:
+  python -m stones.stress --threads 16 --saves 50
+
+Exit status is 1 if a mismatch is found.'''
+
+import argparse
+import logging
+import sys
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+import model
+from benchmark import stubs
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['StressTarget', 'StressOwner', 'save', 'check', 'run']
+
+MODES = ('put', 'put_with_references')
+
+
+class StressTarget(model.Model):
+  display = model.StringProperty()
+
+
+class StressOwner(model.Model):
+  name = model.StringProperty()
+  single = model.ReferenceProperty(StressTarget)
+  many = model.ReferenceProperty(StressTarget, repeated=True)
+
+
+def _expected(tag, repeated=3):
+  return 'single-%s' % tag, ['many-%s-%d' % (tag, i) for i in xrange(repeated)]
+
+
+def save(tag, mode='put'):
+  '''Saves an owner of new targets named by tag. Returns its key.'''
+  single, many = _expected(tag)
+  owner = StressOwner(name=tag, single=StressTarget(display=single),
+                      many=[StressTarget(display=d) for d in many])
+  if mode == 'put_with_references':
+    return owner.put_with_references()
+  return owner.put()
+
+
+def check(tag, key):
+  '''Returns the list of mismatches (strings) of the owner saved by tag.'''
+  errors = []
+  owner = key.get(use_cache=False, use_memcache=False)
+  if owner is None:
+    return ['%s: owner not found' % tag]
+  single, many = _expected(tag)
+  refs = []
+  if owner.single is None:
+    errors.append('%s: single reference lost' % tag)
+  else:
+    refs.append((owner.single, single))
+  if len(owner.many) != len(many):
+    errors.append('%s: %d many references, expected %d'
+                  % (tag, len(owner.many), len(many)))
+  refs += zip(owner.many, many)
+
+  targets = ndb.get_multi([ndb.Key(urlsafe=ref.urlsafe_key)
+                           for ref, unused in refs if ref.urlsafe_key],
+                          use_cache=False, use_memcache=False)
+  targets = iter(targets)
+  for ref, display in refs:
+    if ref.display != display:
+      errors.append('%s: reference display %r, expected %r'
+                    % (tag, ref.display, display))
+    if not ref.urlsafe_key:
+      errors.append('%s: reference %r without key' % (tag, display))
+      continue
+    target = next(targets)
+    if target is None:
+      errors.append('%s: target %r not found' % (tag, display))
+    elif target.display != display:
+      errors.append('%s: target display %r, expected %r'
+                    % (tag, target.display, display))
+    elif target.key.parent() != key:
+      errors.append('%s: target %r is not a child of its owner'
+                    % (tag, display))
+  return errors
+
+
+def run(threads=8, saves=50, mode='put'):
+  '''Saves threads * saves owners from threads started at once and checks
+  them. Returns a dict with counts, seconds and the mismatches found.'''
+  start = threading.Event()
+  saved = []
+  failures = []
+
+  @ndb.toplevel
+  def work(thread):
+    start.wait()
+    for index in xrange(saves):
+      tag = '%d-%d' % (thread, index)
+      try:
+        saved.append((tag, save(tag, mode)))
+      except Exception, e:
+        failures.append('%s: save failed: %r' % (tag, e))
+
+  workers = [threading.Thread(target=work, args=(i,)) for i in xrange(threads)]
+  for worker in workers:
+    worker.start()
+  started = time.time()
+  start.set()
+  for worker in workers:
+    worker.join()
+  seconds = time.time() - started
+
+  errors = list(failures)
+  for tag, key in saved:
+    errors += check(tag, key)
+  return {
+    'mode': mode,
+    'threads': threads,
+    'saves': len(saved),
+    'seconds': seconds,
+    'errors': errors,
+  }
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--threads', type=int, default=8)
+  parser.add_argument('--saves', type=int, default=50,
+                      help='Saves by thread.')
+  parser.add_argument('--mode', choices=MODES + ('all',), default='all')
+  args = parser.parse_args(argv)
+
+  modes = MODES if args.mode == 'all' else (args.mode,)
+  status = 0
+  with stubs():
+    for mode in modes:
+      result = run(args.threads, args.saves, mode)
+      print '%s: %d saves by %d threads in %.2f s, %d errors' % (
+        mode, result['saves'], result['threads'], result['seconds'],
+        len(result['errors']))
+      for error in result['errors'][:20]:
+        print '  %s' % error
+      if result['errors']:
+        status = 1
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -36,6 +36,7 @@ from google.appengine.api import users as google_users
 from google.appengine.api import images
 from babel.support import LazyProxy
 import model
+import dates
 
 import unittest
 from google.appengine.ext import testbed
@@ -83,12 +84,12 @@ class JSONEncoder(json.JSONEncoder):
     super(JSONEncoder, self).__init__(*args, **kwargs)
 
   def default(self, obj):
-    if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date):
-      return obj.strftime(model.DATETIME_FORMAT)
+    if isinstance(obj, datetime.datetime):
+      return dates.format_datetime(obj)
     elif isinstance(obj, datetime.date):
-      return obj.strftime(model.DATE_FORMAT)
+      return dates.format_date(obj)
     elif isinstance(obj, datetime.time):
-      return obj.strftime(model.TIME_FORMAT)
+      return dates.format_time(obj)
     elif isinstance(obj, ndb.Query):
       return obj.fetch()
     elif isinstance(obj, LazyProxy):
@@ -139,6 +140,9 @@ def resize_image(b64encoded_image, width=0, height=0):
 
 class BaseTestCase(unittest.TestCase):
   '''Base class to test.'''
+  # Directory holding queue.yaml. Needed to test pull queues.
+  root_path = None
+
   def __init__(self, *args, **kwargs):
     super(BaseTestCase, self).__init__(*args, **kwargs)
     self.app = webapp2.import_string('main.app')
@@ -152,6 +156,9 @@ class BaseTestCase(unittest.TestCase):
     self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
     self.testbed.init_memcache_stub()
     self.testbed.init_user_stub()
+    self.testbed.init_mail_stub()
+    self.testbed.init_taskqueue_stub(root_path=self.root_path)
+    self.testbed.init_search_stub()
 
   def tearDown(self):
     self.testbed.deactivate()
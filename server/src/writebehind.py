@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+# This file is part of Stones Server Side.
+
+# Stones Server Side is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Stones Server Side is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Stones Server Side.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2013, Carlos León <carlos.eduardo.leon.franco@gmail.com>
+
+'''Write-behind of entities: requests validate the data and enqueue the
+write in a pull queue; a worker leases the writes by batches and commits
+them with put_multi. Writes which fail, or updates of entities whose
+creation is not committed yet, are retried when their lease expires, up to
+MAX_RETRIES times.
+
+Writes carry the entity as the handler built it (create_model or
+update_model), so the worker does not parse request data again. An update
+only carries the properties it changed.
+
+Order of writes is kept within a batch, but not across batches or retries:
+when two updates of the same property of an entity are processed in
+different batches, the last one committed wins, even if it was enqueued
+first. Clients needing ordered updates of an entity must wait for the status
+of a write before sending the next one.
+
+The queue must be declared in queue.yaml:
+
+  - name: stones-write-behind
+    mode: pull
+
+WriteBehindWorkerHandler must be routed with name WORKER_ROUTE (it is
+kicked by a push task after each write) and may also be run by cron.'''
+
+import base64
+import collections
+import logging
+import time
+import uuid
+try:
+  import simplejson as json
+except ImportError:
+  import json
+
+import webapp2
+from google.appengine.ext import ndb
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore import entity_pb
+
+import model
+
+
+logger = logging.getLogger(__name__)
+__all__ = ['QUEUE', 'WORKER_ROUTE', 'WriteBehindFailure', 'enqueue',
+           'get_status', 'process_batch', 'run']
+
+# Pull queue holding the writes.
+QUEUE = 'stones-write-behind'
+# Name of the route to WriteBehindWorkerHandler.
+WORKER_ROUTE = 'stones.writebehind.worker'
+# Push queue of the tasks which kick the worker.
+WORKER_QUEUE = 'default'
+# Writes leased by batch.
+BATCH_SIZE = 100
+LEASE_SECONDS = 60
+# Times a write is retried before being given up.
+MAX_RETRIES = 5
+# Seconds the status of writes is kept in memcache.
+STATUS_SECONDS = 24 * 60 * 60
+MEMCACHE_NAMESPACE = 'stones.writebehind'
+
+
+class WriteBehindFailure(model.Model):
+  '''Write given up. Stored in the empty namespace, key id is the write
+  token.'''
+  key_urlsafe = model.StringProperty(indexed=False)
+  op = model.StringProperty(indexed=False)
+  error = model.TextProperty()
+  created = model.DateTimeProperty(auto_now_add=True)
+
+
+def _set_status(statuses):
+  if statuses:
+    memcache.set_multi(statuses, time=STATUS_SECONDS,
+                       namespace=MEMCACHE_NAMESPACE)
+
+
+def _kick_worker():
+  '''Adds a push task to run the worker. Tasks are named by second, so a
+  burst of writes kicks it once.'''
+  try:
+    url = webapp2.uri_for(WORKER_ROUTE)
+  except KeyError:
+    # No route, the worker is run by cron.
+    return
+  try:
+    taskqueue.add(url=url, queue_name=WORKER_QUEUE,
+                  name='writebehind-%d' % int(time.time()), countdown=1)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _encode(entity):
+  return base64.b64encode(ndb.ModelAdapter().entity_to_pb(entity).Encode())
+
+
+def _decode(data):
+  return ndb.ModelAdapter().pb_to_entity(
+    entity_pb.EntityProto(base64.b64decode(data)))
+
+
+def enqueue(op, entity, names=None, references=(), queue=QUEUE):
+  '''Enqueues a write. Returns its token, to check its status.
+
+  Args:
+    op: "post" to create entity, "put" to update the stored one.
+    entity: entity with complete key, as it must be written.
+    names: for "put", names of the properties changed.
+    references: new entities referenced by entity, written with it (see
+      Model._prepare_references).
+    queue: pull queue name.'''
+  token = uuid.uuid4().hex
+  payload = json.dumps({
+    'token': token,
+    'op': op,
+    'time': time.time(),
+    'key': entity.key.urlsafe(),
+    'entity': _encode(entity),
+    'names': list(names or []),
+    'references': [_encode(e) for e in references],
+  })
+  taskqueue.Queue(queue).add(taskqueue.Task(payload=payload, method='PULL',
+                                            name=token))
+  _set_status({token: 'pending'})
+  _kick_worker()
+  return token
+
+
+def get_status(token):
+  '''Returns the status of a write: "pending", "done", "failed" or
+  "unknown" (not found, e. g. expired), and the error if failed.'''
+  status = memcache.get(token, namespace=MEMCACHE_NAMESPACE)
+  if status in (None, 'failed'):
+    failure = WriteBehindFailure.get_by_id(token, namespace='')
+    if not failure is None:
+      return 'failed', failure.error
+  return status or 'unknown', None
+
+
+def _fail(job, error):
+  logger.error('Write %s %s given up: %s' % (job['op'], job['key'], error))
+  WriteBehindFailure(id=job['token'], namespace='', key_urlsafe=job['key'],
+                     op=job['op'], error=unicode(error)).put()
+  return 'failed'
+
+
+def _apply(entity, update, names):
+  '''Sets to entity the values of properties names of update.'''
+  for name in names:
+    prop = update._properties.get(name, None)
+    if prop is None or isinstance(prop, ndb.ComputedProperty):
+      continue
+    value = prop._get_value(update)
+    if name in entity._properties:
+      entity._properties[name]._set_value(entity, value)
+    else:
+      # Dynamic property of an Expando.
+      setattr(entity, prop._code_name, value)
+
+
+def _retry_or_fail(task, job, error, statuses, done):
+  if task.retry_count >= MAX_RETRIES:
+    statuses[job['token']] = _fail(job, error)
+    done.append(task)
+  else:
+    # Lease expires and the write is retried later.
+    logger.warning('Write %s %s failed: %s' % (job['op'], job['key'], error))
+
+
+def process_batch(tasks):
+  '''Commits the writes of leased tasks with a single put_multi. Writes of
+  the same entity are applied in the order they were enqueued. Returns the
+  tasks done (committed or given up), to be deleted.'''
+  jobs = []
+  done = []
+  for task in tasks:
+    try:
+      job = json.loads(task.payload)
+      jobs.append((task, job, ndb.Key(urlsafe=job['key'])))
+    except Exception, e:
+      logger.error('Invalid write-behind payload %r: %s' % (task.payload, e))
+      done.append(task)
+  jobs.sort(key=lambda (task, job, key): job['time'])
+
+  # Stored entities, to update them or to tell the put hooks of created
+  # ones whether they overwrite some.
+  keys = list(set([key for unused, job, key in jobs]))
+  stored = dict(zip(keys, ndb.get_multi(keys)))
+
+  statuses = {}
+  entities = collections.OrderedDict()
+  jobs_by_key = {}
+  for task, job, key in jobs:
+    try:
+      update = _decode(job['entity'])
+      job_references = [_decode(data) for data in job['references']]
+    except Exception, e:
+      # Invalid data is not retried.
+      statuses[job['token']] = _fail(job, e)
+      done.append(task)
+      continue
+    if job['op'] == 'post':
+      entity = update.__class__(key=key)
+      if isinstance(entity, model.Model):
+        entity._set_stored(stored[key])
+      names = update._values.keys()
+    else:
+      entity = entities.get(key, None) or stored.get(key, None)
+      names = job['names']
+      if entity is None:
+        # Its creation may be in a later batch.
+        _retry_or_fail(task, job, 'Entity not found.', statuses, done)
+        continue
+    try:
+      _apply(entity, update, names)
+    except Exception, e:
+      statuses[job['token']] = _fail(job, e)
+      done.append(task)
+      continue
+    entities[key] = entity
+    jobs_by_key.setdefault(key, []).append((task, job, job_references))
+
+  # New references are put in the same put_multi, after the entities.
+  puts = entities.values()
+  reference_ranges = {}
+  for key in entities:
+    for task, job, job_references in jobs_by_key[key]:
+      reference_ranges[job['token']] = (len(puts),
+                                        len(puts) + len(job_references))
+      puts.extend(job_references)
+  futures = ndb.put_multi_async(puts)
+
+  for index, key in enumerate(entities.keys()):
+    error = futures[index].get_exception()
+    for task, job, unused in jobs_by_key[key]:
+      start, end = reference_ranges[job['token']]
+      job_error = error
+      for future in futures[start:end]:
+        job_error = job_error or future.get_exception()
+      if job_error is None:
+        statuses[job['token']] = 'done'
+        done.append(task)
+      else:
+        _retry_or_fail(task, job, job_error, statuses, done)
+  _set_status(statuses)
+  return done
+
+
+def run(queue=QUEUE, batch_size=BATCH_SIZE, lease_seconds=LEASE_SECONDS,
+        seconds=60):
+  '''Commits batches of writes until the queue is empty or seconds pass.
+  Returns the number of writes done.'''
+  queue = taskqueue.Queue(queue)
+  deadline = time.time() + seconds
+  count = 0
+  while time.time() < deadline:
+    tasks = queue.lease_tasks(lease_seconds, batch_size)
+    if not tasks:
+      break
+    done = process_batch(tasks)
+    if done:
+      queue.delete_tasks(done)
+    count += len(done)
+  return count